@@ -0,0 +1,124 @@
+"""
+Time to bring simulated clients online against a loopback server.
+
+A server with the session admission of core.application and as many
+clients as asked for run in one process over loopback links. Devices are
+stand-ins that do nothing, so the time measured is connection setup,
+admission and the address handshake, up to the point where every client
+has configured its network.
+
+Clients connect in bursts, one burst per IOLoop iteration: the magic words
+of a thousand UDP clients at once overflow the default receive buffer of
+the server socket, and handshakes are not retransmitted.
+
+    python -m benchmarks.admission [--clients 1000] [--burst 50] [--link udp|tcp]
+"""
+import argparse
+import logging
+import resource
+import time
+import tornado.ioloop
+from core.admission import AdmissionController
+from core.devices.abstract import Device
+from core.links.tcp import TCPLink
+from core.links.udp import UDPLink
+from core.session import ClientSession, ServerSession
+
+
+LINKS = {
+    "udp": UDPLink,
+    "tcp": TCPLink,
+}
+PORT = 20990
+
+
+class NullDevice(Device):
+    def __init__(self, on_configured=None):
+        super(NullDevice, self).__init__()
+        self.on_configured = on_configured
+
+    def send_packet(self, packet):
+        packet.release()
+
+    def configure_network(self, *args, **kwargs):
+        if self.on_configured:
+            self.on_configured()
+
+    def restore_network(self, *args, **kwargs):
+        pass
+
+
+def raise_fd_limit(wanted):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted, hard), hard))
+
+
+def run(link_cls, clients, burst, timeout):
+    io_loop = tornado.ioloop.IOLoop.instance()
+    config = {"network": "10.48.0.0/16", "addons": []}
+    state = {"online": 0}
+    sessions = []
+
+    def on_online():
+        state["online"] += 1
+        if state["online"] == clients:
+            io_loop.stop()
+
+    def on_close(session):
+        session.cleanup()
+
+    def start_session(link):
+        session = ServerSession("server", config, NullDevice(), link)
+        sessions.append(session)
+        session.setup(on_close)
+
+    server = link_cls.get_manager_class("server")({"port": PORT})
+    server.setup()
+    admission = AdmissionController(server, start_session, clients, 0, io_loop)
+    admission.start()
+
+    def on_link(link):
+        if link is None:
+            return
+        session = ClientSession("client", config, NullDevice(on_online), link)
+        sessions.append(session)
+        session.setup(on_close)
+
+    def connect(left):
+        for i in xrange(min(burst, left)):
+            manager = link_cls.get_manager_class("client")({"host": "127.0.0.1",
+                "port": PORT})
+            manager.setup()
+            manager.create(on_link)
+        if left > burst:
+            io_loop.add_callback(lambda: connect(left - burst))
+
+    started = time.time()
+    # lost handshakes are not retried, give up on them eventually
+    io_loop.add_timeout(started + timeout, io_loop.stop)
+    connect(clients)
+    io_loop.start()
+    elapsed = time.time() - started
+    return elapsed, state["online"], admission.stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Session admission benchmark.")
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--burst", type=int, default=50)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--link", choices=sorted(LINKS), default="udp")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    raise_fd_limit(args.clients * 3 + 64)
+    elapsed, online, stats = run(LINKS[args.link], args.clients,
+        args.burst, args.timeout)
+    print "%d of %d %s clients online in %.2f s (%.0f sessions/s)" % (online,
+        args.clients, args.link, elapsed, online / elapsed)
+    print "admission: %s" % stats
+
+
+if __name__ == "__main__":
+    main()
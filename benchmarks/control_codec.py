@@ -0,0 +1,53 @@
+"""
+Handshake throughput of the control message codecs in
+core.networking.control.
+
+Every round encodes and decodes the three messages of an address handshake
+(ip_request, ip_reply, ip_confirm), which is what a server does per client
+when they all reconnect at once.
+
+    python -m benchmarks.control_codec [--handshakes 100000]
+"""
+import argparse
+import time
+from core.networking import control
+
+
+HANDSHAKE = (
+    {"type": "ip_request", "client_id": "5f0d6b3f9ce94d1c8a5ea2c1f6c7e8d4"},
+    {
+        "type": "ip_reply",
+        "server_ip": "10.48.0.1",
+        "network": "10.48.0.0/24",
+        "client_ip": "10.48.0.2",
+    },
+    {"type": "ip_confirm"},
+)
+
+
+def run(codec, handshakes):
+    encode, decode = control.encode, control.decode
+    started = time.time()
+    for i in xrange(handshakes):
+        for msg in HANDSHAKE:
+            decode(encode(msg, codec))
+    return time.time() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Control codec benchmark.")
+    parser.add_argument("--handshakes", type=int, default=100000)
+    args = parser.parse_args()
+
+    print "%-6s %14s %14s %14s" % ("codec", "bytes/hs", "handshakes/s",
+        "messages/s")
+    for name in sorted(control.CODECS):
+        codec = control.CODECS[name]
+        size = sum(len(control.encode(msg, codec)) for msg in HANDSHAKE)
+        elapsed = run(codec, args.handshakes)
+        print "%-6s %14d %14.0f %14.0f" % (name, size, args.handshakes / elapsed,
+            args.handshakes * len(HANDSHAKE) / elapsed)
+
+
+if __name__ == "__main__":
+    main()
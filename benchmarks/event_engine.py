@@ -0,0 +1,108 @@
+"""
+Wakeup latency and CPU cost of the event engines in core.utils.engine.
+
+For every engine and every descriptor count, that many socket pairs are
+registered with the IOLoop and a single byte is written to a random pair per
+round. Latency is measured from the write to the handler invocation.
+
+    python -m benchmarks.event_engine [--rounds 5000]
+"""
+import argparse
+import errno
+import random
+import resource
+import socket
+import time
+import tornado.ioloop
+from core.utils.engine import ENGINES
+
+
+FD_COUNTS = (10, 100, 1000)
+FD_SETSIZE = 1024
+
+
+def raise_fd_limit(wanted):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted, hard), hard))
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run(engine, fd_count, rounds):
+    pairs = [socket.socketpair() for i in xrange(fd_count)]
+    try:
+        if engine == "select" and max(r.fileno() for r, w in pairs) >= FD_SETSIZE:
+            return None
+
+        io_loop = tornado.ioloop.IOLoop(impl=ENGINES[engine]())
+        readers = dict((r.fileno(), r) for r, w in pairs)
+        latencies = []
+        state = {"sent": 0, "left": rounds}
+
+        def fire():
+            if state["left"] == 0:
+                io_loop.stop()
+                return
+            state["left"] -= 1
+            state["sent"] = time.time()
+            random.choice(pairs)[1].send("x")
+
+        def on_read(fd, events):
+            latencies.append(time.time() - state["sent"])
+            while True:
+                try:
+                    readers[fd].recv(64)
+                except socket.error as e:
+                    if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        break
+                    raise
+            io_loop.add_callback(fire)
+
+        for reader, writer in pairs:
+            reader.setblocking(0)
+            io_loop.add_handler(reader.fileno(), on_read, io_loop.READ)
+
+        io_loop.add_callback(fire)
+        started = cpu_seconds()
+        io_loop.start()
+        cpu = cpu_seconds() - started
+        io_loop.close()
+        return (percentile(latencies, 0.5), percentile(latencies, 0.99),
+            cpu / len(latencies))
+    finally:
+        for reader, writer in pairs:
+            reader.close()
+            writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Event engine wakeup benchmark.")
+    parser.add_argument("--rounds", type=int, default=5000)
+    args = parser.parse_args()
+
+    raise_fd_limit(max(FD_COUNTS) * 2 + 64)
+    random.seed(0)
+
+    print "%-10s %6s %12s %12s %14s" % ("engine", "fds", "p50 (us)",
+        "p99 (us)", "cpu/wake (us)")
+    for engine in sorted(ENGINES):
+        for fd_count in FD_COUNTS:
+            result = run(engine, fd_count, args.rounds)
+            if result is None:
+                print "%-10s %6d %12s" % (engine, fd_count, "n/a (FD_SETSIZE)")
+            else:
+                print "%-10s %6d %12.1f %12.1f %14.1f" % ((engine, fd_count) +
+                    tuple(v * 1e6 for v in result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+"""
+Forwarding throughput and latency of a client and a server session over
+loopback links, without root or TUN devices.
+
+The devices of both sessions are TUN devices whose file descriptor is one
+end of a datagram socketpair instead of /dev/net/tun, so packets take the
+same read and write path as they do in production. The benchmark plays
+the kernel at the other ends: it writes IPv4 packets stamped with the time
+into the client's device and reads them from the server's, keeping at most
+--window packets in flight.
+
+For every link and payload size it reports packets/s, Mbit/s of IP
+packets, p50/p99 one-way latency from device to device, and process CPU
+time per packet, the benchmark's own writes and reads included. Latency
+includes the time packets wait behind the window: --window 1 measures an
+idle path, larger windows load it.
+
+    python -m benchmarks.forwarding [--links tcp,udp] [--sizes 64,512,1400]
+        [--seconds 2] [--warmup 0.5] [--window 32]
+"""
+import argparse
+import errno
+import functools
+import io
+import logging
+import resource
+import socket
+import struct
+import time
+import tornado.ioloop
+from core.devices.tun import TUNDevice
+from core.links.tcp import TCPLink
+from core.links.udp import UDPLink
+from core.session import ClientSession, ServerSession
+
+
+LINKS = {
+    "udp": UDPLink,
+    "tcp": TCPLink,
+}
+PORTS = {
+    "udp": 20991,
+    "tcp": 20992,
+}
+# IPv4 header of a UDP packet from the client to the server address, the
+# total length is filled in per size
+IPV4_HEADER = struct.Struct("!BBHHHBBH4s4s")
+# send time and sequence number, after the IPv4 and UDP headers
+STAMP = struct.Struct("!dQ")
+STAMP_OFFSET = 28
+MIN_SIZE = STAMP_OFFSET + STAMP.size
+SOCKET_BUFFER = 4 << 20
+STALL_CHECK_MS = 100
+
+
+class SocketpairDevice(TUNDevice):
+    """
+    TUN device backed by a socketpair: the device reads and writes one end,
+    host is the other end, where the kernel would be.
+    """
+    def __init__(self, on_configured=None, **kwargs):
+        super(SocketpairDevice, self).__init__(**kwargs)
+        self.on_configured = on_configured
+        self.host = None
+
+    def __str__(self):
+        return "socketpair-tun"
+
+    def setup(self):
+        device, self.host = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        for sock in (device, self.host):
+            sock.setblocking(0)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER)
+        # the device owns the fd from here on, as it owns a tun fd
+        self.fd = device.fileno()
+        self.device_socket = device
+        self.file = io.FileIO(self.fd, "r", closefd=False)
+        self.io_loop.add_handler(self.fd, self.on_read, self.io_loop.READ)
+
+    def cleanup(self):
+        if self.fd is not None:
+            self.io_loop.remove_handler(self.fd)
+            self.device_socket.close()
+            self.host.close()
+        self.fd = None
+        self.file = None
+
+    def configure_network(self, *args, **kwargs):
+        if self.on_configured:
+            self.on_configured()
+
+    def restore_network(self, *args, **kwargs):
+        pass
+
+
+class Traffic(object):
+    """
+    Writes stamped packets into source and reads them from sink, for one
+    payload size at a time.
+    """
+    def __init__(self, source, sink, window, io_loop):
+        self.source = source
+        self.sink = sink
+        self.window = window
+        self.io_loop = io_loop
+        self.packet = None
+        self.sequence = 0
+        self.measuring = False
+        self.reset()
+        self.io_loop.add_handler(self.sink.fileno(), self.on_sink_read,
+            self.io_loop.READ)
+        self.stall_check = tornado.ioloop.PeriodicCallback(self.check_stalled,
+            STALL_CHECK_MS, self.io_loop)
+
+    def reset(self):
+        self.sent = 0
+        self.received = 0
+        self.lost = 0
+        self.received_at_check = 0
+        self.latencies = []
+
+    def start(self, size):
+        header = IPV4_HEADER.pack(0x45, 0, size, 0, 0, 64, 17, 0,
+            socket.inet_aton("10.48.0.2"), socket.inet_aton("10.48.0.1"))
+        self.packet = bytearray(header + "\x00" * (size - len(header)))
+        self.reset()
+        self.stall_check.start()
+        self.fill()
+
+    def stop(self):
+        self.stall_check.stop()
+        self.packet = None
+
+    def in_flight(self):
+        return self.sent - self.received - self.lost
+
+    def fill(self):
+        packet = self.packet
+        while packet is not None and self.in_flight() < self.window:
+            self.sequence += 1
+            STAMP.pack_into(packet, STAMP_OFFSET, time.time(), self.sequence)
+            try:
+                self.source.send(packet)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                    # the device will drain it and the sink call fill again
+                    return
+                raise
+            self.sent += 1
+
+    def on_sink_read(self, fd, events):
+        latencies = self.latencies
+        while True:
+            try:
+                data = self.sink.recv(65536)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if len(data) < MIN_SIZE:
+                continue
+            sent_at, _ = STAMP.unpack_from(data, STAMP_OFFSET)
+            if self.measuring:
+                latencies.append(time.time() - sent_at)
+            self.received += 1
+        self.fill()
+
+    def check_stalled(self):
+        # datagrams dropped on the way never arrive, stop waiting for them
+        if self.received == self.received_at_check and self.in_flight():
+            self.lost += self.in_flight()
+            self.fill()
+        self.received_at_check = self.received
+
+    def cleanup(self):
+        self.stop()
+        self.io_loop.remove_handler(self.sink.fileno())
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(link_name, sizes, seconds, warmup, window):
+    """
+    Returns a (size, pps, mbps, p50, p99, cpu per packet, lost) row per
+    size, or None if the sessions did not come up.
+    """
+    io_loop = tornado.ioloop.IOLoop.instance()
+    link_cls = LINKS[link_name]
+    config = {"network": "10.48.0.0/16", "addons": [],
+        "set_default_gateway": False}
+    sessions = []
+    devices = {}
+    state = {"configured": 0, "traffic": None}
+    results = []
+
+    def on_close(session):
+        session.cleanup()
+
+    def on_configured():
+        state["configured"] += 1
+        if state["configured"] == 2:
+            io_loop.add_callback(start)
+
+    def create_device(mode):
+        devices[mode] = SocketpairDevice(on_configured, io_loop=io_loop)
+        return devices[mode]
+
+    def on_server_link(link):
+        session = ServerSession("server", config, create_device("server"), link)
+        sessions.append(session)
+        session.setup(on_close)
+
+    def on_client_link(link):
+        if link is None:
+            io_loop.stop()
+            return
+        session = ClientSession("client", config, create_device("client"), link)
+        sessions.append(session)
+        session.setup(on_close)
+
+    def start():
+        traffic = Traffic(devices["client"].host, devices["server"].host,
+            window, io_loop)
+        state["traffic"] = traffic
+        measure(list(sizes))
+
+    def measure(left):
+        if not left:
+            io_loop.stop()
+            return
+        size = left.pop(0)
+        traffic = state["traffic"]
+        traffic.measuring = False
+        traffic.start(size)
+        io_loop.add_timeout(time.time() + warmup, functools.partial(begin,
+            size, left))
+
+    def begin(size, left):
+        traffic = state["traffic"]
+        traffic.reset()
+        traffic.measuring = True
+        started = (time.time(), cpu_seconds())
+        io_loop.add_timeout(started[0] + seconds, functools.partial(end, size,
+            left, started))
+
+    def end(size, left, started):
+        traffic = state["traffic"]
+        elapsed = time.time() - started[0]
+        cpu = cpu_seconds() - started[1]
+        received = traffic.received
+        traffic.measuring = False
+        traffic.stop()
+        latencies = sorted(traffic.latencies)
+        results.append((size, received / elapsed,
+            received * size * 8 / elapsed / 1e6,
+            percentile(latencies, 0.5), percentile(latencies, 0.99),
+            cpu / received if received else float("nan"), traffic.lost))
+        # let packets still in flight drain before the next size
+        io_loop.add_timeout(time.time() + 0.2, functools.partial(measure, left))
+
+    server = link_cls.get_manager_class("server")({"port": PORTS[link_name]})
+    server.setup()
+    server.create(on_server_link)
+    client = link_cls.get_manager_class("client")({"host": "127.0.0.1",
+        "port": PORTS[link_name]})
+    client.setup()
+    client.create(on_client_link)
+
+    timeout = io_loop.add_timeout(time.time() + 10 + len(sizes) * (seconds +
+        warmup + 1), io_loop.stop)
+    io_loop.start()
+    io_loop.remove_timeout(timeout)
+
+    if state["traffic"] is not None:
+        state["traffic"].cleanup()
+    for session in sessions:
+        session.cleanup()
+    client.cleanup()
+    server.cleanup()
+    return results if len(results) == len(sizes) else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Session forwarding benchmark.")
+    parser.add_argument("--links", default="tcp,udp")
+    parser.add_argument("--sizes", default="64,512,1400")
+    parser.add_argument("--seconds", type=float, default=2)
+    parser.add_argument("--warmup", type=float, default=0.5)
+    parser.add_argument("--window", type=int, default=32)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    links = args.links.split(",")
+    sizes = [int(size) for size in args.sizes.split(",")]
+    for link in links:
+        if link not in LINKS:
+            parser.error("unknown link: %s" % link)
+    for size in sizes:
+        if not MIN_SIZE <= size <= TUNDevice.MTU:
+            parser.error("sizes must be between %d and %d" % (MIN_SIZE,
+                TUNDevice.MTU))
+
+    print "%-5s %6s %10s %9s %9s %9s %10s %7s" % ("link", "size", "packets/s",
+        "Mbit/s", "p50 us", "p99 us", "cpu us/pkt", "lost")
+    for link in links:
+        results = run(link, sizes, args.seconds, args.warmup, args.window)
+        if results is None:
+            print "%-5s sessions did not come up" % link
+            continue
+        for size, pps, mbps, p50, p99, cpu, lost in results:
+            print "%-5s %6d %10.0f %9.1f %9.1f %9.1f %10.2f %7d" % (link, size,
+                pps, mbps, p50 * 1e6, p99 * 1e6, cpu * 1e6, lost)
+
+
+if __name__ == "__main__":
+    main()
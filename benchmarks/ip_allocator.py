@@ -0,0 +1,60 @@
+"""
+Startup and allocate/release cost of core.networking.ip.IPAddressSpaceManager
+for small, medium and carrier-sized pools.
+
+Per network the pool is created, --ops addresses (at most the whole pool)
+are allocated, all of them released, and as many allocated again from the
+released ones.
+
+    python -m benchmarks.ip_allocator [--ops 100000]
+"""
+import argparse
+import time
+from core.networking.ip import IPAddressSpaceManager
+
+
+NETWORKS = ("10.48.0.0/24", "10.48.0.0/16", "10.64.0.0/10")
+
+
+def timed(func, *args):
+    started = time.time()
+    result = func(*args)
+    return time.time() - started, result
+
+
+def allocate(manager, count):
+    return [manager.allocate() for i in xrange(count)]
+
+
+def release(manager, hosts):
+    for host in hosts:
+        manager.release(host)
+
+
+def run(network, ops):
+    startup, manager = timed(IPAddressSpaceManager, network)
+    count = min(ops, manager.slots)
+    allocation, hosts = timed(allocate, manager, count)
+    release_time, unused = timed(release, manager, hosts)
+    # skip the untouched slots so that allocation takes the released ones
+    manager.next_slot = manager.slots
+    reuse, unused = timed(allocate, manager, count)
+    return (manager.slots, len(manager.bitmap), startup, count / allocation,
+        count / release_time, count / reuse)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="IP allocator benchmark.")
+    parser.add_argument("--ops", type=int, default=100000)
+    args = parser.parse_args()
+
+    print "%-16s %9s %10s %12s %12s %12s %12s" % ("network", "hosts",
+        "bitmap (B)", "startup (ms)", "alloc/s", "release/s", "realloc/s")
+    for network in NETWORKS:
+        hosts, size, startup, allocs, releases, reallocs = run(network, args.ops)
+        print "%-16s %9d %10d %12.2f %12.0f %12.0f %12.0f" % (network, hosts,
+            size, startup * 1000, allocs, releases, reallocs)
+
+
+if __name__ == "__main__":
+    main()
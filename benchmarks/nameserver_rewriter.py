@@ -0,0 +1,117 @@
+"""
+Packets per second through NameserverRewriter: the header-offset rewriter
+of core.addons.resolve_rewriter against the scapy implementation it
+replaced (when scapy is installed).
+
+Each round rewrites a DNS query on its way out and the matching answer on
+its way back, i.e. two packets.
+
+    python -m benchmarks.nameserver_rewriter [--rounds 100000]
+"""
+import argparse
+import socket
+import struct
+import time
+from core.addons.resolve_rewriter import NameserverRewriter
+
+
+CLIENT = "10.48.0.2"
+NAMESERVER = "192.168.1.1"
+FORCED_NAMESERVER = "8.8.8.8"
+QUESTION = "\x07example\x03com\x00\x00\x01\x00\x01"
+ANSWER = "\xc0\x0c\x00\x01\x00\x01\x00\x00\x0e\x10\x00\x04\x5d\xb8\xd8\x22"
+
+
+def checksum(data):
+    if len(data) % 2:
+        data += "\x00"
+    total = sum(struct.unpack("!%dH" % (len(data) // 2), data))
+    while total >> 16:
+        total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
+
+
+def udp_packet(src, dst, sport, dport, payload):
+    src, dst = socket.inet_aton(src), socket.inet_aton(dst)
+    udp = struct.pack("!HHHH", sport, dport, 8 + len(payload), 0) + payload
+    pseudo = src + dst + struct.pack("!BBH", 0, 17, len(udp))
+    udp = udp[:6] + struct.pack("!H", checksum(pseudo + udp) or 0xFFFF) + udp[8:]
+    header = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(udp), 0, 0, 64, 17, 0,
+        src, dst)
+    header = header[:10] + struct.pack("!H", checksum(header)) + header[12:]
+    return header + udp
+
+
+def dns_packets(dns_id):
+    query = udp_packet(CLIENT, NAMESERVER, 40000, 53, struct.pack("!HHHHHH",
+        dns_id, 0x0100, 1, 0, 0, 0) + QUESTION)
+    answer = udp_packet(FORCED_NAMESERVER, CLIENT, 53, 40000, struct.pack(
+        "!HHHHHH", dns_id, 0x8180, 1, 1, 0, 0) + QUESTION + ANSWER)
+    return query, answer
+
+
+class ScapyNameserverRewriter(object):
+    """
+    The rewrite of NameserverRewriter before it stopped using scapy.
+    """
+    def __init__(self, nameserver):
+        from scapy.all import IP, UDP, DNS
+        self.IP, self.UDP, self.DNS = IP, UDP, DNS
+        self.nameserver = nameserver
+        self.records = {}
+
+    def rewrite(self, pkt):
+        IP, UDP, DNS = self.IP, self.UDP, self.DNS
+        ip = IP(pkt)
+        if ip.haslayer(DNS):
+            iph = ip.getlayer(IP)
+            udph = ip.getlayer(UDP)
+            dns = ip.getlayer(DNS)
+            if dns.qr == 0:
+                self.records[dns.id] = iph.dst
+                iph.dst = self.nameserver
+            elif dns.qr == 1:
+                record = self.records.pop(dns.id, None)
+                if record:
+                    iph.src = record
+            del iph.chksum
+            del udph.chksum
+            del iph.len
+            del udph.len
+            return str(iph / udph / dns)
+
+
+def run(rewrite, rounds):
+    packets = [dns_packets(i) for i in xrange(256)]
+    started = time.time()
+    for i in xrange(rounds):
+        query, answer = packets[i & 0xFF]
+        rewrite(query)
+        rewrite(answer)
+    return rounds * 2 / (time.time() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DNS rewriter benchmark.")
+    parser.add_argument("--rounds", type=int, default=100000)
+    args = parser.parse_args()
+
+    rewriter = NameserverRewriter({"force_nameserver": FORCED_NAMESERVER}, None)
+    query, answer = dns_packets(1)
+    query, answer = rewriter.rewrite(query), rewriter.rewrite(answer)
+    assert query[16:20] == socket.inet_aton(FORCED_NAMESERVER)
+    assert checksum(query[:20]) == 0 and answer[12:16] == socket.inet_aton(NAMESERVER)
+
+    print "%-16s %14s" % ("implementation", "packets/s")
+    try:
+        scapy_rewriter = ScapyNameserverRewriter(FORCED_NAMESERVER)
+    except ImportError:
+        print "%-16s %14s" % ("scapy", "n/a (not installed)")
+    else:
+        print "%-16s %14.0f" % ("scapy", run(scapy_rewriter.rewrite,
+            max(1, args.rounds // 100)))
+    print "%-16s %14.0f" % ("header offsets", run(rewriter.rewrite, args.rounds))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Per-packet cost of logging on the hot paths, with logging at info level.
+
+"before" is the statement the links and devices ran for every packet,
+logger.debug("sent: %s" % str(packet)), which formats the message whether
+or not it is logged. "off" is the guarded Tracer call that replaced it,
+"sampled" the same with tracing turned on at runtime for 1 in --sample
+packets (written to a null handler).
+
+    python -m benchmarks.tracing [--packets 1000000] [--sample 100]
+"""
+import argparse
+import logging
+import time
+from core.networking.packet import Packet
+from core.utils.trace import Tracer
+
+
+class NullHandler(logging.Handler):
+    def emit(self, record):
+        # format like a real handler would
+        self.format(record)
+
+
+def before(logger, tracer, packet, count):
+    for i in xrange(count):
+        logger.debug("sent: %s" % str(packet))
+
+
+def after(logger, tracer, packet, count):
+    for i in xrange(count):
+        if tracer.enabled:
+            tracer.trace("sent: %s", packet)
+
+
+def empty(logger, tracer, packet, count):
+    for i in xrange(count):
+        pass
+
+
+def measure(func, logger, tracer, packet, count):
+    started = time.time()
+    func(logger, tracer, packet, count)
+    return time.time() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hot path tracing benchmark.")
+    parser.add_argument("--packets", type=int, default=1000000)
+    parser.add_argument("--sample", type=int, default=100)
+    args = parser.parse_args()
+
+    logger = logging.getLogger("benchmark")
+    logger.propagate = False
+    logger.addHandler(NullHandler())
+    logger.setLevel(logging.INFO)
+    tracer = Tracer(logger)
+    packet = Packet("\x45" + "\x00" * 1399, source="benchmark")
+
+    loop = measure(empty, logger, tracer, packet, args.packets)
+    results = [("before", measure(before, logger, tracer, packet, args.packets)),
+        ("off", measure(after, logger, tracer, packet, args.packets))]
+    tracer.enable(args.sample)
+    results.append(("sampled 1/%d" % args.sample, measure(after, logger,
+        tracer, packet, args.packets)))
+
+    print "%-16s %12s" % ("logging", "ns/packet")
+    for name, elapsed in results:
+        print "%-16s %12.1f" % (name, (elapsed - loop) * 1e9 / args.packets)
+
+
+if __name__ == "__main__":
+    main()
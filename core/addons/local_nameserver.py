@@ -1,30 +1,44 @@
 from .abstract import Addon
+from ..networking import dns
 import socket
+import errno
 import logging
+import time
 import tornado.ioloop
 import tornado.gen
-from datetime import datetime, timedelta
 
 
-try:
-    from scapy.all import DNS
-except ImportError:
-    logging.error("Cannot import scapy. LocalNameserver requires scapy.")
-    raise
+RECORD_TIMEOUT = 60
 
 
 class LocalNameserver(Addon):
+    """
+    Nameserver on the client side that answers repeated queries from a
+    cache of the responses and passes the others to the server as
+    resolve_request control messages, batched per read. With "tunnel" set
+    to false, queries are sent to remote over UDP instead.
+    """
     def setup(self):
         self.remote = self.config.get('remote', '8.8.8.8')
-        self.logger = logging.getLogger("local-nameserver<%s>" % self.remote)
+        self.tunnel = self.config.get('tunnel', True)
+        self.logger = logging.getLogger("local-nameserver<%s>" % (
+            "tunnel" if self.tunnel else self.remote))
         self.io_loop = tornado.ioloop.IOLoop.instance()
+        # by transaction id over UDP, by query id through the tunnel
         self.records = {}
+        self.pending = []
+        self.next_id = 0
+        self.cache = dns.AnswerCache(
+            self.config.get('cache_bytes', dns.CACHE_BYTES),
+            self.config.get('max_ttl', dns.MAX_TTL),
+            self.config.get('max_negative_ttl', dns.MAX_NEGATIVE_TTL))
         self.socket = None
         self.periodic = tornado.ioloop.PeriodicCallback(self.timeout, 5000)
         self.periodic.start()
 
     def cleanup(self):
         self.periodic.stop()
+        self.logger.info("cache: %s" % self.cache.stats())
         if self.socket:
             self.io_loop.remove_handler(self.socket.fileno())
             self.socket.close()
@@ -35,43 +49,126 @@ class LocalNameserver(Addon):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.bind((self.config.get('host', '127.0.0.1'),
             self.config.get('port', 53)))
+        self.socket.setblocking(0)
         self.io_loop.add_handler(self.socket.fileno(),
             self.on_read, self.io_loop.READ)
-        self.session.add_message_callback("resolve_response", self.on_resolve_response)
-
-    def on_resolve_request(self, msg):
-        data = msg["data"]
-        
+        if self.tunnel:
+            self.session.add_message_callback("resolve_response",
+                self.on_resolve_response)
 
     def on_read(self, fd, events):
-        data, addr = self.socket.recvfrom(2048)
+        while self.socket:
+            try:
+                data, addr = self.socket.recvfrom(2048)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            self.on_datagram(data, addr)
+        self.send_pending()
+
+    def send_pending(self):
+        if not self.pending:
+            return
+        for batch in dns.encode_batches(self.pending):
+            self.session.link.send_message({"type": "resolve_request",
+                "queries": batch})
+        self.logger.debug("sent %d DNS requests through the tunnel" %
+            len(self.pending))
+        self.pending = []
+
+    def on_resolve_response(self, msg):
         try:
-            dns = DNS(data)
-        except:
+            answers = dns.decode_batch(msg["answers"])
+        except (KeyError, ValueError):
+            self.logger.warning("malformed resolve response")
+            return
+        now = time.time()
+        for query_id, response in answers:
+            record = self.records.pop(query_id, None)
+            if record is None or response is None:
+                continue
+            try:
+                self.cache.put(response, now)
+                response = dns.reply_to(record['query'], response)
+            except ValueError:
+                self.logger.debug("not caching malformed DNS answer")
+            try:
+                self.socket.sendto(response, record['from'])
+                self.logger.debug("forwarded DNS answer to " + str(record['from']))
+            except Exception as e:
+                self.logger.error(str(e))
+
+    def on_datagram(self, data, addr):
+        if len(data) < dns.HEADER.size:
             self.logger.warning("received malformed DNS packet from " + str(addr))
             return
+        dns_id, flags = dns.HEADER.unpack_from(data)[:2]
 
-        if dns.qr == 0:
-            self.records[str(dns.id)] = {'time': datetime.utcnow(), 'from': addr}
+        if not flags & dns.DNS_QR:
+            try:
+                answer = self.cache.get(data, time.time())
+            except ValueError:
+                # not a query the cache understands, leave it to remote
+                answer = None
+            if answer is not None:
+                try:
+                    self.socket.sendto(answer, addr)
+                    self.logger.debug("answered DNS request from %s from cache" %
+                        str(addr))
+                except Exception as e:
+                    self.logger.error(str(e))
+                return
+
+            if self.tunnel:
+                self.next_id = (self.next_id + 1) & 0x7FFFFFFF
+                self.records[self.next_id] = {'time': time.time(), 'from': addr,
+                    'query': data}
+                self.pending.append((self.next_id, data))
+                return
+
+            try:
+                key, _ = dns.parse_question(data)
+            except ValueError:
+                key = None
+            # answers must come from remote and match the question
+            self.records[dns_id] = {'time': time.time(), 'from': addr,
+                'key': key}
             try:
                 self.socket.sendto(data, (self.remote, 53))
                 self.logger.debug("forwarded DNS request from " + str(addr))
             except Exception as e:
                 self.logger.error(str(e))
-        elif dns.qr == 1:
-            record = self.records.get(str(dns.id), None)
-            if record:
-                try:
-                    self.socket.sendto(data, record['from'])
-                    self.logger.debug("forwarded DNS answer to " + str(record['from']))
-                except Exception as e:
-                    self.logger.error(str(e))
-                del self.records[str(dns.id)]
-            else:
-                self.logger.debug("unknown DNS answer: " + dns.summary())
+        elif not self.tunnel:
+            if addr != (self.remote, 53):
+                self.logger.debug("ignoring DNS answer from " + str(addr))
+                return
+            record = self.records.get(dns_id, None)
+            if record is None:
+                self.logger.debug("unknown DNS answer: %d" % dns_id)
+                return
+            try:
+                answered, _ = dns.parse_question(data)
+            except ValueError:
+                answered = None
+            if answered != record['key']:
+                self.logger.warning("DNS answer %d does not match its question" %
+                    dns_id)
+                return
+
+            del self.records[dns_id]
+            try:
+                self.cache.put(data, time.time())
+            except ValueError:
+                self.logger.debug("not caching malformed DNS answer")
+            try:
+                self.socket.sendto(data, record['from'])
+                self.logger.debug("forwarded DNS answer to " + str(record['from']))
+            except Exception as e:
+                self.logger.error(str(e))
 
     def timeout(self):
-        for dns_id in self.records:
-            record = self.records[dns_id]
-            if datetime.utcnow() - record['time'] > timedelta(seconds=60):
-                del self.records[dns_id]
+        deadline = time.time() - RECORD_TIMEOUT
+        for record_id, record in self.records.items():
+            if record['time'] < deadline:
+                del self.records[record_id]
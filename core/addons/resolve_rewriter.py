@@ -1,22 +1,27 @@
 from .abstract import Addon
+from ..networking.packet import adjust_checksum
 import logging
+import socket
+import struct
+import time
 import tornado.ioloop
-import sys
-from datetime import datetime, timedelta
-
-
-try:
-    from scapy.all import IP, UDP, DNS
-except ImportError:
-    logging.error("Cannot import scapy. It's required for NameserverRewriter.")
-    sys.exit(1)
 
 
+UDP_PROTOCOL = 17
+DNS_PORT = 53
 DNS_TIMEOUT = 60
 DNS_TIMEOUT_CLEARANCE = 10
+CHECKSUM = struct.Struct("!H")
+DNS_ID = struct.Struct("!H")
+DNS_QR = 0x80
 
 
 class NameserverRewriter(Addon):
+    """
+    Sends the DNS queries of the tunnel to force_nameserver and makes the
+    answers look like they came from the nameserver that was asked. Only
+    the addresses are patched, along with the IP and UDP checksums.
+    """
     def __init__(self, config, session):
         super(NameserverRewriter, self).__init__(config, session)
         self.logger = logging.getLogger(str(self))
@@ -28,48 +33,62 @@ class NameserverRewriter(Addon):
             self.config['force_nameserver'] = '8.8.8.8'
             self.logger.warning("Using default nameserver " +
                 self.config['force_nameserver'])
+        self.nameserver = socket.inet_aton(self.config['force_nameserver'])
 
     def __str__(self):
         return "nameserver-rewriter(%s)" % self.config.get(
             "force_nameserver", 'Unknown')
 
     def on_session_established(self):
-        self.session.add_rewriter_callback(self.rewrite)
+        self.session.add_rewriter_callback(self.rewrite, protocol=UDP_PROTOCOL,
+            ports=(DNS_PORT,))
 
     def rewrite(self, pkt):
-        ip = IP(pkt)
-        if ip.haslayer(DNS):
-            iph = ip.getlayer(IP)
-            udph = ip.getlayer(UDP)
-            dns = ip.getlayer(DNS)
-            if dns.qr == 0:  # query
-                record = {
-                    'dst_ip':  iph.dst,
-                    'time': datetime.utcnow()
-                }
-                self.records[dns.id] = record
-                self.logger.debug("rewriting DNS query: %s to %s" % (iph.dst,
-                    self.config['force_nameserver']))
-                iph.dst = self.config['force_nameserver']
-            elif dns.qr == 1:  # answer
-                self.logger.debug("found DNS answer: " + dns.summary())
-                record = self.records.get(dns.id, None)
-                if record:
-                    self.logger.debug("rewriting DNS answer: %s to %s" % (
-                        iph.src, record['dst_ip']))
-                    iph.src = record['dst_ip']
-                    del self.records[dns.id]
-            del iph.chksum
-            del udph.chksum
-            del iph.len
-            del udph.len
-            return str(iph / udph / dns)
+        # the pipeline only passes UDP to or from port 53 of IPv4
+        header_length = (ord(pkt[0]) & 0x0F) * 4
+        dns = header_length + 8
+        if len(pkt) < dns + 4 or (ord(pkt[6]) & 0x3F) or ord(pkt[7]):
+            # too short, or a fragment
+            return None
+
+        dns_id, = DNS_ID.unpack_from(pkt, dns)
+        if not ord(pkt[dns + 2]) & DNS_QR:
+            if pkt[header_length + 2: header_length + 4] != "\x00\x35":
+                return None
+            self.records[dns_id] = (pkt[16:20], time.time())
+            self.logger.debug("rewriting DNS query: %s to %s" % (
+                socket.inet_ntoa(pkt[16:20]), self.config['force_nameserver']))
+            return self.replace_address(pkt, header_length, 16, self.nameserver)
+        else:
+            if pkt[header_length: header_length + 2] != "\x00\x35":
+                return None
+            record = self.records.pop(dns_id, None)
+            if record is None:
+                return None
+            self.logger.debug("rewriting DNS answer: %s to %s" % (
+                socket.inet_ntoa(pkt[12:16]), socket.inet_ntoa(record[0])))
+            return self.replace_address(pkt, header_length, 12, record[0])
+
+    def replace_address(self, pkt, header_length, offset, address):
+        old = pkt[offset: offset + 4]
+        if old == address:
+            return None
+        buf = bytearray(pkt)
+        buf[offset: offset + 4] = address
+        ip_checksum, = CHECKSUM.unpack_from(pkt, 10)
+        CHECKSUM.pack_into(buf, 10, adjust_checksum(ip_checksum, old, address))
+        # the UDP checksum covers the addresses through the pseudo header,
+        # zero means the sender did not compute one
+        udp_checksum, = CHECKSUM.unpack_from(pkt, header_length + 6)
+        if udp_checksum:
+            CHECKSUM.pack_into(buf, header_length + 6, adjust_checksum(
+                udp_checksum, old, address) or 0xFFFF)
+        return str(buf)
 
     def clear_timeout(self):
-        for dns_id in self.records:
-            record = self.records[dns_id]
-            if (record['time'] - datetime.utcnow()) > timedelta(
-                seconds=DNS_TIMEOUT):
+        deadline = time.time() - DNS_TIMEOUT
+        for dns_id, (address, recorded) in self.records.items():
+            if recorded < deadline:
                 del self.records[dns_id]
 
     def cleanup(self):
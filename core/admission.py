@@ -0,0 +1,120 @@
+import logging
+import functools
+import tornado.ioloop
+from datetime import timedelta
+from collections import deque
+
+
+MAX_SESSIONS = 4096
+MAX_QUEUED = 256
+RETRY_SECONDS = 1
+
+
+class AdmissionController(object):
+    """
+    Turns the links of a link manager into sessions as fast as they arrive.
+
+    Up to max_sessions sessions run at once. Links beyond that wait in a
+    queue of up to max_queued for a session to close, and are rejected once
+    the queue is full. No new link is asked for while the queue is full, so
+    link managers that keep a backlog hold them back until there is room.
+    """
+    def __init__(self, link_manager, start_session, max_sessions=MAX_SESSIONS,
+            max_queued=MAX_QUEUED, io_loop=None):
+        self.link_manager = link_manager
+        self.start_session = start_session
+        self.max_sessions = max_sessions
+        self.max_queued = max_queued
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self.sessions = 0
+        self.queue = deque()
+        self.accepting = False
+        self.stopped = False
+        self.accepted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.logger = logging.getLogger("admission")
+
+    def stats(self):
+        return {
+            "sessions": self.sessions,
+            "waiting": len(self.queue),
+            "accepted": self.accepted,
+            "queued": self.queued,
+            "rejected": self.rejected,
+        }
+
+    def start(self):
+        self.accept()
+
+    def stop(self):
+        self.stopped = True
+        while self.queue:
+            self.queue.popleft().cleanup()
+
+    def accept(self):
+        if self.accepting or self.stopped or self.full():
+            return
+        self.accepting = True
+        self.link_manager.create(self.on_link)
+
+    def full(self):
+        return self.sessions >= self.max_sessions and \
+            len(self.queue) >= self.max_queued
+
+    def on_link(self, link):
+        self.accepting = False
+        if self.stopped:
+            if link:
+                link.cleanup()
+            return
+        if link is None:
+            # the link could not be opened, e.g. the server is not up yet
+            self.io_loop.add_timeout(timedelta(seconds=RETRY_SECONDS), self.accept)
+            return
+        self.admit(link)
+        # links the manager has ready are handed out synchronously, do not
+        # recurse through all of them
+        self.io_loop.add_callback(self.accept)
+
+    def admit(self, link):
+        if self.sessions < self.max_sessions and not self.queue:
+            self.run(link)
+        elif len(self.queue) < self.max_queued:
+            # messages the peer sends meanwhile are held by the link
+            link.set_close_callback(functools.partial(self.on_queued_close, link))
+            self.queue.append(link)
+            self.queued += 1
+            self.logger.debug("queued %s: %s" % (str(link), self.stats()))
+        else:
+            self.rejected += 1
+            self.logger.warning("rejected %s: %s" % (str(link), self.stats()))
+            link.cleanup()
+
+    def run(self, link):
+        self.sessions += 1
+        self.accepted += 1
+        self.start_session(link)
+        self.logger.debug("accepted %s: %s" % (str(link), self.stats()))
+
+    def on_queued_close(self, link):
+        try:
+            self.queue.remove(link)
+        except ValueError:
+            return
+        link.cleanup()
+        self.accept()
+
+    def release(self):
+        """
+        Called when a session has closed.
+        """
+        self.sessions -= 1
+        while self.queue and self.sessions < self.max_sessions:
+            link = self.queue.popleft()
+            link.set_close_callback(None)
+            if link.is_alive():
+                self.run(link)
+            else:
+                link.cleanup()
+        self.accept()
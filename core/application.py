@@ -4,13 +4,21 @@ import argparse
 import logging
 import json
 import tornado.ioloop
-from .utils import import_class
+import tornado.process
+from .utils import import_class, Error
+from .utils.engine import create_io_loop
 from devices.tun import TUNDeviceManager
 from session import ClientSession, ServerSession
+from admission import AdmissionController, MAX_SESSIONS, MAX_QUEUED
+from stats import StatsServer
 import tornado.gen
 import uuid
-from datetime import timedelta
 import atexit
+import signal
+
+
+# with tracing turned on by SIGUSR1, 1 in TRACE_SAMPLE packets is logged
+TRACE_SAMPLE = 100
 
 
 class Application(object):
@@ -21,6 +29,8 @@ class Application(object):
             description='A simple VPN implementation with flexible data transportation.')
         parser.add_argument('--logging', type=str, default='info',
             help='Log level: debug, info, warning, or error. (Default:info)')
+        parser.add_argument('--event-engine', type=str, default=None,
+            help='Event engine: select, epoll, epoll-et or kqueue. (Default:epoll-et on Linux, select elsewhere)')
         args = parser.parse_args()
 
         level = args.logging
@@ -30,10 +40,9 @@ class Application(object):
 
         logging.basicConfig(level=level, format=format)
         self.logger = logging.getLogger("app")
-        self.io_loop = tornado.ioloop.IOLoop(impl=tornado.ioloop._Select())
-        self.io_loop.install()
         self.mode = mode
         self.config = config
+
         self.config.setdefault("link", {})
         self.config.setdefault("rewriters", [])
         self.config.setdefault("device", {})
@@ -57,10 +66,37 @@ class Application(object):
 
         link_manager_cls = link_cls.get_manager_class(self.mode)
         device_manager_cls = device_cls.get_manager_class(self.mode)
-        self.link_manager = link_manager_cls(self.config["link"])
         self.device_manager = device_manager_cls(self.config["device"])
 
+        # workers must be forked before any IOLoop exists. every worker binds
+        # the link port with SO_REUSEPORT, the kernel hashes clients onto them
+        self.task_id = None
+        workers = 1
+        if self.mode == "server":
+            workers = self.device_manager.prefork(self.config.get("network"),
+                self.config["link"].get("shards", 1))
+        if workers > 1:
+            self.config["link"]["reuse_port"] = True
+            self.task_id = tornado.process.fork_processes(workers)
+            self.device_manager.postfork(self.task_id)
+            self.config["shard"] = self.task_id
+            self.config["shards"] = workers
+            self.logger = logging.getLogger("app[%d]" % self.task_id)
+
+        try:
+            self.io_loop = create_io_loop(args.event_engine or
+                self.config.get("event_engine"))
+        except Error as e:
+            self.logger.error(str(e))
+            sys.exit(1)
+        self.io_loop.install()
+
+        self.link_manager = link_manager_cls(self.config["link"])
+
         self.sessions = []
+        self.admission = None
+        self.stats_server = None
+        self.tracing = False
 
     def _run(self):
         self.link_manager.setup()
@@ -68,29 +104,50 @@ class Application(object):
 
         self.session_name = uuid.uuid4().hex
 
-        self.max_session_size = 1 if self.mode == "client" else 10
-        self.add_new_session()
+        if self.mode == "client":
+            self.admission = AdmissionController(self.link_manager,
+                self.start_session, 1, 0, self.io_loop)
+        else:
+            self.admission = AdmissionController(self.link_manager,
+                self.start_session, self.config.get("max_sessions", MAX_SESSIONS),
+                self.config.get("max_queued_sessions", MAX_QUEUED), self.io_loop)
+        self.admission.start()
+
+        # metrics on a Unix socket, one per worker
+        stats_socket = self.config.get("stats_socket")
+        if stats_socket:
+            if self.task_id is not None:
+                stats_socket += ".%d" % self.task_id
+            self.stats_server = StatsServer(stats_socket, self.sessions,
+                self.admission, self.io_loop)
+            self.stats_server.start()
+
+        # SIGUSR1 turns packet tracing of the sessions on and off
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, lambda signum, frame:
+                self.io_loop.add_callback(self.toggle_tracing))
+
+    def toggle_tracing(self):
+        self.tracing = not self.tracing
+        for session in self.sessions:
+            session.set_tracing(self.tracing, self.config.get("trace_sample",
+                TRACE_SAMPLE))
 
     @tornado.gen.engine
-    def add_new_session(self):
+    def start_session(self, link):
         session_cls = ClientSession if self.mode == "client" else ServerSession
-        if len(self.sessions) < self.max_session_size:
-            link = None
-            while link is None:
-                yield tornado.gen.Task(self.io_loop.add_timeout, timedelta(seconds=1))
-                link = yield tornado.gen.Task(self.link_manager.create)
-
-            device = yield tornado.gen.Task(self.device_manager.create)
+        device = yield tornado.gen.Task(self.device_manager.create)
 
-            session = session_cls(self.mode, self.config, device, link, name=self.session_name)
-            self.sessions.append(session)
-            session.setup(self.session_closed)
-            self.add_new_session()
+        session = session_cls(self.mode, self.config, device, link, name=self.session_name)
+        self.sessions.append(session)
+        session.setup(self.session_closed)
+        if self.tracing:
+            session.set_tracing(True, self.config.get("trace_sample", TRACE_SAMPLE))
 
     def session_closed(self, session):
         session.cleanup()
         self.sessions.remove(session)
-        self.add_new_session()
+        self.admission.release()
 
     def run(self):
         self.io_loop.add_callback(self._run)
@@ -104,6 +161,11 @@ class Application(object):
         if not self.cleaned_up:
             self.cleaned_up = True
             self.logger.info("cleaning up...")
+            if self.admission:
+                self.logger.info("sessions: %s" % self.admission.stats())
+                self.admission.stop()
+            if self.stats_server:
+                self.stats_server.stop()
             for session in self.sessions:
                 session.cleanup()
             self.link_manager.cleanup()
@@ -2,6 +2,7 @@ import abc
 import logging
 import tornado.ioloop
 from ..utils import Error
+from ..utils.metrics import new_metrics, DROPS
 
 
 class Device(object):
@@ -11,6 +12,15 @@ class Device(object):
     def get_manager_class(cls, mode):
         return None
 
+    def __init__(self):
+        self.metrics = new_metrics()
+
+    def update_metrics(self):
+        """
+        Brings gauges in metrics up to date before they are read.
+        """
+        pass
+
     def setup(self):
         pass
 
@@ -20,6 +30,19 @@ class Device(object):
     def is_alive(self):
         return True
 
+    def set_tracing(self, enabled, sample=1):
+        """
+        Turns per-packet tracing on or off whatever the log level, logging
+        every sample-th packet.
+        """
+        tracer = getattr(self, "tracer", None)
+        if tracer is None:
+            return
+        if enabled:
+            tracer.enable(sample)
+        else:
+            tracer.disable()
+
     def set_packet_callback(self, callback):
         self.packet_callback = callback
 
@@ -27,6 +50,20 @@ class Device(object):
         func = getattr(self, "packet_callback", None)
         if func:
             func(packet)
+        else:
+            self.metrics[DROPS] += 1
+            packet.release()
+
+    def set_batch_packet_callback(self, callback):
+        self.batch_packet_callback = callback
+
+    def apply_batch_packet_callback(self, packets):
+        func = getattr(self, "batch_packet_callback", None)
+        if func:
+            func(packets)
+        else:
+            for packet in packets:
+                self.apply_packet_callback(packet)
 
     @abc.abstractmethod
     def configure_network(self, server_public_ip, server_private_ip=None, client_private_ip=None):
@@ -43,6 +80,17 @@ class DeviceManager(object):
     def __init__(self, config):
         self.config = config
 
+    def prefork(self, network, workers):
+        """
+        Called in the parent process before any IOLoop exists, with the
+        network leased to clients and the number of worker processes the
+        link asks for. Returns the number of workers to fork.
+        """
+        return workers
+
+    def postfork(self, task_id):
+        pass
+
     def setup(self):
         pass
 
@@ -1,6 +1,8 @@
 from .abstract import Device, DeviceManager
 from ..networking.packet import Packet
 from ..utils import validate_port, Error, run_os_command
+from ..utils.trace import Tracer
+from ..utils.metrics import PACKETS_IN, BYTES_IN, PACKETS_OUT, BYTES_OUT
 import socket
 import logging
 import sys
@@ -15,11 +17,13 @@ class DivertSocketDevice(Device):
     def __init__(self, port, io_loop=None):
         if "darwin" not in sys.platform:
             raise Error("Divert socket works only on Mac OS X")
+        super(DivertSocketDevice, self).__init__()
         self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
         self.port = port
         self.callback = None
         self.ipfw_modified = False
         self.logger = logging.getLogger(str(self))
+        self.tracer = Tracer(self.logger)
         self.logger.debug("created.")
 
     def __str__(self):
@@ -48,7 +52,10 @@ class DivertSocketDevice(Device):
         p = Packet(payload, source=self.source_name, routing={'addr': addr,
             'direction': direction})
         self.source_ip = payload[12:16]
-        self.logger.debug("received: %s" % str(p))
+        self.metrics[PACKETS_IN] += 1
+        self.metrics[BYTES_IN] += len(payload)
+        if self.tracer.enabled:
+            self.tracer.trace("received: %s", p)
         self.apply_packet_callback(p)
 
     def cleanup(self):
@@ -59,7 +66,11 @@ class DivertSocketDevice(Device):
         payload = pkt.payload
         payload[16:20] = self.source_ip
         self.sock.send(payload)
-        self.logger.debug("sent: %s" % str(pkt))
+        self.metrics[PACKETS_OUT] += 1
+        self.metrics[BYTES_OUT] += len(payload)
+        if self.tracer.enabled:
+            self.tracer.trace("sent: %s", pkt)
+        pkt.release()
 
     def configure_network(self, server_public_ip, server_private_ip=None, client_private_ip=None,
             add_routes=False):
@@ -1,47 +1,97 @@
 from .abstract import Device, DeviceManager
 from ..networking.packet import Packet
-from fcntl import ioctl
+from ..networking.routing import RoutingTable
+from fcntl import ioctl, fcntl, F_GETFL, F_SETFL
 from ..utils import Error, hexdump, run_os_command, get_route
+from ..utils.trace import Tracer
+from ..utils.buffers import BufferPool
+from ..utils import bpf
+from ..networking import ipaddr
+from ..utils.metrics import PACKETS_IN, BYTES_IN, PACKETS_OUT, BYTES_OUT, DROPS
+import io
+import socket
 import struct
 import tornado.ioloop
 import logging
 import sys
 import os.path
+import errno
+import functools
+
+
+def load_steering_program(network, queues):
+    """
+    Loads the program that steers a packet to queue (dst - first host) %
+    queues, the worker whose address slice dst is in. See
+    IPAddressSpaceManager for the slices.
+    """
+    network = ipaddr.ip_network(network)
+    if network.version != 4:
+        raise ValueError("steering needs an IPv4 network: %s" % network)
+    return bpf.load_socket_filter([
+        bpf.mov64_reg(6, 1),
+        # destination address of the IPv4 header, no packet information
+        bpf.ld_abs_w(16),
+        bpf.alu32_sub_imm(0, int(network.network_address) + 1),
+        bpf.alu32_mod_imm(0, queues),
+        bpf.exit_insn(),
+    ])
 
 
 class TUNDevice(Device):
     TUNSETIFF = 0x400454ca
+    TUNSETSTEERINGEBPF = 0x800454e0
     IFF_TUN = 0x0001
     IFF_TAP = 0x0002
+    IFF_MULTI_QUEUE = 0x0100
     IFF_NO_PI = 0x1000
     MAX_BUF_SIZE = 2048
+    READ_BUDGET = 64
     IFNAME_PREFIX = "vpn"
     MTU = 1460
 
     @classmethod
     def get_manager_class(cls, mode):
+        if mode == "server":
+            return SharedTUNDeviceManager
         return TUNDeviceManager
 
-    def __init__(self, io_loop=None):
+    def __init__(self, io_loop=None, read_budget=None, ifname=None,
+            queue_fd=None):
+        super(TUNDevice, self).__init__()
         self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self.read_budget = read_budget or self.READ_BUDGET
+        # a queue of a multi-queue interface, opened already
+        self.queue_fd = queue_fd
         self.callback = None
         self.fd = None
-        self.ifname = None
+        self.file = None
+        self.pool = BufferPool.shared()
+        self.ifname = ifname
         self.added_routes = []
         self.setup_logger()
         self.logger.debug("created.")
 
     def setup_logger(self):
         self.logger = logging.getLogger(str(self))
+        self.tracer = Tracer(self.logger)
 
     def __str__(self):
         return "ifname<%s>" % self.ifname if self.ifname else "tun"
 
-    def open_tun(self, path):
-        mode = self.IFF_TUN | self.IFF_NO_PI
+    @classmethod
+    def open_tun(cls, path, ifname=None, multi_queue=False):
+        mode = cls.IFF_TUN | cls.IFF_NO_PI
+        if multi_queue:
+            mode |= cls.IFF_MULTI_QUEUE
         tun = os.open(path, os.O_RDWR)
+        # readiness is edge-triggered under epoll-et, on_read drains until EAGAIN
+        fcntl(tun, F_SETFL, fcntl(tun, F_GETFL) | os.O_NONBLOCK)
         if "linux" in sys.platform:
-            ifs = ioctl(tun, self.TUNSETIFF, struct.pack("16sH", self.IFNAME_PREFIX + "%d", mode))
+            # with a fixed ifname a multi-queue device attaches one more queue
+            # to the existing interface instead of creating a new one
+            name = ifname or (cls.IFNAME_PREFIX + "%d")
+            ifs = ioctl(tun, cls.TUNSETIFF, struct.pack("16sH", name, mode))
             ifname = ifs[:16].strip("\x00")
         elif "darwin" in sys.platform:
             ifname = os.path.split(path)[-1]
@@ -49,12 +99,15 @@ class TUNDevice(Device):
 
     def setup(self):
         opened_path = None
-        if "darwin" in sys.platform:
+        if self.queue_fd is not None:
+            self.fd = self.queue_fd
+            opened_path = "queue of %s" % self.ifname
+        elif "darwin" in sys.platform:
             for i in range(0, 16):
                 path = "/dev/tun" + str(i)
                 self.logger.debug("trying to open " + path)
                 try:
-                    self.fd, self.ifname = self.open_tun(path)
+                    self.fd, self.ifname = self.open_tun(path, self.ifname)
                     opened_path = path
                     break
                 except OSError as e:
@@ -63,12 +116,15 @@ class TUNDevice(Device):
             path = "/dev/net/tun"
             self.logger.debug("trying to open " + path)
             try:
-                self.fd, self.ifname = self.open_tun(path)
+                self.fd, self.ifname = self.open_tun(path, self.ifname)
                 opened_path = path
             except OSError as e:
                 self.logger.debug(str(e))
         if opened_path:
             self.setup_logger()
+            # no os.readv in Python 2: packets are read into pool buffers
+            # through readinto
+            self.file = io.FileIO(self.fd, "r", closefd=False)
             """
             Hack Tornado so that ERROR event is not automatically added, equal to:
 
@@ -90,16 +146,59 @@ class TUNDevice(Device):
             self.io_loop.remove_handler(self.fd)
             os.close(self.fd)
         self.fd = None
+        self.file = None
 
     def on_read(self, fd, events):
-        payload = os.read(self.fd, self.MAX_BUF_SIZE)
-        p = Packet(payload, source=self)
-        self.logger.debug("read: %s" % str(p))
-        self.apply_packet_callback(p)
+        """
+        Drains up to read_budget packets and hands them to the session as one
+        batch. When the budget runs out the rest are read on the next IOLoop
+        iteration, as edge-triggered epoll will not report them again.
+        """
+        packets = []
+        read_bytes = 0
+        pool = self.pool
+        while self.fd is not None and len(packets) < self.read_budget:
+            address = pool.acquire()
+            try:
+                if address is None:
+                    payload = os.read(self.fd, self.MAX_BUF_SIZE)
+                else:
+                    length = self.file.readinto(pool.buffer(address))
+                    if length is None:
+                        # would block
+                        pool.release(address)
+                        break
+                    payload = pool.buffer(address, length)
+            except (OSError, IOError) as e:
+                if address is not None:
+                    pool.release(address)
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if address is None:
+                p = Packet(payload, source=self)
+            else:
+                p = Packet(payload, source=self, pool=pool, address=address)
+            read_bytes += len(payload)
+            if self.tracer.enabled:
+                self.tracer.trace("read: %s", p)
+            packets.append(p)
+        else:
+            if self.fd is not None:
+                self.io_loop.add_callback(functools.partial(self.on_read, fd, events))
+
+        if packets:
+            self.metrics[PACKETS_IN] += len(packets)
+            self.metrics[BYTES_IN] += read_bytes
+            self.apply_batch_packet_callback(packets)
 
     def send_packet(self, pkt):
         os.write(self.fd, pkt.payload)
-        self.logger.debug("wrote: %s" % str(pkt))
+        self.metrics[PACKETS_OUT] += 1
+        self.metrics[BYTES_OUT] += len(pkt.payload)
+        if self.tracer.enabled:
+            self.tracer.trace("wrote: %s", pkt)
+        pkt.release()
 
     def interface_up(self, *args):
         if "darwin" in sys.platform:
@@ -128,6 +227,14 @@ class TUNDevice(Device):
             self.modify_route(*route, operation="delete")
         self.added_routes = []
 
+    @classmethod
+    def set_steering(cls, fd, program_fd):
+        """
+        Makes the eBPF program of program_fd pick the queue of every packet
+        the kernel writes to the interface of fd.
+        """
+        ioctl(fd, cls.TUNSETSTEERINGEBPF, struct.pack("i", program_fd))
+
     def configure_network(self, peer_pub_ip, peer_ip=None, my_ip=None,
             set_default_routes=False):
         self.interface_up(self.ifname, my_ip, peer_ip)
@@ -138,11 +245,180 @@ class TUNDevice(Device):
             self.add_route('0.0.0.0', '128.0.0.0', peer_ip, self.ifname)
             self.add_route('128.0.0.0', '128.0.0.0', peer_ip, self.ifname)
 
-    def restore_network(self, server_pub_ip, my_ip=None, peer_ip=None):
+    def restore_network(self, peer_pub_ip, peer_ip=None, my_ip=None):
         self.restore_routes()
         self.interface_down(self.ifname)
 
 
 class TUNDeviceManager(DeviceManager):
     def create(self, callback):
-        callback(TUNDevice())
+        callback(TUNDevice(read_budget=self.config.get("read_budget")))
+
+
+class SharedTUNDevice(Device):
+    """
+    A session's share of the server's TUN device: packets the device reads
+    for the session's client address are dispatched here, packets written
+    here go out of the shared device.
+    """
+    def __init__(self, manager):
+        super(SharedTUNDevice, self).__init__()
+        self.manager = manager
+        self.routes = []
+        self.logger = logging.getLogger(str(self))
+        self.tracer = Tracer(self.logger)
+
+    def __str__(self):
+        return "shared-tun"
+
+    def setup(self):
+        self.manager.attach()
+
+    def cleanup(self):
+        self.restore_network(None)
+
+    def send_packet(self, pkt):
+        self.metrics[PACKETS_OUT] += 1
+        self.metrics[BYTES_OUT] += len(pkt.payload)
+        if self.tracer.enabled:
+            self.tracer.trace("wrote: %s", pkt)
+        # the shared device writes and releases the packet
+        self.manager.device.send_packet(pkt)
+
+    def configure_network(self, peer_pub_ip, peer_ip=None, my_ip=None,
+            set_default_routes=False):
+        self.manager.add_route(peer_ip, my_ip, self)
+        self.routes.append((peer_ip, my_ip))
+
+    def restore_network(self, peer_pub_ip, peer_ip=None, my_ip=None):
+        for client_ip, server_ip in self.routes:
+            self.manager.remove_route(client_ip, server_ip, self)
+        self.routes = []
+
+
+class SharedTUNDeviceManager(TUNDeviceManager):
+    """
+    Serves every session of a server process from one TUN device. Packets
+    read from it are routed to sessions by destination address through a
+    longest-prefix-match table; the kernel gets a host route per client.
+
+    Set "shared" to false for one device per session.
+
+    With "queues" > 1 the device is created multi-queue and every queue is
+    served by its own worker process. Workers lease client addresses from
+    disjoint slices of the network, every queues-th address, and an eBPF
+    steering program gives each packet to the queue of the worker whose
+    slice its destination is in. The parent holds all queues open, so the
+    interface and the queue of a worker outlive the worker.
+    """
+    def __init__(self, config):
+        super(SharedTUNDeviceManager, self).__init__(config)
+        self.shared = self.config.get("shared", True)
+        if self.shared and "linux" not in sys.platform:
+            logging.warning("shared tun devices are only supported on Linux.")
+            self.shared = False
+        self.device = None
+        self.ifname = None
+        self.queue_fds = []
+        self.queue_fd = None
+        self.routes = RoutingTable()
+        self.unroutable = 0
+
+    def prefork(self, network, workers):
+        if self.config.get("queues", 1) <= 1:
+            return workers
+        if not self.shared:
+            logging.warning("multi-queue tun devices need \"shared\", "
+                "every worker gets its own device.")
+            return workers
+        queues = max(self.config["queues"], workers)
+        try:
+            program_fd = load_steering_program(network, queues)
+        except (OSError, ValueError) as e:
+            # a device per worker still works: the kernel routes every client
+            # to the device of the worker that leased its address
+            logging.warning("cannot steer packets to queues, every worker "
+                "gets its own device: %s" % str(e))
+            return workers
+
+        try:
+            for i in xrange(queues):
+                # queues are numbered in the order they are attached
+                fd, self.ifname = TUNDevice.open_tun("/dev/net/tun", self.ifname,
+                    multi_queue=True)
+                self.queue_fds.append(fd)
+            TUNDevice.set_steering(self.queue_fds[0], program_fd)
+        finally:
+            os.close(program_fd)
+        logging.info("created multi-queue interface %s for %d workers" % (
+            self.ifname, queues))
+        return queues
+
+    def postfork(self, task_id):
+        # the parent keeps every queue open, a worker only needs its own
+        for i, fd in enumerate(self.queue_fds):
+            if i == task_id:
+                self.queue_fd = fd
+            else:
+                os.close(fd)
+        self.queue_fds = []
+
+    def create(self, callback):
+        if not self.shared:
+            return super(SharedTUNDeviceManager, self).create(callback)
+        callback(SharedTUNDevice(self))
+
+    def attach(self):
+        if self.device is None:
+            self.device = TUNDevice(read_budget=self.config.get("read_budget"),
+                ifname=self.ifname, queue_fd=self.queue_fd)
+            self.device.setup()
+            self.device.set_batch_packet_callback(self.on_device_packets)
+            run_os_command("/sbin/ip link set %s up mtu %d" % (self.device.ifname,
+                TUNDevice.MTU))
+
+    def add_route(self, client_ip, server_ip, device):
+        """
+        Routes client_ip to device. The server end of the session's address
+        pair goes on the interface, with the host route to the client.
+        """
+        self.routes.add(client_ip, device)
+        run_os_command("/sbin/ip addr replace %s peer %s dev %s" % (server_ip,
+            client_ip, self.device.ifname))
+
+    def remove_route(self, client_ip, server_ip, device):
+        # the address may have been handed to a newer session meanwhile
+        if self.routes.lookup_packed(socket.inet_aton(client_ip)) is not device:
+            return
+        if self.routes.remove(client_ip) is not None:
+            run_os_command("/sbin/ip addr del %s peer %s dev %s" % (server_ip,
+                client_ip, self.device.ifname))
+
+    def on_device_packets(self, packets):
+        batches = {}
+        for packet in packets:
+            dst = packet.dst
+            device = self.routes.lookup_packed(dst) if dst is not None else None
+            if device is None:
+                self.unroutable += 1
+                self.device.metrics[DROPS] += 1
+                packet.release()
+                continue
+            batch = batches.get(device, None)
+            if batch is None:
+                batches[device] = [packet]
+            else:
+                batch.append(packet)
+        for device, batch in batches.iteritems():
+            device.metrics[PACKETS_IN] += len(batch)
+            device.metrics[BYTES_IN] += sum(len(packet.payload)
+                for packet in batch)
+            if device.tracer.enabled:
+                for packet in batch:
+                    device.tracer.trace("read: %s", packet)
+            device.apply_batch_packet_callback(batch)
+
+    def cleanup(self):
+        if self.device is not None:
+            self.device.cleanup()
+            self.device = None
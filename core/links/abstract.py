@@ -1,7 +1,12 @@
 import abc
 import tornado.ioloop
 import logging
+from ..networking import control
 from ..utils import Error
+from ..utils.metrics import new_metrics, DROPS, KEEPALIVE_RTT
+
+
+MAX_HELD_MESSAGES = 16
 
 
 class Link(object):
@@ -11,6 +16,21 @@ class Link(object):
     def get_manager_class(cls, mode):
         return None
 
+    def __init__(self):
+        self.metrics = new_metrics()
+        # not measured until a link answers a keep-alive, if it ever does
+        self.metrics[KEEPALIVE_RTT] = float("nan")
+        # codec of control messages sent, and the highest one this end speaks
+        self.codec = self.offered_codec = control.CODEC_JSON
+        # messages the peer sent before the link was handed to a session
+        self.held_messages = []
+
+    def update_metrics(self):
+        """
+        Brings gauges in metrics up to date before they are read.
+        """
+        pass
+
     def setup(self):
         pass
 
@@ -20,6 +40,19 @@ class Link(object):
     def is_alive(self):
         return True
 
+    def set_tracing(self, enabled, sample=1):
+        """
+        Turns per-packet tracing on or off whatever the log level, logging
+        every sample-th packet.
+        """
+        tracer = getattr(self, "tracer", None)
+        if tracer is None:
+            return
+        if enabled:
+            tracer.enable(sample)
+        else:
+            tracer.disable()
+
     @abc.abstractproperty
     def ip_endpoint(self):
         return None
@@ -28,10 +61,21 @@ class Link(object):
     def send_packet(self, packet):
         pass
 
+    def send_packets(self, packets):
+        for packet in packets:
+            self.send_packet(packet)
+
     @abc.abstractmethod
     def send_message(self, msg):
         pass
 
+    def accept_codec(self, codec):
+        """
+        Sends control messages with codec, the highest one the peer speaks,
+        or the highest one of this end if that is lower.
+        """
+        self.codec = min(self.offered_codec, codec)
+
     def set_packet_callback(self, callback):
         self.packet_callback = callback
 
@@ -39,14 +83,28 @@ class Link(object):
         func = getattr(self, "packet_callback", None)
         if func:
             func(packet)
+        else:
+            self.metrics[DROPS] += 1
+            packet.release()
 
     def set_message_callback(self, callback):
         self.message_callback = callback
+        if callback and self.held_messages:
+            tornado.ioloop.IOLoop.instance().add_callback(self.release_messages)
 
     def apply_message_callback(self, msg):
         func = getattr(self, "message_callback", None)
         if func:
             func(msg)
+        else:
+            # the peer may talk before the link has been handed to a session,
+            # keep its messages until somebody listens
+            if len(self.held_messages) < MAX_HELD_MESSAGES:
+                self.held_messages.append(msg)
+
+    def release_messages(self):
+        while getattr(self, "message_callback", None) and self.held_messages:
+            self.message_callback(self.held_messages.pop(0))
 
     def set_close_callback(self, callback):
         self.close_callback = callback
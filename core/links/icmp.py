@@ -1,14 +1,16 @@
 from .abstract import Link
 from ..networking.packet import Packet
+from ..networking import control
 from ..utils import validate_port, Error, read_packet
+from ..utils.timer import TimerWheel
+from ..utils.trace import Tracer
+from ..utils.metrics import PACKETS_IN, BYTES_IN, PACKETS_OUT, BYTES_OUT
 import struct
 import tornado.gen
 import logging
 import socket
 import tornado.netutil
 import tornado.ioloop
-from datetime import timedelta, datetime
-import json
 
 
 MAGIC_WORD = 0x1306A15
@@ -18,8 +20,8 @@ RESET_PACKET = struct.pack("!B", 0x00)
 CONTROL_MESSAGE_IDENTIFIER = 0x01
 PACKET_IDENTIFIER = 0x02
 KEEP_ALIVE_IDENTIFIER = 0x03
+KEEP_ALIVE_PACKET = struct.pack("!BH", KEEP_ALIVE_IDENTIFIER, 0)
 KEEP_ALIVE_SECONDS = 30
-CHECK_SECONDS = 30
 CONNECTION_DEATH_SECONDS = 90
 
 
@@ -51,15 +53,17 @@ class ICMPLink(Link):
     MAGIC_WORD = 0x1306A15
 
     def __init__(self, manager, address):
+        super(ICMPLink, self).__init__()
         self.manager = manager
         self.dest = address
         self.logger = logging.getLogger(str(self))
+        self.tracer = Tracer(self.logger)
         self.logger.debug("created.")
-        self.periodic_check = tornado.ioloop.PeriodicCallback(self.check_alive,
-            timedelta(seconds=CHECK_SECONDS))
-        self.periodic_send_alive = tornado.ioloop.PeriodicCallback(
-            self.send_alive, timedelta(seconds=KEEP_ALIVE_SECONDS))
-        self.record_alive()
+        # seconds on the clock of the manager's timer wheel
+        self.last_recorded = self.last_sent = manager.wheel.now
+        self.timer = None
+        self.closed = False
+        self.schedule_check()
 
     def __str__(self):
         if not hasattr(self, "_name"):
@@ -70,20 +74,31 @@ class ICMPLink(Link):
     def ip_endpoint(self):
         return self.dest[0]
 
+    def schedule_check(self):
+        # wake up when the link turns idle or dead, whichever comes first
+        now = self.manager.wheel.now
+        self.timer = self.manager.wheel.schedule(min(
+            self.last_sent + KEEP_ALIVE_SECONDS,
+            self.last_recorded + CONNECTION_DEATH_SECONDS) - now,
+            self.check_alive)
+
     def check_alive(self):
-        if datetime.utcnow() - self.last_recorded > timedelta(
-            seconds=CONNECTION_DEATH_SECONDS):
+        now = self.manager.wheel.now
+        if now - self.last_recorded >= CONNECTION_DEATH_SECONDS:
             self.manager.write(RESET_PACKET, self.dest)
             self.apply_close_callback()
+            return
+        # links that sent anything lately need no keep-alive
+        if now - self.last_sent >= KEEP_ALIVE_SECONDS:
+            self.send_alive()
+        if not self.closed:
+            self.schedule_check()
 
     def send_alive(self):
-        self.manager.write(struct.pack("!B", KEEP_ALIVE_IDENTIFIER), self.dest)
+        self.manager.write(KEEP_ALIVE_PACKET, self.dest)
+        self.last_sent = self.manager.wheel.now
         self.logger.debug("sent keep-alive")
 
-    def setup(self):
-        self.periodic_check_alive.start()
-        self.periodic_send_alive.start()
-
     def parse_packet(self, pkt):
         try:
             pkt.decode()
@@ -112,32 +127,36 @@ class ICMPLink(Link):
                     data = payload[consumed: consumed + length]
                     if type_byte == CONTROL_MESSAGE_IDENTIFIER:
                         try:
-                            msg = json.loads(data)
-                        except:
-                            raise
-                            self.logger.error("cannot parse message: " + data)
+                            msg = control.decode(data)
+                        except ValueError:
+                            self.logger.error("cannot parse message: %r" % data)
                             return
                         self.logger.debug("received message: " + str(msg))
                         self.record_alive()
                         self.apply_message_callback(msg)
                     elif type_byte == PACKET_IDENTIFIER:
                         self.record_alive()
+                        self.metrics[PACKETS_IN] += 1
+                        self.metrics[BYTES_IN] += length
                         p = Packet(data, source=self)
-                        self.logger.debug("received: " + str(p))
+                        if self.tracer.enabled:
+                            self.tracer.trace("received: %s", p)
                         self.apply_packet_callback(p)
                     elif type_byte == KEEP_ALIVE_IDENTIFIER:
                         self.logger.debug("received keep-alive")
                         self.record_alive()
 
     def record_alive(self):
-        self.last_recorded = datetime.utcnow()
+        self.last_recorded = self.manager.wheel.now
 
     def establish(self, callback):
         callback()
 
     def cleanup(self):
-        self.periodic_check.stop()
-        self.periodic_send_alive.stop()
+        self.closed = True
+        if self.timer is not None:
+            self.manager.wheel.cancel(self.timer)
+            self.timer = None
         try:
             self.manager.write(RESET_PACKET, self.dest)
         except:
@@ -147,15 +166,21 @@ class ICMPLink(Link):
         return True
 
     def send_packet(self, packet):
-        p = ICMPPacket()
-        p.
-        self.manager.write(data, self.dest)
-        self.logger.debug("sent: %s" % str(packet))
+        payload = packet.tobytes()
+        self.manager.write(struct.pack("!BH", PACKET_IDENTIFIER,
+            len(payload)) + payload, self.dest)
+        self.last_sent = self.manager.wheel.now
+        self.metrics[PACKETS_OUT] += 1
+        self.metrics[BYTES_OUT] += len(packet.payload)
+        if self.tracer.enabled:
+            self.tracer.trace("sent: %s", packet)
+        packet.release()
 
     def send_message(self, msg):
-        serialized = bytes(json.dumps(msg))
+        serialized = control.encode(msg, control.CODEC_JSON)
         self.manager.write(struct.pack("!BH", CONTROL_MESSAGE_IDENTIFIER,
             len(serialized)) + serialized, self.dest)
+        self.last_sent = self.manager.wheel.now
         self.logger.debug("sent message: " + str(msg))
 
 
@@ -163,6 +188,7 @@ class UDPLinkClientManager(object):
     def __init__(self, config):
         self.config = config
         self.io_loop = tornado.ioloop.IOLoop.instance()
+        self.wheel = TimerWheel(io_loop=self.io_loop)
         self.logger = logging.getLogger(str(self))
         self.logger.debug("created.")
 
@@ -172,8 +198,10 @@ class UDPLinkClientManager(object):
     def setup(self):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_RAW,
             socket.IPPROTO_ICMP)
+        self.wheel.start()
 
     def cleanup(self):
+        self.wheel.stop()
         self.io_loop.remove_handler(self.socket)
 
     @tornado.gen.engine
@@ -190,9 +218,9 @@ class UDPLinkClientManager(object):
 
         if len(data) == struct.calcsize("!L"):
             word, = struct.unpack("!L", data)
-            if word == UDP_MAGIC_WORD:
+            if word == MAGIC_WORD:
                 self.logger.info("received correct magic word.")
-                self.link = UDPLink(self, peer)
+                self.link = ICMPLink(self, peer)
                 self.io_loop.add_handler(self.socket, self.on_socket_read,
                     self.io_loop.READ)
                 callback(self.link)
@@ -206,7 +234,7 @@ class UDPLinkClientManager(object):
             callback(None)
 
     def on_socket_read(self, fd, events):
-        data, addr = self.socket.recvfrom(UDP_BUF_SIZE)
+        data, addr = self.socket.recvfrom(BUF_SIZE)
         self.link.parse_packet(Packet(data, source=self, routing={
             'src': addr
             }))
@@ -221,6 +249,8 @@ class UDPLinkServerManager(object):
         self.creation_callback = None
         self.io_loop = tornado.ioloop.IOLoop.instance()
         self.addr_links = {}
+        # keep-alives and liveness checks of all links
+        self.wheel = TimerWheel(io_loop=self.io_loop)
         self.logger = logging.getLogger(str(self))
         self.logger.debug("created.")
 
@@ -234,22 +264,23 @@ class UDPLinkServerManager(object):
             self.config['port'])
         self.io_loop.add_handler(self.socket.fileno(), self.on_socket_read,
             self.io_loop.READ)
+        self.wheel.start()
 
     def on_socket_read(self, fd, events):
-        data, addr = self.socket.recvfrom(UDP_BUF_SIZE)
+        data, addr = self.socket.recvfrom(BUF_SIZE)
 
         link = self.addr_links.get(addr, None)
         if link is None:
             magic_word, = struct.unpack("!L", data)
-            if magic_word != UDP_MAGIC_WORD:
+            if magic_word != MAGIC_WORD:
                 self.logger.debug("magic word does not match.")
                 self.socket.sendto(RESET_PACKET, addr)
             else:
                 if data == RESET_PACKET:
                     return
-                link = UDPLink(self, addr)
+                link = ICMPLink(self, addr)
                 self.addr_links[addr] = link
-                self.socket.sendto(struct.pack("!L", UDP_MAGIC_WORD), addr)
+                self.socket.sendto(struct.pack("!L", MAGIC_WORD), addr)
                 self.logger.info("new client from " + str(addr))
                 self.creation_callback(link)
         else:
@@ -265,4 +296,5 @@ class UDPLinkServerManager(object):
         self.creation_callback = callback
 
     def cleanup(self):
+        self.wheel.stop()
         self.io_loop.remove_handler(self.socket.fileno())
@@ -0,0 +1,257 @@
+from .abstract import Link
+from .tcp import TCPLinkClientManager, TCPLinkServerManager
+from ..utils.metrics import (PACKETS_IN, BYTES_IN, PACKETS_OUT, BYTES_OUT,
+    QUEUE_DEPTH)
+import tornado.gen
+import tornado.ioloop
+import logging
+import functools
+import uuid
+from datetime import timedelta
+from collections import deque
+
+
+STREAMS = 4
+MAX_STREAMS = 64
+JOIN_TIMEOUT_SECONDS = 10
+
+
+class MultiTCPLink(Link):
+    """
+    One logical link over several TCP connections. Packets are spread over
+    the connections by the hash of their inner 5-tuple: a flow keeps its
+    order on one connection, while a stalled connection only holds up the
+    flows hashed onto it.
+    """
+    @classmethod
+    def get_manager_class(cls, mode):
+        if mode == "server":
+            return MultiTCPLinkServerManager
+        elif mode == "client":
+            return MultiTCPLinkClientManager
+
+    def __init__(self, session_id, members):
+        super(MultiTCPLink, self).__init__()
+        self.session_id = session_id
+        self.members = members
+        self.offered_codec = members[0].offered_codec
+        self.closed = False
+        self.logger = logging.getLogger(str(self))
+        for member in self.members:
+            member.set_packet_callback(self.apply_packet_callback)
+            member.set_message_callback(self.apply_message_callback)
+            member.set_close_callback(self.on_member_close)
+        self.logger.debug("created.")
+
+    def __str__(self):
+        if not hasattr(self, "_name"):
+            self._name = u"multitcplink<%s:%d,%d>" % (self.members[0].dest +
+                (len(self.members),))
+        return self._name
+
+    @property
+    def ip_endpoint(self):
+        return self.members[0].ip_endpoint
+
+    def is_alive(self):
+        return not self.closed
+
+    def set_tracing(self, enabled, sample=1):
+        for member in self.members:
+            member.set_tracing(enabled, sample)
+
+    def update_metrics(self):
+        # the members count the traffic, drops are counted here
+        for member in self.members:
+            member.update_metrics()
+        for slot in (PACKETS_IN, BYTES_IN, PACKETS_OUT, BYTES_OUT, QUEUE_DEPTH):
+            self.metrics[slot] = sum(member.metrics[slot]
+                for member in self.members)
+
+    def send_packet(self, packet):
+        index = packet.flow_hash() % len(self.members)
+        self.members[index].send_packet(packet)
+
+    def send_packets(self, packets):
+        batches = {}
+        for packet in packets:
+            index = packet.flow_hash() % len(self.members)
+            batches.setdefault(index, []).append(packet)
+        for index, batch in batches.iteritems():
+            self.members[index].send_packets(batch)
+
+    def send_message(self, msg):
+        # control messages stay on the first connection to keep their order
+        self.members[0].send_message(msg)
+
+    def accept_codec(self, codec):
+        super(MultiTCPLink, self).accept_codec(codec)
+        for member in self.members:
+            member.accept_codec(codec)
+
+    def replay(self, frames):
+        """
+        Delivers frames that arrived before the link was handed out.
+        """
+        for is_message, frame in frames:
+            if is_message:
+                self.apply_message_callback(frame)
+            else:
+                self.apply_packet_callback(frame)
+
+    def on_member_close(self):
+        if not self.closed:
+            self.logger.info("a member connection closed, closing link.")
+            self.cleanup()
+            self.apply_close_callback()
+
+    def cleanup(self):
+        self.closed = True
+        for member in self.members:
+            member.set_close_callback(None)
+            member.cleanup()
+
+
+class MultiTCPLinkClientManager(object):
+    def __init__(self, config):
+        self.config = config
+        self.streams = self.config.get('streams', STREAMS)
+        self.logger = logging.getLogger(str(self))
+        self.logger.debug("created.")
+
+    def __str__(self):
+        return "multitcp<%s:%d>" % (self.config['host'], self.config['port'])
+
+    def setup(self):
+        pass
+
+    def cleanup(self):
+        pass
+
+    @tornado.gen.engine
+    def create(self, callback):
+        managers = [TCPLinkClientManager(self.config) for i in xrange(self.streams)]
+        links = yield [tornado.gen.Task(manager.create) for manager in managers]
+        if None in links:
+            self.logger.info("could not open all %d connections." % self.streams)
+            for link in links:
+                if link:
+                    link.cleanup()
+            callback(None)
+            return
+
+        session_id = uuid.uuid4().hex
+        for index, link in enumerate(links):
+            link.send_message({
+                "type": "join",
+                "session": session_id,
+                "index": index,
+                "count": self.streams,
+                })
+        callback(MultiTCPLink(session_id, links))
+
+
+class MultiTCPLinkServerManager(object):
+    def __init__(self, config):
+        self.config = config
+        self.io_loop = tornado.ioloop.IOLoop.instance()
+        self.manager = TCPLinkServerManager(config)
+        self.groups = {}
+        self.established = deque([])
+        self.callback = None
+        self.logger = logging.getLogger(str(self))
+        self.logger.debug("created.")
+
+    def __str__(self):
+        return "multitcp-manager<%d>" % self.config['port']
+
+    def setup(self):
+        self.manager.setup()
+        self.accept()
+
+    def accept(self):
+        self.manager.create(self.on_member)
+
+    def on_member(self, link):
+        link.set_message_callback(functools.partial(self.on_join, link))
+        link.set_close_callback(functools.partial(self.on_member_close, link))
+        self.accept()
+
+    def on_member_close(self, link):
+        for session_id, group in self.groups.items():
+            if link in group["members"]:
+                self.io_loop.remove_timeout(group["timeout"])
+                self.expire(session_id)
+
+    def on_join(self, link, msg):
+        """
+        Groups connections by the session id each of them sends right after
+        the magic word, and hands out the link once all of them joined.
+        """
+        link.set_message_callback(None)
+        try:
+            session_id, index, count = msg["session"], int(msg["index"]), int(msg["count"])
+            if msg["type"] != "join" or not (0 <= index < count <= MAX_STREAMS):
+                raise ValueError()
+        except (KeyError, ValueError, TypeError):
+            self.logger.warning("%s did not join properly: %s" % (str(link), msg))
+            link.cleanup()
+            return
+
+        group = self.groups.get(session_id, None)
+        if group is None:
+            group = self.groups[session_id] = {
+                "members": [None] * count,
+                "early_frames": [],
+                "timeout": self.io_loop.add_timeout(timedelta(
+                    seconds=JOIN_TIMEOUT_SECONDS), functools.partial(self.expire,
+                    session_id)),
+                }
+        if len(group["members"]) != count or group["members"][index]:
+            self.logger.warning("%s sent a conflicting join: %s" % (str(link), msg))
+            link.cleanup()
+            return
+
+        group["members"][index] = link
+        # the peer starts sending as soon as it sent its joins, keep whatever
+        # arrives on the members until the whole group is there
+        link.set_packet_callback(functools.partial(self.on_early_frame,
+            group["early_frames"], False))
+        link.set_message_callback(functools.partial(self.on_early_frame,
+            group["early_frames"], True))
+        if None not in group["members"]:
+            del self.groups[session_id]
+            self.io_loop.remove_timeout(group["timeout"])
+            multi_link = MultiTCPLink(session_id, group["members"])
+            self.on_established(multi_link)
+            self.io_loop.add_callback(functools.partial(multi_link.replay,
+                group["early_frames"]))
+
+    def on_early_frame(self, frames, is_message, frame):
+        frames.append((is_message, frame))
+
+    def expire(self, session_id):
+        group = self.groups.pop(session_id, None)
+        if group:
+            self.logger.info("session %s did not open all connections." % session_id)
+            for link in group["members"]:
+                if link:
+                    link.cleanup()
+
+    def on_established(self, link):
+        if self.callback:
+            callback, self.callback = self.callback, None
+            callback(link)
+        else:
+            self.established.append(link)
+
+    def create(self, callback):
+        try:
+            link = self.established.popleft()
+        except IndexError:
+            self.callback = callback
+            return
+        callback(link)
+
+    def cleanup(self):
+        self.manager.cleanup()
@@ -1,8 +1,14 @@
 from .abstract import Link
-from ..networking.packet import Packet
+from ..networking.packet import Packet, FrameHeaders, FRAME_HEADER
+from ..networking import control
 from tornado.iostream import IOStream
-from ..utils import validate_port, Error
+from ..utils import validate_port, Error, SO_REUSEPORT
+from ..utils.mmsg import writev, IOV_MAX
+from ..utils.trace import Tracer
+from ..utils.metrics import (PACKETS_IN, BYTES_IN, PACKETS_OUT, BYTES_OUT,
+    QUEUE_DEPTH)
 import struct
+import time
 import tornado.gen
 import logging
 import socket
@@ -11,11 +17,14 @@ import tornado.ioloop
 import functools
 from datetime import timedelta
 from collections import deque
-import json
+
+
+COALESCE_BYTES = 64 * 1024
+COALESCE_DELAY_US = 0
 
 
 class TCPLink(Link):
-    MAGIC_WORD = 0x1306A15
+    MAGIC_WORD = control.MAGIC_WORD
     CONTROL_MESSAGE_IDENTIFIER = 0x01
     PACKET_IDENTIFIER = 0x02
 
@@ -26,14 +35,36 @@ class TCPLink(Link):
         elif mode == "client":
             return TCPLinkClientManager
 
-    def __init__(self, stream):
+    def __init__(self, stream, config=None):
+        super(TCPLink, self).__init__()
         self.stream = stream
+        self.config = config or {}
         self.io_loop = tornado.ioloop.IOLoop.instance()
         self.dest = self.stream.socket.getpeername()
         self.connected = True
+        self.read_buffer = bytearray()
+        self.establish_callback = None
+        self.pending = []
+        self.pending_bytes = 0
+        # bytes handed to the stream that it has yet to write
+        self.stream_bytes = 0
+        self.flush_scheduled = False
+        self.flush_handle = None
+        self.coalesce_bytes = self.config.get("coalesce_bytes", COALESCE_BYTES)
+        self.coalesce_delay = self.config.get("coalesce_delay_us", COALESCE_DELAY_US)
+        self.cork = self.config.get("cork", False) and hasattr(socket, "TCP_CORK")
+        self.offered_codec = control.get_codec(self.config.get("control_codec",
+            control.DEFAULT_CODEC))
         self.logger = logging.getLogger(str(self))
+        self.tracer = Tracer(self.logger)
+        self.set_socket_options()
         self.logger.debug("created.")
 
+    def set_socket_options(self):
+        # frames are coalesced here already, Nagle would only add delay
+        self.stream.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY,
+            1 if self.config.get("nodelay", True) else 0)
+
     def __str__(self):
         if not hasattr(self, "_name"):
             self._name = u"tcplink<%s:%d>" % (self.dest)
@@ -46,40 +77,188 @@ class TCPLink(Link):
     def setup(self):
         self.send_magic_word()
 
-    @tornado.gen.engine
     def establish(self, callback):
         self.logger.debug("establishing session link.")
 
         # add a close timeout in case server does not respond
-        handle = self.io_loop.add_timeout(timedelta(seconds=5), self.apply_close_callback)
-        data = yield tornado.gen.Task(self.stream.read_bytes, 4)
-        self.io_loop.remove_timeout(handle)
-
-        word, = struct.unpack("!L", data)
-        if word != self.MAGIC_WORD:
-            self.logger.debug("received wrong magic word: 0x%X" % word)
-            self.stream.close()
-        else:
+        self.establish_timeout = self.io_loop.add_timeout(timedelta(seconds=5),
+            self.apply_close_callback)
+        self.establish_callback = callback
+        self.stream.read_until_close(self.on_stream_closed, self.on_stream_data)
+
+    def on_stream_data(self, data):
+        self.read_buffer.extend(data)
+        if self.establish_callback:
+            if len(self.read_buffer) < MAGIC_WORD_HEADER.size:
+                return
+            word, = MAGIC_WORD_HEADER.unpack_from(self.read_buffer)
+            del self.read_buffer[:MAGIC_WORD_HEADER.size]
+            self.io_loop.remove_timeout(self.establish_timeout)
+            callback, self.establish_callback = self.establish_callback, None
+
+            if not control.is_magic_word(word):
+                self.logger.debug("received wrong magic word: 0x%X" % word)
+                self.stream.close()
+                return
             self.stream.set_close_callback(self.on_close)
             self.logger.debug("received correct magic word: 0x%X" % word)
             callback()
-            self.io_loop.add_callback(self.process_stream)
+            self.io_loop.add_callback(self.parse_frames)
+        else:
+            self.parse_frames()
+
+    def on_stream_closed(self, data):
+        pass
+
+    def parse_frames(self):
+        """
+        Dispatches every complete frame in the read buffer in one pass and
+        keeps a trailing partial frame for the next chunk.
+        """
+        buf = self.read_buffer
+        end = len(buf)
+        offset = 0
+        while offset < end and not self.stream.closed():
+            type_byte = buf[offset]
+            if type_byte == self.PACKET_IDENTIFIER:
+                if end - offset < FRAME_HEADER.size:
+                    break
+                type_byte, length = FRAME_HEADER.unpack_from(buf, offset)
+                start = offset + FRAME_HEADER.size
+                if end - start < length:
+                    break
+                offset = start + length
+                self.metrics[PACKETS_IN] += 1
+                self.metrics[BYTES_IN] += length
+                pkt = Packet(str(buf[start: offset]), source=self)
+                if self.tracer.enabled:
+                    self.tracer.trace("received: %s", pkt)
+                self.apply_packet_callback(pkt)
+            elif type_byte == self.CONTROL_MESSAGE_IDENTIFIER:
+                if end - offset < MESSAGE_HEADER.size:
+                    break
+                type_byte, length = MESSAGE_HEADER.unpack_from(buf, offset)
+                start = offset + MESSAGE_HEADER.size
+                if end - start < length:
+                    break
+                offset = start + length
+                payload = str(buf[start: offset])
+                try:
+                    msg = control.decode(payload)
+                except ValueError:
+                    self.logger.error("cannot parse message: %r" % payload)
+                    self.stream.close()
+                    return
+                self.logger.debug("received message: " + str(msg))
+                self.apply_message_callback(msg)
+            else:
+                self.logger.error("came a wild id: 0x%X. it's a suicide!" % type_byte)
+                self.stream.close()
+                return
+        del buf[:offset]
 
     def cleanup(self):
         self.callback = None
+        self.cancel_flush()
+        self.pending = []
+        self.pending_bytes = 0
+        self.stream_bytes = 0
         self.stream.close()
 
     def is_alive(self):
         return self.connected
 
+    def update_metrics(self):
+        # frames waiting to be coalesced and what the socket did not take
+        self.metrics[QUEUE_DEPTH] = self.pending_bytes + self.stream_bytes
+
     def send_packet(self, packet):
-        self.stream.write(struct.pack("!B", self.PACKET_IDENTIFIER) + packet.serialize())
-        self.logger.debug("sent: %s" % str(packet))
+        # the frame may be queued past this IOLoop iteration
+        packet.detach()
+        self.queue_parts(packet.frame(PACKET_HEADERS))
+        self.metrics[PACKETS_OUT] += 1
+        self.metrics[BYTES_OUT] += len(packet.payload)
+        if self.tracer.enabled:
+            self.tracer.trace("sent: %s", packet)
+
+    def queue_parts(self, parts):
+        """
+        Coalesces frames into one writev(2). The queue is flushed at the end
+        of the current IOLoop iteration, or after coalesce_delay_us if set,
+        and right away once it holds coalesce_bytes.
+        """
+        self.pending.extend(parts)
+        for part in parts:
+            self.pending_bytes += len(part)
+
+        if self.pending_bytes >= self.coalesce_bytes or \
+            len(self.pending) >= IOV_MAX - 1:
+            self.flush()
+        elif not self.flush_scheduled:
+            self.flush_scheduled = True
+            if self.coalesce_delay:
+                self.flush_handle = self.io_loop.add_timeout(time.time() +
+                    self.coalesce_delay / 1000000.0, self.flush)
+            else:
+                self.io_loop.add_callback(self.flush)
+
+    def cancel_flush(self):
+        if self.flush_handle:
+            self.io_loop.remove_timeout(self.flush_handle)
+            self.flush_handle = None
+        self.flush_scheduled = False
+
+    def flush(self):
+        self.cancel_flush()
+        if not self.pending:
+            return
+        parts = self.pending
+        self.pending = []
+        self.pending_bytes = 0
+        if self.stream.closed():
+            return
+
+        if self.cork:
+            self.stream.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+        self.write_parts(parts)
+        if self.cork:
+            # uncorking pushes out the last partial segment immediately
+            self.stream.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+
+    def write_parts(self, parts):
+        """
+        Writes the parts of a frame with one writev(2) while nothing is
+        queued in the stream. Only what the socket did not take is copied
+        into the IOStream write buffer.
+        """
+        written = 0
+        if not self.stream.writing() and not self.stream.closed():
+            try:
+                written = writev(self.stream.socket, parts)
+            except socket.error:
+                # let the stream run into the error and close itself
+                written = 0
+
+        for part in parts:
+            if written >= len(part):
+                written -= len(part)
+            else:
+                self.stream_bytes += len(part) - written
+                self.stream.write(part[written:] if written else part,
+                    self.on_stream_drained)
+                written = 0
+
+    def on_stream_drained(self):
+        # runs from the IOLoop, a later write may have refilled the stream
+        if not self.stream.writing():
+            self.stream_bytes = 0
 
     def send_message(self, msg):
-        serialized = bytes(json.dumps(msg))
-        self.stream.write(struct.pack("!BL", self.CONTROL_MESSAGE_IDENTIFIER,
-            len(serialized)) + serialized)
+        serialized = control.encode(msg, self.codec)
+        # queued behind pending packets to keep the frame order
+        self.queue_parts((MESSAGE_HEADER.pack(self.CONTROL_MESSAGE_IDENTIFIER,
+            len(serialized)), serialized))
+        self.flush()
         self.logger.debug("sent message: " + str(msg))
 
     def on_close(self):
@@ -90,46 +269,13 @@ class TCPLink(Link):
         self.apply_close_callback()
 
     def send_magic_word(self):
-        self.stream.write(struct.pack("!L", self.MAGIC_WORD))
+        self.stream.write(MAGIC_WORD_HEADER.pack(self.MAGIC_WORD))
         self.logger.debug("sent magic word: 0x%X" % self.MAGIC_WORD)
 
-    @tornado.gen.engine
-    def process_stream(self):
-        type_byte, = struct.unpack("!B", (yield tornado.gen.Task(
-            self.stream.read_bytes, 1)))
-        if type_byte == self.CONTROL_MESSAGE_IDENTIFIER:
-            self.wait_message()
-        elif type_byte == self.PACKET_IDENTIFIER:
-            self.wait_packet()
-        else:
-            self.logger.error("came a wild id: 0x%X. it's a suicide!" % type_byte)
-            self.stream.close()
 
-    @tornado.gen.engine
-    def wait_message(self):
-        data = yield tornado.gen.Task(self.stream.read_bytes, struct.calcsize("!L"))
-        length, = struct.unpack("!L", data)
-        payload = yield tornado.gen.Task(self.stream.read_bytes, length)
-        try:
-            msg = json.loads(payload)
-        except:
-            self.logger.error("cannot parse message: %s" % payload)
-            self.stream.close()
-            return
-
-        self.logger.debug("received message: " + str(msg))
-        self.apply_message_callback(msg)
-        self.io_loop.add_callback(self.process_stream)
-
-    @tornado.gen.engine
-    def wait_packet(self):
-        data = yield tornado.gen.Task(self.stream.read_bytes, struct.calcsize("!H"))
-        length, = struct.unpack("!H", data)
-        payload = yield tornado.gen.Task(self.stream.read_bytes, length)
-        pkt = Packet(payload, source=self)
-        self.logger.debug("received: " + str(pkt))
-        self.apply_packet_callback(pkt)
-        self.io_loop.add_callback(self.process_stream)
+PACKET_HEADERS = FrameHeaders(TCPLink.PACKET_IDENTIFIER)
+MAGIC_WORD_HEADER = struct.Struct("!L")
+MESSAGE_HEADER = struct.Struct("!BL")
 
 
 class TCPLinkClientManager(object):
@@ -152,7 +298,7 @@ class TCPLinkClientManager(object):
     def on_connect(self):
         if self.stream:
             if self.creation_callback:
-                link = TCPLink(self.stream)
+                link = TCPLink(self.stream, self.config)
                 link.setup()
                 yield tornado.gen.Task(link.establish)
                 self.creation_callback(link)
@@ -180,28 +326,41 @@ class TCPLinkServerManager(object):
 
     def setup(self):
         class Server(tornado.netutil.TCPServer):
-            def __init__(self, bind_address):
+            def __init__(self, bind_address, link_config):
                 super(Server, self).__init__()
                 self.established = deque([])
                 self.bind_address = bind_address
+                self.link_config = link_config
+                self.reuse_port = link_config.get('reuse_port', False)
                 self.callback = None
 
             def bind(self):
-                super(Server, self).bind(self.bind_address[1], address=self.bind_address[0])
-                self.start(1)
+                if self.reuse_port:
+                    # every worker process listens on its own socket
+                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    tornado.netutil.set_close_exec(sock.fileno())
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                    sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+                    sock.setblocking(0)
+                    sock.bind(self.bind_address)
+                    sock.listen(128)
+                    self.add_sockets([sock])
+                else:
+                    super(Server, self).bind(self.bind_address[1], address=self.bind_address[0])
+                    self.start(1)
                 logging.debug("started tcp server on (%s:%d)" % self.bind_address)
 
             def handle_stream(self, stream, address):
                 logging.debug("new stream from " + str(address))
-                link = TCPLink(stream)
+                link = TCPLink(stream, self.link_config)
                 link.setup()
                 link.establish(functools.partial(self.on_established, link))
 
             def on_established(self, link):
                 logging.debug("%s established" % str(link))
                 if self.callback:
-                    self.callback(link)
-                    self.callback = None
+                    callback, self.callback = self.callback, None
+                    callback(link)
                 else:
                     self.established.append(link)
 
@@ -213,7 +372,7 @@ class TCPLinkServerManager(object):
                     return
                 callback(s)
 
-        self.server = Server(('0.0.0.0', self.config['port']))
+        self.server = Server(('0.0.0.0', self.config['port']), self.config)
         self.server.bind()
 
     @tornado.gen.engine
@@ -1,30 +1,47 @@
 from .abstract import Link
-from ..networking.packet import Packet
-from ..utils import validate_port, Error, read_packet
+from ..networking.packet import Packet, FrameHeaders
+from ..networking import control
+from ..utils import validate_port, Error, read_packet, SO_REUSEPORT
+from ..utils.mmsg import BatchedDatagramSocket
+from ..utils.buffers import BufferPool
+from ..utils.timer import TimerWheel
+from ..utils.trace import Tracer
+from ..utils.metrics import (PACKETS_IN, BYTES_IN, PACKETS_OUT, BYTES_OUT,
+    DROPS, KEEPALIVE_RTT)
+from collections import OrderedDict
 import struct
+import time
 import tornado.gen
 import logging
 import socket
 import tornado.netutil
 import tornado.ioloop
-from datetime import timedelta, datetime
-import json
 
 
-UDP_MAGIC_WORD = 0x1306A15
+MAGIC_WORD_HEADER = struct.Struct("!L")
 UDP_BUF_SIZE = 2048
+UDP_BATCH_SIZE = 32
+# clients waiting for the server to take a new link, as a listen backlog
+UDP_BACKLOG = 4096
 IDENTIFIER_LENGTH = 4
 RESET_PACKET = struct.pack("!B", 0x00)
 CONTROL_MESSAGE_IDENTIFIER = 0x01
 PACKET_IDENTIFIER = 0x02
 KEEP_ALIVE_IDENTIFIER = 0x03
+KEEP_ALIVE_PACKET = struct.pack("!BH", KEEP_ALIVE_IDENTIFIER, 0)
+FRAME_HEADER = struct.Struct("!BH")
+# payload of timed keep-alives, answered with an echo of the send time. peers
+# that predate them take these for plain keep-alives and do not answer
+KEEP_ALIVE_STAMP = struct.Struct("!Bd")
+KEEP_ALIVE_REQUEST = 0
+KEEP_ALIVE_ECHO = 1
+PACKET_HEADERS = FrameHeaders(PACKET_IDENTIFIER)
 KEEP_ALIVE_SECONDS = 30
-CHECK_SECONDS = 30
 CONNECTION_DEATH_SECONDS = 90
 
 
 class UDPLink(Link):
-    MAGIC_WORD = 0x1306A15
+    MAGIC_WORD = control.MAGIC_WORD
 
     @classmethod
     def get_manager_class(cls, mode):
@@ -34,15 +51,18 @@ class UDPLink(Link):
             return UDPLinkClientManager
 
     def __init__(self, manager, address):
+        super(UDPLink, self).__init__()
         self.manager = manager
         self.dest = address
+        self.offered_codec = manager.offered_codec
         self.logger = logging.getLogger(str(self))
+        self.tracer = Tracer(self.logger)
         self.logger.debug("created.")
-        self.periodic_check = tornado.ioloop.PeriodicCallback(self.check_alive,
-            CHECK_SECONDS * 1000)
-        self.periodic_send_alive = tornado.ioloop.PeriodicCallback(
-            self.send_alive, KEEP_ALIVE_SECONDS * 1000)
-        self.record_alive()
+        # seconds on the clock of the manager's timer wheel
+        self.last_recorded = self.last_sent = manager.wheel.now
+        self.timer = None
+        self.closed = False
+        self.schedule_check()
 
     def __str__(self):
         if not hasattr(self, "_name"):
@@ -53,86 +73,159 @@ class UDPLink(Link):
     def ip_endpoint(self):
         return self.dest[0]
 
+    def schedule_check(self):
+        # wake up when the link turns idle or dead, whichever comes first
+        now = self.manager.wheel.now
+        self.timer = self.manager.wheel.schedule(min(
+            self.last_sent + KEEP_ALIVE_SECONDS,
+            self.last_recorded + CONNECTION_DEATH_SECONDS) - now,
+            self.check_alive)
+
     def check_alive(self):
-        if datetime.utcnow() - self.last_recorded > timedelta(
-            seconds=CONNECTION_DEATH_SECONDS):
+        now = self.manager.wheel.now
+        if now - self.last_recorded >= CONNECTION_DEATH_SECONDS:
+            self.logger.info("no packets for %d seconds" % (now - self.last_recorded))
             self.manager.write(RESET_PACKET, self.dest)
             self.apply_close_callback()
+            return
+        # links that sent anything lately need no keep-alive
+        if now - self.last_sent >= KEEP_ALIVE_SECONDS:
+            self.send_alive()
+        if not self.closed:
+            self.schedule_check()
 
     def send_alive(self):
-        self.manager.write(struct.pack("!B", KEEP_ALIVE_IDENTIFIER), self.dest)
+        self.send_keep_alive(KEEP_ALIVE_REQUEST, time.time())
         self.logger.debug("sent keep-alive")
 
-    def setup(self):
-        self.periodic_check_alive.start()
-        self.periodic_send_alive.start()
-
-    def parse_packet(self, pkt):
-        payload = pkt.payload
+    def send_keep_alive(self, kind, stamp):
+        self.manager.write(FRAME_HEADER.pack(KEEP_ALIVE_IDENTIFIER,
+            KEEP_ALIVE_STAMP.size) + KEEP_ALIVE_STAMP.pack(kind, stamp), self.dest)
+        self.last_sent = self.manager.wheel.now
+
+    def on_keep_alive(self, kind, stamp):
+        if kind == KEEP_ALIVE_REQUEST:
+            self.send_keep_alive(KEEP_ALIVE_ECHO, stamp)
+        elif kind == KEEP_ALIVE_ECHO:
+            rtt = time.time() - stamp
+            if rtt >= 0:
+                self.metrics[KEEPALIVE_RTT] = rtt
+
+    def parse_datagram(self, payload, address=None):
+        """
+        Handles one datagram from the peer. payload may be a memoryview of
+        the pool buffer at address, which is released unless a packet read
+        from it is passed on.
+        """
         consumed = 0
 
-        if payload == RESET_PACKET:
-            self.logger.info("received RESET")
-            self.apply_close_callback()
-        else:
-            if len(payload) >= 3:
-                type_byte, = struct.unpack("!B", payload[consumed:
-                    consumed + 1])
-                consumed += 1
-                if type_byte not in [CONTROL_MESSAGE_IDENTIFIER,
-                    PACKET_IDENTIFIER, KEEP_ALIVE_IDENTIFIER]:
-                    self.manager.write(RESET_PACKET, self.dest)
-                length, = struct.unpack("!H", payload[consumed:
-                    consumed + 2])
-                consumed += 2
-
-                if len(payload) >= (consumed + length):
-                    data = payload[consumed: consumed + length]
-                    if type_byte == CONTROL_MESSAGE_IDENTIFIER:
-                        try:
-                            msg = json.loads(data)
-                        except:
-                            raise
-                            self.logger.error("cannot parse message: " + data)
-                            return
+        if len(payload) == 1:
+            if payload[0] == RESET_PACKET:
+                self.logger.info("received RESET")
+                self.apply_close_callback()
+            elif payload[0] == KEEP_ALIVE_PACKET[:1]:
+                # sent by peers that predate framed keep-alives
+                self.record_alive()
+        elif len(payload) >= 3:
+            type_byte, length = FRAME_HEADER.unpack_from(payload)
+            consumed += FRAME_HEADER.size
+            if type_byte not in [CONTROL_MESSAGE_IDENTIFIER,
+                PACKET_IDENTIFIER, KEEP_ALIVE_IDENTIFIER]:
+                self.manager.write(RESET_PACKET, self.dest)
+
+            if len(payload) >= (consumed + length):
+                data = payload[consumed: consumed + length]
+                if type_byte == CONTROL_MESSAGE_IDENTIFIER:
+                    if not isinstance(data, str):
+                        data = data.tobytes()
+                    try:
+                        msg = control.decode(data)
+                    except ValueError:
+                        self.logger.error("cannot parse message: %r" % data)
+                        data = None
+                    if data is not None:
                         self.logger.debug("received message: " + str(msg))
                         self.record_alive()
                         self.apply_message_callback(msg)
-                    elif type_byte == PACKET_IDENTIFIER:
-                        self.record_alive()
+                elif type_byte == PACKET_IDENTIFIER:
+                    self.record_alive()
+                    self.metrics[PACKETS_IN] += 1
+                    self.metrics[BYTES_IN] += length
+                    if address is None:
                         p = Packet(data, source=self)
-                        self.logger.debug("received: " + str(p))
-                        self.apply_packet_callback(p)
-                    elif type_byte == KEEP_ALIVE_IDENTIFIER:
-                        self.logger.debug("received keep-alive")
-                        self.record_alive()
+                    else:
+                        p = Packet(data, source=self, pool=self.manager.pool,
+                            address=address + consumed)
+                        address = None
+                    if self.tracer.enabled:
+                        self.tracer.trace("received: %s", p)
+                    self.apply_packet_callback(p)
+                elif type_byte == KEEP_ALIVE_IDENTIFIER:
+                    self.logger.debug("received keep-alive")
+                    self.record_alive()
+                    if length == KEEP_ALIVE_STAMP.size:
+                        self.on_keep_alive(*KEEP_ALIVE_STAMP.unpack_from(
+                            payload, consumed))
+
+        if address is not None:
+            self.manager.pool.release(address)
 
     def record_alive(self):
-        self.last_recorded = datetime.utcnow()
+        self.last_recorded = self.manager.wheel.now
 
     def establish(self, callback):
         callback()
 
     def cleanup(self):
-        self.periodic_check.stop()
-        self.periodic_send_alive.stop()
+        self.closed = True
+        if self.timer is not None:
+            self.manager.wheel.cancel(self.timer)
+            self.timer = None
+        # a new magic word from the address starts a new link
+        self.manager.remove_link(self)
         try:
             self.manager.write(RESET_PACKET, self.dest)
         except:
             pass
 
     def is_alive(self):
-        return True
+        # idle peers send keep-alives, one that missed two is likely gone
+        return not self.closed and \
+            self.manager.wheel.now - self.last_recorded < 2 * KEEP_ALIVE_SECONDS
 
     def send_packet(self, packet):
-        data = struct.pack("!B", PACKET_IDENTIFIER) + packet.serialize()
-        self.manager.write(data, self.dest)
-        self.logger.debug("sent: %s" % str(packet))
+        metrics = self.metrics
+        metrics[DROPS] += self.manager.write_many([(packet.frame(PACKET_HEADERS),
+            self.dest)])
+        metrics[PACKETS_OUT] += 1
+        metrics[BYTES_OUT] += len(packet.payload)
+        self.last_sent = self.manager.wheel.now
+        if self.tracer.enabled:
+            self.tracer.trace("sent: %s", packet)
+        packet.release()
+
+    def send_packets(self, packets):
+        datagrams = []
+        sent_bytes = 0
+        for packet in packets:
+            datagrams.append((packet.frame(PACKET_HEADERS), self.dest))
+            sent_bytes += len(packet.payload)
+        metrics = self.metrics
+        metrics[DROPS] += self.manager.write_many(datagrams)
+        metrics[PACKETS_OUT] += len(packets)
+        metrics[BYTES_OUT] += sent_bytes
+        self.last_sent = self.manager.wheel.now
+        if self.tracer.enabled:
+            for packet in packets:
+                self.tracer.trace("sent: %s", packet)
+        for packet in packets:
+            packet.release()
 
     def send_message(self, msg):
-        serialized = bytes(json.dumps(msg))
+        serialized = control.encode(msg, self.codec)
         self.manager.write(struct.pack("!BH", CONTROL_MESSAGE_IDENTIFIER,
             len(serialized)) + serialized, self.dest)
+        self.last_sent = self.manager.wheel.now
         self.logger.debug("sent message: " + str(msg))
 
 
@@ -140,6 +233,10 @@ class UDPLinkClientManager(object):
     def __init__(self, config):
         self.config = config
         self.io_loop = tornado.ioloop.IOLoop.instance()
+        self.offered_codec = control.get_codec(self.config.get("control_codec",
+            control.DEFAULT_CODEC))
+        self.wheel = TimerWheel(io_loop=self.io_loop)
+        self.pool = BufferPool.shared()
         self.logger = logging.getLogger(str(self))
         self.logger.debug("created.")
 
@@ -147,17 +244,25 @@ class UDPLinkClientManager(object):
         return "udp<%s:%d>" % (self.config['host'], self.config['port'])
 
     def setup(self):
+        # no SO_REUSEADDR: the socket is bound implicitly, and with it the
+        # kernel may give clients on one host the same ephemeral port
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.setblocking(0)
+        self.datagrams = BatchedDatagramSocket(self.socket,
+            self.config.get('batch_size', UDP_BATCH_SIZE), UDP_BUF_SIZE,
+            self.pool)
+        self.wheel.start()
 
     def cleanup(self):
-        self.io_loop.remove_handler(self.socket)
+        self.wheel.stop()
+        self.io_loop.remove_handler(self.socket.fileno())
+        self.datagrams.close()
 
     @tornado.gen.engine
     def create(self, callback):
         addr = (self.config['host'], self.config['port'])
 
-        self.socket.sendto(struct.pack("!L", UDP_MAGIC_WORD), addr)
+        self.socket.sendto(MAGIC_WORD_HEADER.pack(control.MAGIC_WORD), addr)
 
         self.logger.info("sent initialial message.")
         data, peer = yield tornado.gen.Task(read_packet, self.socket)
@@ -165,12 +270,12 @@ class UDPLinkClientManager(object):
             callback(None)
             return
 
-        if len(data) == struct.calcsize("!L"):
-            word, = struct.unpack("!L", data)
-            if word == UDP_MAGIC_WORD:
+        if len(data) == MAGIC_WORD_HEADER.size:
+            word, = MAGIC_WORD_HEADER.unpack(data)
+            if control.is_magic_word(word):
                 self.logger.info("received correct magic word.")
                 self.link = UDPLink(self, peer)
-                self.io_loop.add_handler(self.socket, self.on_socket_read,
+                self.io_loop.add_handler(self.socket.fileno(), self.on_socket_read,
                     self.io_loop.READ)
                 callback(self.link)
             else:
@@ -183,14 +288,22 @@ class UDPLinkClientManager(object):
             callback(None)
 
     def on_socket_read(self, fd, events):
-        data, addr = self.socket.recvfrom(UDP_BUF_SIZE)
-        self.link.parse_packet(Packet(data, source=self, routing={
-            'src': addr
-            }))
+        while True:
+            datagrams = self.datagrams.recv()
+            for data, addr, address in datagrams:
+                self.link.parse_datagram(data, address)
+            if len(datagrams) < self.datagrams.batch_size:
+                return
 
     def write(self, data, addr):
         self.socket.sendto(data, addr)
 
+    def write_many(self, datagrams):
+        return self.datagrams.send(datagrams)
+
+    def remove_link(self, link):
+        pass
+
 
 class UDPLinkServerManager(object):
     def __init__(self, config):
@@ -198,6 +311,14 @@ class UDPLinkServerManager(object):
         self.creation_callback = None
         self.io_loop = tornado.ioloop.IOLoop.instance()
         self.addr_links = {}
+        # addresses whose magic word waits for create, oldest first
+        self.backlog = OrderedDict()
+        self.max_backlog = self.config.get('backlog', UDP_BACKLOG)
+        self.offered_codec = control.get_codec(self.config.get("control_codec",
+            control.DEFAULT_CODEC))
+        # keep-alives and liveness checks of all links
+        self.wheel = TimerWheel(io_loop=self.io_loop)
+        self.pool = BufferPool.shared()
         self.logger = logging.getLogger(str(self))
         self.logger.debug("created.")
 
@@ -207,40 +328,76 @@ class UDPLinkServerManager(object):
     def setup(self):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.config.get('reuse_port'):
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
         self.socket.bind(('0.0.0.0', self.config['port']))
+        self.socket.setblocking(0)
+        self.datagrams = BatchedDatagramSocket(self.socket,
+            self.config.get('batch_size', UDP_BATCH_SIZE), UDP_BUF_SIZE,
+            self.pool)
         self.logger.info("listening for UDP packets on port %d" %
             self.config['port'])
         self.io_loop.add_handler(self.socket.fileno(), self.on_socket_read,
             self.io_loop.READ)
+        self.wheel.start()
 
     def on_socket_read(self, fd, events):
-        data, addr = self.socket.recvfrom(UDP_BUF_SIZE)
-
+        while True:
+            datagrams = self.datagrams.recv()
+            for data, addr, address in datagrams:
+                self.on_datagram(data, addr, address)
+            if len(datagrams) < self.datagrams.batch_size:
+                return
+
+    def on_datagram(self, data, addr, address=None):
         link = self.addr_links.get(addr, None)
         if link is None:
-            magic_word, = struct.unpack("!L", data)
-            if magic_word != UDP_MAGIC_WORD:
+            if address is not None:
+                data = data.tobytes()
+                self.pool.release(address)
+            if data == RESET_PACKET:
+                return
+            if len(data) != MAGIC_WORD_HEADER.size or not control.is_magic_word(
+                    MAGIC_WORD_HEADER.unpack(data)[0]):
                 self.logger.debug("magic word does not match.")
                 self.socket.sendto(RESET_PACKET, addr)
+            elif self.creation_callback is not None:
+                self.accept(addr)
+            elif addr in self.backlog:
+                pass
+            elif len(self.backlog) < self.max_backlog:
+                # answered once a link is asked for, the client keeps waiting
+                self.backlog[addr] = True
             else:
-                if data == RESET_PACKET:
-                    return
-                link = UDPLink(self, addr)
-                self.addr_links[addr] = link
-                self.socket.sendto(struct.pack("!L", UDP_MAGIC_WORD), addr)
-                self.logger.info("new client from " + str(addr))
-                self.creation_callback(link)
+                self.logger.debug("backlog full, rejecting " + str(addr))
+                self.socket.sendto(RESET_PACKET, addr)
         else:
-            pkt = Packet(data, source=self, routing={
-                'src': addr
-                })
-            link.parse_packet(pkt)
+            link.parse_datagram(data, address)
+
+    def remove_link(self, link):
+        if self.addr_links.get(link.dest, None) is link:
+            del self.addr_links[link.dest]
 
     def write(self, data, addr):
         self.socket.sendto(data, addr)
 
+    def write_many(self, datagrams):
+        return self.datagrams.send(datagrams)
+
+    def accept(self, addr):
+        link = UDPLink(self, addr)
+        self.addr_links[addr] = link
+        self.socket.sendto(MAGIC_WORD_HEADER.pack(control.MAGIC_WORD), addr)
+        self.logger.info("new client from " + str(addr))
+        callback, self.creation_callback = self.creation_callback, None
+        callback(link)
+
     def create(self, callback):
         self.creation_callback = callback
+        if self.backlog:
+            self.accept(self.backlog.popitem(last=False)[0])
 
     def cleanup(self):
+        self.wheel.stop()
         self.io_loop.remove_handler(self.socket.fileno())
+        self.datagrams.close()
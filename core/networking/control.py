@@ -0,0 +1,195 @@
+"""
+Control message codecs.
+
+Control messages are dicts with a "type" key. Links start out with JSON,
+which every peer speaks, and agree on a codec during the address handshake:
+ip_request carries the highest codec the client speaks, ip_reply the one
+the server picked, the lower of its own and the client's. Peers that
+predate the codecs send neither, and stay with JSON.
+
+The TLV codec covers the address handshake (ip_request, ip_reply and
+ip_confirm). Any message it cannot express is sent as JSON instead; the
+receiver tells both apart by the first byte, which is never "{" for TLV.
+
+    TLV message: version (1 byte), message type (1 byte), fields...
+    field: tag (1 byte), length (1 byte), value
+"""
+import json
+import socket
+import struct
+from ..utils import Error
+
+
+MAGIC_WORD = 0x1306A15
+# the top four bits are reserved, peers may set them
+MAGIC_WORD_MASK = 0x0FFFFFFF
+
+CODEC_JSON = 0
+CODEC_TLV = 1
+CODECS = {
+    "json": CODEC_JSON,
+    "tlv": CODEC_TLV,
+}
+DEFAULT_CODEC = "tlv"
+
+TLV_VERSION = 1
+TLV_HEADER = struct.Struct("!BB")
+FIELD_HEADER = struct.Struct("!BB")
+
+
+def get_codec(name):
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise Error("unknown control codec: %s (available: %s)" % (name,
+            ", ".join(sorted(CODECS))))
+
+
+def is_magic_word(word):
+    return word & MAGIC_WORD_MASK == MAGIC_WORD
+
+
+def pack_ipv4(value):
+    return socket.inet_aton(value)
+
+
+def unpack_ipv4(data):
+    if len(data) != 4:
+        raise ValueError("IPv4 address must be 4 bytes")
+    return socket.inet_ntoa(data)
+
+
+def pack_ipv4_network(value):
+    address, prefix = value.split("/")
+    prefix = int(prefix)
+    if not 0 <= prefix <= 32:
+        raise ValueError("invalid prefix length: %d" % prefix)
+    return socket.inet_aton(address) + chr(prefix)
+
+
+def unpack_ipv4_network(data):
+    if len(data) != 5:
+        raise ValueError("IPv4 network must be 5 bytes")
+    return "%s/%d" % (socket.inet_ntoa(data[:4]), ord(data[4]))
+
+
+def pack_uint8(value):
+    if not isinstance(value, (int, long)) or not 0 <= value <= 0xFF:
+        raise ValueError("invalid byte field")
+    return chr(value)
+
+
+def unpack_uint8(data):
+    if len(data) != 1:
+        raise ValueError("byte field must be 1 byte")
+    return ord(data)
+
+
+def pack_string(value):
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    if not isinstance(value, str) or len(value) > 0xFF:
+        raise ValueError("invalid string field")
+    return value
+
+
+def unpack_string(data):
+    return data.decode("utf-8")
+
+
+MESSAGE_TYPES = {
+    "ip_request": 1,
+    "ip_reply": 2,
+    "ip_confirm": 3,
+}
+MESSAGE_NAMES = dict((v, k) for k, v in MESSAGE_TYPES.iteritems())
+
+# name: (tag, pack, unpack)
+FIELDS = {
+    "server_ip": (1, pack_ipv4, unpack_ipv4),
+    "client_ip": (2, pack_ipv4, unpack_ipv4),
+    "network": (3, pack_ipv4_network, unpack_ipv4_network),
+    "client_id": (4, pack_string, unpack_string),
+    "codec": (5, pack_uint8, unpack_uint8),
+}
+FIELD_TAGS = dict((tag, (name, unpack)) for name, (tag, pack, unpack) in
+    FIELDS.iteritems())
+# messages without fields, encoded once
+BARE_MESSAGES = dict((name, TLV_HEADER.pack(TLV_VERSION, type_id))
+    for name, type_id in MESSAGE_TYPES.iteritems())
+
+
+def encode_tlv(msg):
+    """
+    Returns the TLV encoding of msg, None if the codec cannot express it.
+    """
+    type_id = MESSAGE_TYPES.get(msg.get("type", None), None)
+    if type_id is None:
+        return None
+    if len(msg) == 1:
+        return BARE_MESSAGES[msg["type"]]
+    parts = [TLV_HEADER.pack(TLV_VERSION, type_id)]
+    for name, value in msg.iteritems():
+        if name == "type":
+            continue
+        field = FIELDS.get(name, None)
+        if field is None:
+            return None
+        tag, pack, unpack = field
+        try:
+            packed = pack(value)
+        except (socket.error, ValueError, TypeError, AttributeError):
+            return None
+        parts.append(FIELD_HEADER.pack(tag, len(packed)))
+        parts.append(packed)
+    return "".join(parts)
+
+
+def decode_tlv(data):
+    if len(data) < TLV_HEADER.size:
+        raise ValueError("truncated control message")
+    version, type_id = TLV_HEADER.unpack_from(data)
+    if version != TLV_VERSION:
+        raise ValueError("unsupported control codec version: %d" % version)
+    msg = {"type": MESSAGE_NAMES.get(type_id, None)}
+    if msg["type"] is None:
+        raise ValueError("unknown control message type: %d" % type_id)
+
+    offset = TLV_HEADER.size
+    end = len(data)
+    while offset < end:
+        if end - offset < FIELD_HEADER.size:
+            raise ValueError("truncated control message field")
+        tag, length = FIELD_HEADER.unpack_from(data, offset)
+        offset += FIELD_HEADER.size
+        if end - offset < length:
+            raise ValueError("truncated control message field")
+        value = data[offset: offset + length]
+        offset += length
+        field = FIELD_TAGS.get(tag, None)
+        # fields of a later version are skipped
+        if field is not None:
+            name, unpack = field
+            msg[name] = unpack(value)
+    return msg
+
+
+def encode(msg, codec):
+    if codec >= CODEC_TLV:
+        data = encode_tlv(msg)
+        if data is not None:
+            return data
+    return bytes(json.dumps(msg))
+
+
+def decode(data):
+    """
+    Decodes a control message of either codec. Raises ValueError if it is
+    malformed.
+    """
+    if data[:1] == "{":
+        msg = json.loads(data)
+        if not isinstance(msg, dict):
+            raise ValueError("control message is not an object")
+        return msg
+    return decode_tlv(data)
@@ -0,0 +1,292 @@
+import base64
+import struct
+from collections import OrderedDict
+
+
+HEADER = struct.Struct("!HHHHHH")
+HEADER_ID = struct.Struct("!H")
+QUESTION = struct.Struct("!HH")
+RECORD = struct.Struct("!HHLH")
+TTL = struct.Struct("!L")
+DNS_QR = 0x8000
+DNS_OPCODE = 0x7800
+DNS_TC = 0x0200
+DNS_RCODE = 0x000F
+RCODE_NOERROR = 0
+RCODE_NXDOMAIN = 3
+TYPE_SOA = 6
+TYPE_OPT = 41
+MAX_POINTERS = 16
+
+CACHE_BYTES = 1 << 20
+MAX_TTL = 86400
+MAX_NEGATIVE_TTL = 900
+# encoded DNS messages per resolve_request or resolve_response control
+# message, so that one fits a datagram of the UDP link
+MAX_BATCH_BYTES = 1920
+# JSON around an encoded message in a batch: id, quotes, brackets, commas
+BATCH_ENTRY_BYTES = 20
+# largest DNS message that fits a batch of its own
+MAX_TUNNELED_BYTES = (MAX_BATCH_BYTES - BATCH_ENTRY_BYTES) * 3 // 4
+# rough cost of an entry beyond the answer itself: key, tuple, dict slot
+ENTRY_OVERHEAD = 160
+
+
+def read_name(data, offset):
+    """
+    Returns the lowercased dotted name at offset and the offset past it,
+    following compression pointers.
+    """
+    labels = []
+    end = None
+    pointers = 0
+    while True:
+        if offset >= len(data):
+            raise ValueError("truncated name")
+        length = ord(data[offset])
+        if length & 0xC0 == 0xC0:
+            if offset + 2 > len(data) or pointers == MAX_POINTERS:
+                raise ValueError("bad compression pointer")
+            if end is None:
+                end = offset + 2
+            pointers += 1
+            offset = ((length & 0x3F) << 8) | ord(data[offset + 1])
+        elif length & 0xC0:
+            raise ValueError("bad label")
+        elif length == 0:
+            if end is None:
+                end = offset + 1
+            return ".".join(labels).lower(), end
+        else:
+            labels.append(data[offset + 1: offset + 1 + length])
+            offset += 1 + length
+
+
+def skip_name(data, offset):
+    while True:
+        if offset >= len(data):
+            raise ValueError("truncated name")
+        length = ord(data[offset])
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+        if length == 0:
+            return offset + 1
+        offset += 1 + length
+
+
+def parse_question(data):
+    """
+    Returns the (qname, qtype, qclass) of a single-question standard query
+    or response, and the offset where the question ends. Raises ValueError
+    for anything else.
+    """
+    if len(data) < HEADER.size:
+        raise ValueError("truncated header")
+    _, flags, qdcount, _, _, _ = HEADER.unpack_from(data)
+    if flags & DNS_OPCODE or qdcount != 1:
+        raise ValueError("not a standard query")
+    qname, offset = read_name(data, HEADER.size)
+    if offset + QUESTION.size > len(data):
+        raise ValueError("truncated question")
+    qtype, qclass = QUESTION.unpack_from(data, offset)
+    return (qname, qtype, qclass), offset + QUESTION.size
+
+
+def parse_answer(data):
+    """
+    Returns the question key of a response, the offset where the question
+    ends, the number of seconds it may be cached and the (offset, ttl) of
+    every record in it, or a ttl of None if it must not be cached. Negative
+    answers are cached for as long as the SOA of their authority section
+    says (RFC 2308), and not at all without one.
+    """
+    key, question_end = parse_question(data)
+    offset = question_end
+    _, flags, _, ancount, nscount, arcount = HEADER.unpack_from(data)
+    rcode = flags & DNS_RCODE
+    if not flags & DNS_QR or flags & DNS_TC or \
+            rcode not in (RCODE_NOERROR, RCODE_NXDOMAIN):
+        return key, question_end, None, ()
+
+    ttls = []
+    answer_ttl = None
+    negative_ttl = None
+    for i in xrange(ancount + nscount + arcount):
+        offset = skip_name(data, offset)
+        if offset + RECORD.size > len(data):
+            raise ValueError("truncated record")
+        rtype, _, ttl, length = RECORD.unpack_from(data, offset)
+        if rtype != TYPE_OPT:
+            # the TTL of OPT holds the extended rcode and flags
+            ttls.append((offset + 4, ttl))
+            if i < ancount:
+                answer_ttl = ttl if answer_ttl is None else min(answer_ttl, ttl)
+            elif i < ancount + nscount and rtype == TYPE_SOA:
+                # the last field of SOA data is the negative caching TTL
+                end = offset + RECORD.size + length
+                if end > len(data):
+                    raise ValueError("truncated record")
+                minimum, = TTL.unpack_from(data, end - TTL.size)
+                negative_ttl = min(ttl, minimum)
+        offset += RECORD.size + length
+        if offset > len(data):
+            raise ValueError("truncated record")
+
+    if rcode == RCODE_NOERROR and ancount:
+        return key, question_end, answer_ttl, ttls
+    return key, question_end, negative_ttl, ttls
+
+
+def reply_to(query, response):
+    """
+    Returns response with the transaction id of query, and with its question
+    spelled the way query asked it.
+    """
+    _, question_end = parse_question(query)
+    if response[HEADER.size: question_end].lower() == \
+            query[HEADER.size: question_end].lower():
+        return query[:2] + response[2: HEADER.size] + \
+            query[HEADER.size: question_end] + response[question_end:]
+    return query[:2] + response[2:]
+
+
+def truncate(response):
+    """
+    Returns the header and question of response with the TC flag set, which
+    makes the client ask again over TCP.
+    """
+    _, question_end = parse_question(response)
+    message_id, flags, _, _, _, _ = HEADER.unpack_from(response)
+    return HEADER.pack(message_id, flags | DNS_TC, 1, 0, 0, 0) + \
+        response[HEADER.size: question_end]
+
+
+def encode_batches(messages):
+    """
+    Splits (id, DNS message or None) pairs into the lists carried by
+    resolve_request and resolve_response control messages. Control
+    messages are JSON for these, the DNS messages are base64 encoded.
+    """
+    batch = []
+    size = 0
+    for message_id, data in messages:
+        if data is not None:
+            data = base64.b64encode(data)
+        entry_size = BATCH_ENTRY_BYTES + (len(data) if data is not None else 4)
+        if batch and size + entry_size > MAX_BATCH_BYTES:
+            yield batch
+            batch = []
+            size = 0
+        size += entry_size
+        batch.append([message_id, data])
+    if batch:
+        yield batch
+
+
+def decode_batch(batch):
+    """
+    Returns the (id, DNS message or None) pairs of a batch. Raises
+    ValueError if it is malformed.
+    """
+    try:
+        return [(int(message_id), base64.b64decode(data)
+            if data is not None else None) for message_id, data in batch]
+    except (TypeError, ValueError):
+        raise ValueError("malformed DNS batch")
+
+
+class AnswerCache(object):
+    """
+    Responses by question, for as long as their records live, up to about
+    max_bytes of them, least recently used ones going first.
+
+    Responses are given out with the transaction id and question of the
+    query and with their TTLs counted down.
+    """
+    def __init__(self, max_bytes=CACHE_BYTES, max_ttl=MAX_TTL,
+            max_negative_ttl=MAX_NEGATIVE_TTL):
+        self.max_bytes = max_bytes
+        self.max_ttl = max_ttl
+        self.max_negative_ttl = max_negative_ttl
+        # key: (response, question_end, ttls, stored, expires, negative, size)
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
+
+    def get(self, query, now):
+        """
+        Returns the cached response to query, None if there is none.
+        """
+        key, question_end = parse_question(query)
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        response, response_question_end, ttls, stored, expires, negative, \
+            size = entry
+        if now >= expires:
+            self.size -= size
+            self.expired += 1
+            self.misses += 1
+            return None
+        self.entries[key] = entry
+
+        if negative:
+            self.negative_hits += 1
+        else:
+            self.hits += 1
+        buf = bytearray(response)
+        buf[0:2] = query[0:2]
+        question = query[HEADER.size: question_end]
+        if question_end == response_question_end and \
+                response[HEADER.size: question_end] != question:
+            # same name in other letter case, answer the way it was asked
+            buf[HEADER.size: question_end] = question
+        elapsed = int(now - stored)
+        for offset, ttl in ttls:
+            TTL.pack_into(buf, offset, max(ttl - elapsed, 0))
+        return str(buf)
+
+    def put(self, response, now):
+        """
+        Stores response if it may be cached, returns whether it was.
+        """
+        key, question_end, ttl, ttls = parse_answer(response)
+        if not ttl:
+            return False
+        _, flags, _, ancount, _, _ = HEADER.unpack_from(response)
+        negative = flags & DNS_RCODE == RCODE_NXDOMAIN or not ancount
+        ttl = min(ttl, self.max_negative_ttl if negative else self.max_ttl)
+        size = len(response) + len(key[0]) + ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return False
+
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= old[-1]
+        self.entries[key] = (response, question_end, ttls, now, now + ttl,
+            negative, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, entry = self.entries.popitem(last=False)
+            self.size -= entry[-1]
+            self.evicted += 1
+        return True
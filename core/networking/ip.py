@@ -1,26 +1,297 @@
 from . import ipaddr
+from .leases import LeaseFile, owner_key, ALLOCATED, ACTIVE, SERVER_END
+from ..utils import Error
+from collections import deque, OrderedDict
+import logging
+import time
+
+
+LEASE_SECONDS = 600
 
 
 class IPAddressSpaceManager(object):
-    def __init__(self, definition):
+    """
+    Hands out the host addresses of a network. Addresses are tracked as
+    integer slots: one bit per host marks it allocated, slots are taken in
+    order the first time and released ones are reused oldest first, so
+    neither startup nor allocation depends on the size of the network.
+    """
+    def __init__(self, definition, shard=0, shards=1):
         self.definition = definition
         self.network = ipaddr.ip_network(self.definition)
-        self.hosts = list(self.network.iterhosts())
+        self.version = self.network.version
+        self.first_host = int(self.network.network_address) + 1
+        host_count = max(0, int(self.network.broadcast_address) -
+            int(self.network.network_address) - 1)
+        # sharded server workers allocate from disjoint slices of the network:
+        # slot n is host shard + n * shards
+        self.shard = shard
+        self.shards = shards
+        self.slots = max(0, (host_count - shard + shards - 1) // shards)
+        self.bitmap = bytearray((self.slots + 7) // 8)
+        self.next_slot = 0
+        self.released = deque()
+        self.allocated = 0
         self.addons = []
 
     @classmethod
-    def shared(cls, definition):
+    def shared(cls, definition, shard=0, shards=1):
         attr_name = "_shared_instance"
-        if not cls.hasattr(attr_name):
-            instance = IPAddressSpaceManager(definition)
+        if not hasattr(cls, attr_name):
+            instance = IPAddressSpaceManager(definition, shard, shards)
             setattr(cls, attr_name, instance)
         return getattr(cls, attr_name)
 
-    def allocate(self):
+    def available(self):
+        return self.slots - self.allocated
+
+    def address_of(self, slot):
+        return ipaddr.ip_address(self.first_host + self.shard +
+            slot * self.shards, version=self.version).exploded
+
+    def slot_of(self, host):
         try:
-            return self.hosts.pop(0).exploded
-        except IndexError:
+            index = int(ipaddr.ip_address(host)) - self.first_host - self.shard
+        except ValueError:
+            raise Error("%s is not an IP address" % host)
+        slot, remainder = divmod(index, self.shards)
+        if index < 0 or remainder or slot >= self.slots:
+            raise Error("%s is not in the address pool of %s" % (host,
+                self.definition))
+        return slot
+
+    def reserve(self, slot):
+        """
+        Marks a slot allocated without handing it out, for restored leases.
+        """
+        mask = 1 << (slot & 7)
+        if self.bitmap[slot >> 3] & mask:
+            raise Error("%s reserved twice" % self.address_of(slot))
+        self.bitmap[slot >> 3] |= mask
+        self.allocated += 1
+
+    def allocate(self):
+        # reserved slots are skipped once, on the way of the cursor
+        while self.next_slot < self.slots and \
+            self.bitmap[self.next_slot >> 3] & (1 << (self.next_slot & 7)):
+            self.next_slot += 1
+        if self.next_slot < self.slots:
+            slot = self.next_slot
+            self.next_slot += 1
+        elif self.released:
+            slot = self.released.popleft()
+        else:
             return None
+        self.bitmap[slot >> 3] |= 1 << (slot & 7)
+        self.allocated += 1
+        return self.address_of(slot)
 
     def release(self, host):
-        self.hosts.append(host)
+        slot = self.slot_of(host)
+        mask = 1 << (slot & 7)
+        if not self.bitmap[slot >> 3] & mask:
+            raise Error("%s released but not allocated" % host)
+        self.bitmap[slot >> 3] &= ~mask & 0xFF
+        self.allocated -= 1
+        # slots the cursor has yet to pass (reserved ones) are found by it
+        if slot < self.next_slot:
+            self.released.append(slot)
+
+
+class Lease(object):
+    def __init__(self, client_id, server_ip, client_ip, endpoint=None):
+        self.client_id = client_id
+        self.server_ip = server_ip
+        self.client_ip = client_ip
+        # address the client connected from
+        self.endpoint = endpoint
+        self.active = True
+        self.expires = None
+        # set by the session holding the lease: whether its link is up, and
+        # what to do when a new session of the same client takes it over
+        self.is_alive = None
+        self.on_taken_over = None
+
+    def is_stale(self, endpoint):
+        """
+        Returns whether a new session from endpoint may take the lease over:
+        the client reconnects from where it was, or its session is dead.
+        """
+        if endpoint is not None and endpoint == self.endpoint:
+            return True
+        return self.is_alive is not None and not self.is_alive()
+
+
+class IPLeaseManager(object):
+    """
+    Process-wide lease table over an address pool. Every session leases a
+    server and a client address under the identity its client sent. When
+    the session ends the lease is kept for lease_seconds, and a client
+    reconnecting under the same identity within that time gets the same
+    addresses back. Expired leases are reclaimed lazily, and early when
+    the pool runs dry.
+
+    A client that reconnects from the same address before its old session
+    has noticed it is gone takes the lease over from that session, which
+    is told to close; so does any session of the identity once the old
+    one's link is down. Other sessions under an identity in use get
+    addresses of their own, clients sharing a configuration do not evict
+    each other.
+
+    With a lease file, leases of known identities survive restarts.
+    """
+    def __init__(self, definition, shard=0, shards=1, lease_seconds=LEASE_SECONDS,
+        lease_file=None):
+        self.pool = IPAddressSpaceManager(definition, shard, shards)
+        self.lease_seconds = lease_seconds
+        self.leases = {}
+        # released leases, oldest first
+        self.idle = OrderedDict()
+        self.logger = logging.getLogger("leases<%s>" % definition)
+        self.file = None
+        if lease_file:
+            if shards > 1:
+                lease_file = "%s.%d" % (lease_file, shard)
+            self.file = LeaseFile(lease_file, definition, shard, shards,
+                self.pool.slots)
+            self.restore()
+
+    @classmethod
+    def shared(cls, definition, shard=0, shards=1, lease_seconds=LEASE_SECONDS,
+        lease_file=None):
+        attr_name = "_shared_instance"
+        if not hasattr(cls, attr_name):
+            instance = IPLeaseManager(definition, shard, shards, lease_seconds,
+                lease_file)
+            setattr(cls, attr_name, instance)
+        return getattr(cls, attr_name)
+
+    def restore(self):
+        """
+        Reloads the leases of the lease file. Leases that were active belong
+        to sessions that are gone and start their idle time now.
+        """
+        now = time.time()
+        ends = {}
+        for slot, flags, owner, expires in self.file.load():
+            if not flags & ALLOCATED or not owner:
+                self.file.clear(slot)
+                continue
+            ends.setdefault(owner, [None, None, 0])
+            ends[owner][0 if flags & SERVER_END else 1] = slot
+            ends[owner][2] = now + self.lease_seconds if flags & ACTIVE else expires
+
+        for owner, (server_slot, client_slot, expires) in sorted(
+            ends.iteritems(), key=lambda item: item[1][2]):
+            if server_slot is None or client_slot is None:
+                for slot in (server_slot, client_slot):
+                    if slot is not None:
+                        self.file.clear(slot)
+                continue
+            self.pool.reserve(server_slot)
+            self.pool.reserve(client_slot)
+            lease = Lease(owner, self.pool.address_of(server_slot),
+                self.pool.address_of(client_slot))
+            lease.active = False
+            lease.expires = expires
+            self.leases[owner] = lease
+            self.idle[owner] = lease
+            self.store(lease)
+        self.logger.info("restored %d leases." % len(self.leases))
+
+    def store(self, lease):
+        if self.file is None or lease.client_id is None:
+            return
+        flags = ALLOCATED | (ACTIVE if lease.active else 0)
+        expires = lease.expires or 0
+        self.file.store(self.pool.slot_of(lease.server_ip), flags | SERVER_END,
+            lease.client_id, expires)
+        self.file.store(self.pool.slot_of(lease.client_ip), flags,
+            lease.client_id, expires)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def acquire(self, client_id=None, endpoint=None):
+        """
+        Returns a Lease for a client connecting from endpoint, None if the
+        pool is exhausted.
+        """
+        self.expire(time.time())
+        client_id = owner_key(client_id) if client_id else None
+        lease = self.leases.get(client_id, None) if client_id else None
+        if lease is not None:
+            if not lease.active:
+                del self.idle[client_id]
+                lease.active = True
+                lease.expires = None
+                lease.endpoint = endpoint
+                self.store(lease)
+                self.logger.debug("renewed lease of %s" % client_id)
+                return lease
+            if lease.is_stale(endpoint):
+                return self.take_over(lease, endpoint)
+            # the identity is in use by another live session, do not share
+            # its addresses
+            client_id = None
+
+        addresses = self.allocate_pair()
+        if addresses is None:
+            return None
+        lease = Lease(client_id, addresses[0], addresses[1], endpoint)
+        if client_id:
+            self.leases[client_id] = lease
+            self.store(lease)
+        return lease
+
+    def take_over(self, old, endpoint):
+        lease = Lease(old.client_id, old.server_ip, old.client_ip, endpoint)
+        self.leases[lease.client_id] = lease
+        self.logger.info("lease of %s taken over by a new session" %
+            lease.client_id)
+        # the old session releases old when it closes, which is ignored
+        callback, old.on_taken_over = old.on_taken_over, None
+        if callback:
+            callback()
+        return lease
+
+    def allocate_pair(self):
+        if self.pool.available() < 2:
+            # reclaim idle leases before their time rather than turn away
+            # clients
+            while self.idle and self.pool.available() < 2:
+                self.drop(self.idle.popitem(last=False)[1])
+            if self.pool.available() < 2:
+                return None
+        return self.pool.allocate(), self.pool.allocate()
+
+    def release(self, lease):
+        if lease.client_id is None:
+            self.drop(lease)
+            return
+        if self.leases.get(lease.client_id, None) is not lease:
+            # taken over by another session
+            return
+        lease.active = False
+        lease.expires = time.time() + self.lease_seconds
+        self.idle[lease.client_id] = lease
+        self.store(lease)
+
+    def expire(self, now):
+        while self.idle:
+            client_id, lease = next(self.idle.iteritems())
+            if lease.expires > now:
+                break
+            del self.idle[client_id]
+            self.drop(lease)
+
+    def drop(self, lease):
+        if lease.client_id is not None:
+            self.leases.pop(lease.client_id, None)
+            if self.file is not None:
+                self.file.clear(self.pool.slot_of(lease.server_ip))
+                self.file.clear(self.pool.slot_of(lease.client_ip))
+        self.pool.release(lease.server_ip)
+        self.pool.release(lease.client_ip)
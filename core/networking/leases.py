@@ -0,0 +1,100 @@
+"""
+Memory-mapped lease file of an address pool.
+
+The file holds a fixed-size record per pool slot and is updated in place,
+so a restarted server finds every lease where it left it:
+
+    header
+    flags: one byte per slot
+    records: owner id and expiry per slot
+
+Startup only scans the flags, a byte per address, and unpacks the records
+of allocated slots.
+"""
+import hashlib
+import logging
+import mmap
+import os
+import re
+import struct
+
+
+FILE_MAGIC = "SVPNLEAS"
+FILE_VERSION = 1
+HEADER = struct.Struct("!8sHHHL64s")
+HEADER_SIZE = 128
+OWNER_SIZE = 64
+RECORD = struct.Struct("!%dsd" % OWNER_SIZE)
+
+ALLOCATED = 0x01
+ACTIVE = 0x02
+SERVER_END = 0x04
+
+NONZERO = re.compile("[^\x00]")
+
+
+def owner_key(client_id):
+    """
+    Normalizes a client identity to the byte string stored in the file.
+    Identities too long for a record are replaced by their digest.
+    """
+    if isinstance(client_id, unicode):
+        client_id = client_id.encode("utf-8")
+    if len(client_id) > OWNER_SIZE:
+        client_id = "sha1:" + hashlib.sha1(client_id).hexdigest()
+    return client_id
+
+
+class LeaseFile(object):
+    def __init__(self, path, definition, shard, shards, slots):
+        self.path = path
+        self.slots = slots
+        self.logger = logging.getLogger("leasefile<%s>" % path)
+        self.header = HEADER.pack(FILE_MAGIC, FILE_VERSION, shard, shards, slots,
+            str(definition))
+        self.records_offset = HEADER_SIZE + slots
+        size = self.records_offset + slots * RECORD.size
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            if os.fstat(fd).st_size == size and \
+                os.read(fd, HEADER.size) == self.header:
+                self.fresh = False
+            else:
+                if os.fstat(fd).st_size:
+                    self.logger.warning("lease file does not match the pool, "
+                        "starting over.")
+                # the file is sparse, unused records take no disk space
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.write(fd, self.header)
+                self.fresh = True
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+    def load(self):
+        """
+        Yields (slot, flags, owner, expires) of every allocated slot.
+        """
+        if self.fresh:
+            return
+        flags = self.map[HEADER_SIZE: self.records_offset]
+        for match in NONZERO.finditer(flags):
+            slot = match.start()
+            owner, expires = RECORD.unpack_from(self.map, self.records_offset +
+                slot * RECORD.size)
+            yield slot, ord(flags[slot]), owner.rstrip("\x00"), expires
+
+    def store(self, slot, flags, owner, expires):
+        RECORD.pack_into(self.map, self.records_offset + slot * RECORD.size,
+            owner, expires)
+        self.map[HEADER_SIZE + slot] = chr(flags)
+
+    def clear(self, slot):
+        self.map[HEADER_SIZE + slot] = "\x00"
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
@@ -1,17 +1,175 @@
 import struct
 
 
+FRAME_HEADER = struct.Struct("!BH")
+FRAME_HEADER_CACHE_SIZE = 2048
+IP_PROTOCOLS_WITH_PORTS = (6, 17)
+
+
+IPV4_HEADER = struct.Struct("!BxxxxxHxBxx4s4s")
+PORTS = struct.Struct("!HH")
+NOT_IPV4 = (0, 0, None, 0, None, None, None)
+UNPARSED = object()
+
+
+def parse_header(payload):
+    """
+    Returns (version, header_length, protocol, fragment, src, dst, ports) of
+    an IPv4 payload: fragment is the flags and offset field, src and dst the
+    packed addresses, ports the (source, destination) of TCP and UDP, None
+    for other protocols and later fragments. Anything that is not IPv4 gets
+    its version, if any, and Nones.
+    """
+    if len(payload) < 20:
+        return NOT_IPV4
+    first, fragment, protocol, src, dst = IPV4_HEADER.unpack_from(payload)
+    if first >> 4 != 4:
+        return (first >> 4,) + NOT_IPV4[1:]
+    header_length = (first & 0x0F) * 4
+    ports = None
+    if protocol in IP_PROTOCOLS_WITH_PORTS and not fragment & 0x1FFF and \
+            len(payload) >= header_length + 4:
+        ports = PORTS.unpack_from(payload, header_length)
+    return (4, header_length, protocol, fragment, src, dst, ports)
+
+
+def adjust_checksum(checksum, old, new):
+    """
+    Updates an internet checksum for a field of even length changing from
+    old to new (RFC 1624, eqn. 3) without summing the whole packet again.
+    """
+    total = ~checksum & 0xFFFF
+    for i in xrange(0, len(old), 2):
+        total += (~((ord(old[i]) << 8) | ord(old[i + 1])) & 0xFFFF) + \
+            ((ord(new[i]) << 8) | ord(new[i + 1]))
+    while total >> 16:
+        total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
+
+
+class FrameHeaders(object):
+    """
+    Link frame headers (identifier byte and payload length) of a single
+    identifier, packed once for every length up to FRAME_HEADER_CACHE_SIZE
+    so that the send paths do not build a header per packet.
+    """
+    def __init__(self, identifier):
+        self.identifier = identifier
+        self.headers = [FRAME_HEADER.pack(identifier, length)
+            for length in xrange(FRAME_HEADER_CACHE_SIZE + 1)]
+
+    def __getitem__(self, length):
+        if length <= FRAME_HEADER_CACHE_SIZE:
+            return self.headers[length]
+        return FRAME_HEADER.pack(self.identifier, length)
+
+
 class Packet(object):
-    def __init__(self, payload=None, source=None, routing={}):
+    """
+    A packet and where it came from. The payload is a string, or any
+    buffer (memoryview, bytearray) that supports slicing and struct.
+
+    Packets are created for every packet forwarded, so they have no
+    __dict__, and the IPv4 header fields are parsed on first use, once per
+    payload, for everything that looks at them on the way.
+
+    A payload read into a BufferPool buffer is a memoryview of it, address
+    being where it starts. The buffer goes back to the pool with release,
+    by whoever writes or drops the packet; code that keeps packets longer
+    than that calls detach.
+    """
+    __slots__ = ("payload", "source", "routing", "pool", "address", "_header",
+        "_parsed")
+
+    def __init__(self, payload=None, source=None, routing=None, pool=None,
+            address=0):
         self.payload = payload
         self.source = source
         self.routing = routing
+        self.pool = pool
+        self.address = address
+        self._parsed = UNPARSED
+
+    def header(self):
+        """
+        Returns (version, header_length, protocol, fragment, src, dst, ports)
+        of the payload, see parse_header.
+        """
+        if self._parsed is not self.payload:
+            self._header = parse_header(self.payload)
+            self._parsed = self.payload
+        return self._header
+
+    @property
+    def version(self):
+        return self.header()[0]
+
+    @property
+    def protocol(self):
+        return self.header()[2]
+
+    @property
+    def src(self):
+        return self.header()[4]
+
+    @property
+    def dst(self):
+        return self.header()[5]
+
+    @property
+    def ports(self):
+        return self.header()[6]
+
+    def flow_hash(self):
+        """
+        Hashes the 5-tuple of an IPv4 packet. Fragments and protocols without
+        ports hash by protocol and addresses only, so that every packet of a
+        flow gets the same value.
+        """
+        version, _, protocol, fragment, src, dst, ports = self.header()
+        if version != 4:
+            return 0
+        if fragment & 0x3FFF:
+            ports = None
+        return hash((protocol, src, dst, ports))
+
+    def tobytes(self):
+        if isinstance(self.payload, memoryview):
+            return self.payload.tobytes()
+        return str(self.payload)
+
+    def release(self):
+        """
+        Returns the pool buffer of the payload, which must not be used
+        afterwards.
+        """
+        if self.pool is not None:
+            self.pool.release(self.address)
+            self.pool = None
+
+    def detach(self):
+        """
+        Copies a pooled payload out of its buffer and releases the buffer.
+        """
+        if self.pool is not None:
+            self.payload = self.payload.tobytes()
+            self.release()
 
     def serialize(self):
         ret = struct.pack("!H", len(self.payload))
-        ret += self.payload
+        ret += self.tobytes()
         return ret
 
+    def frame(self, headers):
+        """
+        Returns the frame as (header, payload) parts for scatter-gather
+        writes, leaving the payload uncopied. A pooled payload is given as
+        (address, memoryview), see mmsg.
+        """
+        if self.pool is not None:
+            return (headers[len(self.payload)], (self.address, self.payload))
+        return (headers[len(self.payload)], self.payload)
+
     def __str__(self):
         name = "Packet of %d bytes" % len(self.payload)
         if self.source:
@@ -0,0 +1,94 @@
+import struct
+from . import ipaddr
+from ..utils import ExceptionIgnoredExecution
+from ..utils.metrics import new_metrics, REWRITES
+
+
+ADDRESS = struct.Struct("!L")
+
+
+class Rule(object):
+    """
+    A rewriter and the header predicates a packet has to meet to be passed
+    to it. The predicates are compiled into one match function that only
+    tests what was asked for.
+    """
+    def __init__(self, callback, protocol=None, ports=None, dst_prefix=None):
+        self.callback = callback
+        self.protocol = protocol
+        self.ports = frozenset(ports) if ports is not None else None
+        self.network = None
+        if dst_prefix is not None:
+            network = ipaddr.ip_network(dst_prefix)
+            self.network = (int(network.network_address), int(network.netmask))
+        self.match = self.compile()
+
+    def compile(self):
+        tests = []
+        if self.protocol is not None:
+            protocol = self.protocol
+            tests.append(lambda p, ports, dst: p == protocol)
+        if self.ports is not None:
+            wanted = self.ports
+            tests.append(lambda p, ports, dst: ports is not None and (
+                ports[0] in wanted or ports[1] in wanted))
+        if self.network is not None:
+            network, mask = self.network
+            tests.append(lambda p, ports, dst:
+                ADDRESS.unpack(dst)[0] & mask == network)
+
+        if not tests:
+            return lambda p, ports, dst: True
+        if len(tests) == 1:
+            return tests[0]
+        return lambda p, ports, dst: all(test(p, ports, dst) for test in tests)
+
+
+class RewriterPipeline(object):
+    """
+    Runs packets through the rewriters whose predicates (IP protocol,
+    source or destination port, destination prefix) they meet. The header
+    fields are the ones the packet parsed, and packets of a protocol no
+    rewriter asks for are passed without looking further.
+
+    A rewriter gets the payload and returns a new one, or None to keep it.
+    Every packet passed to a rewriter is counted in metrics.
+    """
+    def __init__(self, logger, metrics=None):
+        self.logger = logger
+        self.metrics = metrics if metrics is not None else new_metrics()
+        self.rules = []
+        self.protocols = None
+
+    def __len__(self):
+        return len(self.rules)
+
+    def add(self, callback, protocol=None, ports=None, dst_prefix=None):
+        self.rules.append(Rule(callback, protocol, ports, dst_prefix))
+        protocols = [rule.protocol for rule in self.rules]
+        self.protocols = None if None in protocols else frozenset(protocols)
+
+    def rewrite(self, packet):
+        version, _, protocol, _, _, dst, ports = packet.header()
+        if version != 4:
+            return
+        if self.protocols is not None and protocol not in self.protocols:
+            return
+
+        data = None
+        for rule in self.rules:
+            if rule.match(protocol, ports, dst):
+                if data is None:
+                    # rewritten payloads replace the pooled buffer
+                    packet.detach()
+                    data = packet.tobytes()
+                    self.metrics[REWRITES] += 1
+                with ExceptionIgnoredExecution(self.logger):
+                    modified = rule.callback(data)
+                    if modified is not None:
+                        data = modified
+                        packet.payload = data
+
+    def rewrite_all(self, packets):
+        for packet in packets:
+            self.rewrite(packet)
@@ -0,0 +1,152 @@
+import errno
+import logging
+import random
+import socket
+import time
+import tornado.ioloop
+from . import dns
+from ..utils import ExceptionIgnoredExecution
+
+
+DNS_PORT = 53
+NAMESERVER = "8.8.8.8"
+RESOLVE_TIMEOUT = 5
+SWEEP_INTERVAL = 1000
+MAX_RESPONSE = 4096
+
+
+class Resolver(object):
+    """
+    Resolves the DNS queries of all sessions of the process through one
+    UDP socket to nameserver. Queries are sent upstream as they come,
+    without waiting for earlier ones to be answered, and a question that
+    is already in flight is not asked again: its response goes to every
+    query that asked it.
+
+    Callbacks get the response as it came from upstream, the transaction
+    id is for the caller to put back.
+    """
+    def __init__(self, nameserver=NAMESERVER, timeout=RESOLVE_TIMEOUT,
+            io_loop=None):
+        self.nameserver = (nameserver, DNS_PORT)
+        self.timeout = timeout
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self.logger = logging.getLogger("resolver<%s>" % nameserver)
+        self.socket = None
+        self.periodic = None
+        # question: (transaction id, sent, callbacks)
+        self.in_flight = {}
+        self.questions = {}
+        self.sent = 0
+        self.deduplicated = 0
+        self.answered = 0
+        self.timed_out = 0
+
+    @classmethod
+    def shared(cls, nameserver=NAMESERVER, timeout=RESOLVE_TIMEOUT):
+        attr_name = "_shared_instance"
+        if not hasattr(cls, attr_name):
+            setattr(cls, attr_name, Resolver(nameserver, timeout))
+        return getattr(cls, attr_name)
+
+    def stats(self):
+        return {
+            "in_flight": len(self.in_flight),
+            "sent": self.sent,
+            "deduplicated": self.deduplicated,
+            "answered": self.answered,
+            "timed_out": self.timed_out,
+        }
+
+    def open(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(0)
+        self.io_loop.add_handler(self.socket.fileno(), self.on_read,
+            self.io_loop.READ)
+        self.periodic = tornado.ioloop.PeriodicCallback(self.sweep,
+            SWEEP_INTERVAL, self.io_loop)
+        self.periodic.start()
+
+    def close(self):
+        if self.socket is not None:
+            self.periodic.stop()
+            self.io_loop.remove_handler(self.socket.fileno())
+            self.socket.close()
+            self.socket = None
+
+    def resolve(self, query, callback):
+        """
+        Sends query upstream unless its question is in flight already, and
+        calls callback with the response, or with None if there is none
+        within the timeout. Raises ValueError if query is not a standard
+        query.
+        """
+        key, _ = dns.parse_question(query)
+        entry = self.in_flight.get(key, None)
+        if entry is not None:
+            entry[2].append(callback)
+            self.deduplicated += 1
+            return
+
+        if self.socket is None:
+            self.open()
+        # random ids, answers are only taken from the nameserver and for the
+        # question asked
+        dns_id = random.getrandbits(16)
+        while dns_id in self.questions:
+            dns_id = random.getrandbits(16)
+        try:
+            self.socket.sendto(dns.HEADER_ID.pack(dns_id) + query[2:],
+                self.nameserver)
+        except socket.error as e:
+            self.logger.error("cannot send DNS query: %s" % str(e))
+            callback(None)
+            return
+        self.in_flight[key] = (dns_id, time.time(), [callback])
+        self.questions[dns_id] = key
+        self.sent += 1
+
+    def on_read(self, fd, events):
+        while self.socket:
+            try:
+                data, addr = self.socket.recvfrom(MAX_RESPONSE)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            self.on_response(data, addr)
+
+    def on_response(self, data, addr):
+        if addr != self.nameserver or len(data) < dns.HEADER.size:
+            return
+        dns_id, = dns.HEADER_ID.unpack_from(data)
+        key = self.questions.get(dns_id, None)
+        if key is None:
+            self.logger.debug("unknown DNS answer: %d" % dns_id)
+            return
+        try:
+            answered, _ = dns.parse_question(data)
+        except ValueError:
+            answered = None
+        if answered != key:
+            self.logger.warning("DNS answer %d does not match its question" %
+                dns_id)
+            return
+
+        del self.questions[dns_id]
+        _, _, callbacks = self.in_flight.pop(key)
+        self.answered += 1
+        for callback in callbacks:
+            with ExceptionIgnoredExecution(self.logger):
+                callback(data)
+
+    def sweep(self):
+        deadline = time.time() - self.timeout
+        for key, (dns_id, sent, callbacks) in self.in_flight.items():
+            if sent < deadline:
+                del self.in_flight[key]
+                del self.questions[dns_id]
+                self.timed_out += 1
+                for callback in callbacks:
+                    with ExceptionIgnoredExecution(self.logger):
+                        callback(None)
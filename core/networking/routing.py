@@ -0,0 +1,93 @@
+import struct
+from . import ipaddr
+
+
+ADDRESS = struct.Struct("!L")
+
+
+class RoutingTable(object):
+    """
+    Longest-prefix-match table over IPv4 prefixes, keyed by the integer
+    value of the addresses. Prefixes live in a binary radix trie; host
+    routes, the common case of one route per client, are also kept in a
+    dict keyed by the packed address, which lookup_packed tries first.
+    """
+    def __init__(self):
+        # node: [child for bit 0, child for bit 1, value]
+        self.root = [None, None, None]
+        self.hosts = {}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    @staticmethod
+    def parse(prefix):
+        network = ipaddr.ip_network(prefix)
+        if network.version != 4:
+            raise ValueError("only IPv4 prefixes are supported: %s" % prefix)
+        return int(network.network_address), network.prefixlen
+
+    def add(self, prefix, value):
+        """
+        Routes prefix ("10.48.0.2" or "10.48.0.0/24") to value, replacing
+        an existing route of the same prefix.
+        """
+        address, length = self.parse(prefix)
+        node = self.root
+        for i in xrange(length):
+            bit = (address >> (31 - i)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        if node[2] is None:
+            self.size += 1
+        node[2] = value
+        if length == 32:
+            self.hosts[ADDRESS.pack(address)] = value
+
+    def remove(self, prefix):
+        address, length = self.parse(prefix)
+        path = [self.root]
+        for i in xrange(length):
+            node = path[-1][(address >> (31 - i)) & 1]
+            if node is None:
+                return None
+            path.append(node)
+        value, path[-1][2] = path[-1][2], None
+        if value is None:
+            return None
+        self.size -= 1
+        if length == 32:
+            del self.hosts[ADDRESS.pack(address)]
+        # prune the branch that no longer leads to a route
+        for i in xrange(length, 0, -1):
+            node = path[i]
+            if node[0] is not None or node[1] is not None or node[2] is not None:
+                break
+            path[i - 1][(address >> (32 - i)) & 1] = None
+        return value
+
+    def lookup(self, address):
+        """
+        Returns the value of the longest prefix containing the integer
+        address, None if there is none.
+        """
+        node = self.root
+        found = node[2]
+        for i in xrange(32):
+            node = node[(address >> (31 - i)) & 1]
+            if node is None:
+                break
+            if node[2] is not None:
+                found = node[2]
+        return found
+
+    def lookup_packed(self, packed):
+        """
+        Same as lookup, for an address as the 4 bytes found in IP headers.
+        """
+        value = self.hosts.get(packed, None)
+        if value is None:
+            value = self.lookup(ADDRESS.unpack(packed)[0])
+        return value
@@ -2,9 +2,14 @@ import logging
 import uuid
 import functools
 import traceback
+import tornado.ioloop
 import tornado.stack_context
 from .utils import import_class, ExceptionIgnoredExecution
-from .networking.ip import IPAddressSpaceManager
+from .networking import control, dns
+from .networking.ip import IPLeaseManager, LEASE_SECONDS
+from .networking.resolver import Resolver, NAMESERVER, RESOLVE_TIMEOUT
+from .networking.pipeline import RewriterPipeline
+from .utils.metrics import new_metrics
 
 
 class Session(object):
@@ -17,7 +22,9 @@ class Session(object):
         self.logger = logging.getLogger("session[%s,%s]" % (str(self.device),
             str(self.link)))
         self.message_callbacks = {}
-        self.rewriter_callbacks = []
+        # counters of the session itself, link and device keep their own
+        self.metrics = new_metrics()
+        self.rewriters = RewriterPipeline(self.logger, self.metrics)
         self.addons = []
         self.network_configured = False
 
@@ -51,11 +58,30 @@ class Session(object):
     def add_message_callback(self, _type, callback):
         self.message_callbacks[_type] = tornado.stack_context.wrap(callback)
 
-    def add_rewriter_callback(self, callback):
-        self.rewriter_callbacks.append(tornado.stack_context(callback))
+    def add_rewriter_callback(self, callback, protocol=None, ports=None,
+            dst_prefix=None):
+        """
+        Passes packets in both directions to callback, only those that meet
+        the given header predicates.
+        """
+        self.rewriters.add(callback, protocol, ports, dst_prefix)
+        if self.network_configured:
+            self.connect_packet_paths()
+
+    def set_tracing(self, enabled, sample=1):
+        """
+        Traces the packets of this session's link and device at runtime.
+        """
+        self.link.set_tracing(enabled, sample)
+        self.device.set_tracing(enabled, sample)
+        self.logger.info("tracing %s" % ("1 in %d packets" % sample
+            if enabled else "off"))
 
     def on_message(self, msg):
         callback = self.message_callbacks.get(msg["type"], None)
+        if callback is None:
+            self.logger.warning("unexpected message: %s" % msg["type"])
+            return
         callback(msg)
 
     def configuration_parameters(self):
@@ -75,30 +101,30 @@ class Session(object):
                 addon.on_session_established()
 
         self.network_configured = True
-
-        self.device.set_packet_callback(self.on_device_packet)
-        self.link.set_packet_callback(self.on_link_packet)
+        self.connect_packet_paths()
         self.logger.info("session initiated!")
 
-    def on_device_packet(self, packet):
-        data = packet.payload
-
-        for rewriter in self.rewriter_callbacks:
-            with ExceptionIgnoredExecution:
-                data = rewriter(data)
+    def connect_packet_paths(self):
+        if self.rewriters:
+            self.device.set_packet_callback(self.on_device_packet)
+            self.device.set_batch_packet_callback(self.on_device_packets)
+            self.link.set_packet_callback(self.on_link_packet)
+        else:
+            # nothing to rewrite: device and link hand packets to each other
+            self.device.set_packet_callback(self.link.send_packet)
+            self.device.set_batch_packet_callback(self.link.send_packets)
+            self.link.set_packet_callback(self.device.send_packet)
 
-        packet.payload = data
+    def on_device_packet(self, packet):
+        self.rewriters.rewrite(packet)
         self.link.send_packet(packet)
 
+    def on_device_packets(self, packets):
+        self.rewriters.rewrite_all(packets)
+        self.link.send_packets(packets)
+
     def on_link_packet(self, packet):
-        data = packet.payload
-        for rewriter in self.rewriter_callbacks:
-            with ExceptionIgnoredExecution:
-                modified = rewriter(data)
-                if modified != None:
-                    data = modified
-
-        packet.payload = data
+        self.rewriters.rewrite(packet)
         self.device.send_packet(packet)
 
     def cleanup(self):
@@ -111,6 +137,7 @@ class Session(object):
                 self.device.restore_network(*self.configuration_parameters())
 
         self.device.set_packet_callback(None)
+        self.device.set_batch_packet_callback(None)
         self.link.set_packet_callback(None)
 
         with ExceptionIgnoredExecution():
@@ -122,46 +149,106 @@ class Session(object):
 class ServerSession(Session):
     def __init__(self, *args, **kwargs):
         super(ServerSession, self).__init__(*args, **kwargs)
-        self.ip_allocated = False
+        self.lease = None
+        self.resolved = []
 
     def setup_completed(self):
         self.add_message_callback("ip_request", self.on_ip_request)
         self.add_message_callback("ip_confirm", self.on_ip_confirm)
-        self.ip_manager = IPAddressSpaceManager(self.config['network'])
-
-    def on_ip_request(self):
-        self.server_ip, self.client_ip = self.ip_manager.allocate(
-            ), self.ip_manager.allocate()
-        self.ip_allocated = True
+        self.add_message_callback("resolve_request", self.on_resolve_request)
+        self.ip_manager = IPLeaseManager.shared(self.config['network'],
+            self.config.get('shard', 0), self.config.get('shards', 1),
+            self.config.get('lease_seconds', LEASE_SECONDS),
+            self.config.get('lease_file', None))
+
+    def on_ip_request(self, msg):
+        if self.lease is None:
+            self.lease = self.ip_manager.acquire(msg.get("client_id", None),
+                self.link.ip_endpoint)
+            if self.lease is None:
+                self.logger.error("no addresses left in %s" % self.config['network'])
+                self.link.apply_close_callback()
+                return
+            self.lease.is_alive = self.link.is_alive
+            self.lease.on_taken_over = self.on_lease_taken_over
+        self.server_ip, self.client_ip = self.lease.server_ip, self.lease.client_ip
+        # clients that predate the codecs send none and ignore the answer
+        self.link.accept_codec(msg.get("codec", control.CODEC_JSON))
         self.link.send_message({
             "type": "ip_reply",
             "server_ip": self.server_ip,
             "network":  self.config['network'],
             "client_ip": self.client_ip,
+            "codec": self.link.codec,
             })
 
-    def on_ip_confirm(self):
+    def on_lease_taken_over(self):
+        # the client reconnected over another link, this one is stale
+        self.logger.info("addresses taken over by a new session, closing")
+        self.link.apply_close_callback()
+
+    def on_ip_confirm(self, msg):
         self.finalize_session()
 
+    def on_resolve_request(self, msg):
+        resolver = Resolver.shared(self.config.get("nameserver", NAMESERVER),
+            self.config.get("resolve_timeout", RESOLVE_TIMEOUT))
+        try:
+            queries = dns.decode_batch(msg["queries"])
+        except (KeyError, ValueError):
+            self.logger.warning("malformed resolve request")
+            return
+        for query_id, query in queries:
+            try:
+                resolver.resolve(query, functools.partial(self.on_resolved,
+                    query_id))
+            except ValueError:
+                self.on_resolved(query_id, None)
+
+    def on_resolved(self, query_id, response):
+        if self.resolved is None:
+            # the session is gone
+            return
+        if response is not None and len(response) > dns.MAX_TUNNELED_BYTES:
+            try:
+                response = dns.truncate(response)
+            except ValueError:
+                response = None
+        if not self.resolved:
+            # answers that come in together go back in one message
+            tornado.ioloop.IOLoop.instance().add_callback(self.send_resolved)
+        self.resolved.append((query_id, response))
+
+    def send_resolved(self):
+        if not self.resolved:
+            return
+        for batch in dns.encode_batches(self.resolved):
+            self.link.send_message({"type": "resolve_response", "answers": batch})
+        self.resolved = []
+
     def cleanup(self):
-        if self.ip_allocated:
-            self.ip_manager.release(self.server_ip)
-            self.ip_manager.release(self.client_ip)
+        self.resolved = None
+        if self.lease is not None:
+            self.lease.is_alive = self.lease.on_taken_over = None
+            self.ip_manager.release(self.lease)
+            self.lease = None
 
         super(ServerSession, self).cleanup()
 
 
 class ClientSession(Session):
     def setup_completed(self):
-        print "A"
         self.add_message_callback("ip_reply", self.on_ip_reply)
+        # the server hands the same addresses back to the same identity
         self.link.send_message({
-                "type": "ip_request"
+                "type": "ip_request",
+                "client_id": self.config.get("client_id", self.name),
+                "codec": self.link.offered_codec,
                 })
 
     def on_ip_reply(self, msg):
-        print "B"
         self.server_ip = msg["server_ip"]
         self.client_ip = msg["client_ip"]
+        self.link.accept_codec(msg.get("codec", control.CODEC_JSON))
         self.link.send_message({"type": "ip_confirm"})
         self.finalize_session()
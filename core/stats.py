@@ -0,0 +1,92 @@
+import errno
+import logging
+import os
+import tornado.httpserver
+import tornado.ioloop
+import tornado.netutil
+from .utils.buffers import BufferPool
+from .utils.metrics import (PREFIX, LINK_METRICS, DEVICE_METRICS,
+    SESSION_METRICS, array_families, format_families)
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def session_labels(session):
+    # the link is known from the start, the client address once assigned
+    return (("client", getattr(session, "client_ip", "")),
+        ("link", str(session.link)))
+
+
+def render(sessions, admission=None):
+    """
+    Returns the metrics of sessions, their links and devices, and of the
+    process, in the Prometheus text format.
+    """
+    links = []
+    devices = []
+    rows = []
+    for session in sessions:
+        session.link.update_metrics()
+        session.device.update_metrics()
+        labels = session_labels(session)
+        links.append((labels, session.link.metrics))
+        devices.append((labels, session.device.metrics))
+        rows.append((labels, session.metrics))
+
+    families = [(PREFIX + "sessions", "gauge", "Sessions running.",
+        [((), len(sessions))])]
+    if admission is not None:
+        families.append((PREFIX + "sessions_queued", "gauge",
+            "Sessions waiting to be admitted.",
+            [((), admission.stats()["queued"])]))
+    pool = BufferPool.shared().stats()
+    families.append((PREFIX + "buffers_free", "gauge",
+        "Receive buffers free in the pool.", [((), pool["free"])]))
+    families.append((PREFIX + "buffers_exhausted_total", "counter",
+        "Reads that found no free receive buffer.", [((), pool["exhausted"])]))
+    families.extend(array_families("link", LINK_METRICS, links))
+    families.extend(array_families("device", DEVICE_METRICS, devices))
+    families.extend(array_families("session", SESSION_METRICS, rows))
+    return format_families(families)
+
+
+class StatsServer(object):
+    """
+    Serves the metrics of the sessions of the process over HTTP on a Unix
+    socket, for Prometheus or anything else that reads its text format:
+
+        curl --unix-socket /var/run/vpn-stats.sock http://localhost/metrics
+
+    Every path answers with all metrics, they are rendered per request.
+    """
+    def __init__(self, path, sessions, admission=None, io_loop=None):
+        self.path = path
+        self.sessions = sessions
+        self.admission = admission
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self.server = None
+        self.logger = logging.getLogger("stats<%s>" % path)
+
+    def start(self):
+        sock = tornado.netutil.bind_unix_socket(self.path)
+        self.server = tornado.httpserver.HTTPServer(self.on_request,
+            io_loop=self.io_loop)
+        self.server.add_socket(sock)
+        self.logger.info("serving metrics")
+
+    def stop(self):
+        if self.server is not None:
+            self.server.stop()
+            self.server = None
+            try:
+                os.remove(self.path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def on_request(self, request):
+        body = render(self.sessions, self.admission).encode("utf-8")
+        request.write("HTTP/1.1 200 OK\r\nContent-Type: %s\r\n"
+            "Content-Length: %d\r\n\r\n" % (CONTENT_TYPE, len(body)) + body)
+        request.finish()
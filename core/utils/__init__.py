@@ -3,6 +3,7 @@ import subprocess
 import logging
 import sys
 import os
+import socket
 import tornado.ioloop
 
 
@@ -12,6 +13,11 @@ logger = logging.getLogger("utils")
 validate_port = lambda p: isinstance(p, int) and p > 0 and p < 65535
 
 
+# not exported by the socket module of python 2.
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT",
+    0x0200 if "darwin" in sys.platform else 15)
+
+
 # base class for all exceptions raised within this app.
 class Error(Exception):
     pass
@@ -81,12 +87,12 @@ def read_packet(fd, io_loop=None, max_size=2048, callback=None):
     else:
         io_loop = io_loop or tornado.ioloop.IOLoop.instance()
 
-        def _callback(fd, events):
-            io_loop.remove_handler(fd)
+        def _callback(fileno, events):
+            io_loop.remove_handler(fileno)
             data, addr = fd.recvfrom(max_size)
             callback((data, addr))
 
-        io_loop.add_handler(fd, _callback, io_loop.READ)
+        io_loop.add_handler(fd.fileno(), _callback, io_loop.READ)
 
 
 def import_class(cl):
@@ -97,6 +103,9 @@ def import_class(cl):
 
 
 class ExceptionIgnoredExecution(object):
+    """
+    Logs and swallows exceptions raised within the block.
+    """
     def __init__(self, logger=logger):
         super(ExceptionIgnoredExecution, self).__init__()
         self.logger = logger
@@ -104,5 +113,8 @@ class ExceptionIgnoredExecution(object):
     def __enter__(self):
         pass
 
-    def __exit__(self, *args, **kwargs):
-        pass
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None or not issubclass(exc_type, Exception):
+            return False
+        self.logger.error("ignored exception", exc_info=(exc_type, exc_value, tb))
+        return True
@@ -0,0 +1,91 @@
+"""
+Just enough eBPF to load small socket filter programs without a compiler.
+
+    program = [mov64_reg(6, 1), ld_abs_w(16), exit_insn()]
+    fd = load_socket_filter(program)
+"""
+import ctypes
+import ctypes.util
+import os
+import platform
+import struct
+
+
+BPF_PROG_LOAD = 5
+BPF_PROG_TYPE_SOCKET_FILTER = 1
+SYSCALL_BPF = {
+    "x86_64": 321,
+    "aarch64": 280,
+}
+LOG_SIZE = 4096
+
+# struct bpf_insn: opcode, dst and src register nibbles, offset, immediate
+INSN = struct.Struct("=BBhi")
+
+
+class ProgLoadAttr(ctypes.Structure):
+    _fields_ = [
+        ("prog_type", ctypes.c_uint32),
+        ("insn_cnt", ctypes.c_uint32),
+        ("insns", ctypes.c_uint64),
+        ("license", ctypes.c_uint64),
+        ("log_level", ctypes.c_uint32),
+        ("log_size", ctypes.c_uint32),
+        ("log_buf", ctypes.c_uint64),
+        ("kern_version", ctypes.c_uint32),
+        ("prog_flags", ctypes.c_uint32),
+    ]
+
+
+def insn(code, dst=0, src=0, off=0, imm=0):
+    # immediates are 32 bits, unsigned values wrap as the kernel reads them
+    imm = ctypes.c_int32(imm).value
+    return INSN.pack(code, dst | src << 4, off, imm)
+
+
+def mov64_reg(dst, src):
+    return insn(0xbf, dst, src)
+
+
+def ld_abs_w(offset):
+    """
+    r0 = the 32-bit word at offset of the packet, in host order. Needs the
+    context in r6.
+    """
+    return insn(0x20, imm=offset)
+
+
+def alu32_sub_imm(dst, imm):
+    return insn(0x14, dst, imm=imm)
+
+
+def alu32_mod_imm(dst, imm):
+    return insn(0x94, dst, imm=imm)
+
+
+def exit_insn():
+    return insn(0x95)
+
+
+def load_socket_filter(program):
+    """
+    Loads program, a list of instructions, and returns its file
+    descriptor. Raises OSError if the kernel refuses it.
+    """
+    number = SYSCALL_BPF.get(platform.machine(), None)
+    if number is None or "linux" not in platform.system().lower():
+        raise OSError(0, "eBPF is not supported on %s" % platform.machine())
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    code = ctypes.create_string_buffer("".join(program))
+    license = ctypes.create_string_buffer("GPL")
+    log = ctypes.create_string_buffer(LOG_SIZE)
+    attr = ProgLoadAttr(prog_type=BPF_PROG_TYPE_SOCKET_FILTER,
+        insn_cnt=len(program), insns=ctypes.addressof(code),
+        license=ctypes.addressof(license), log_level=1, log_size=LOG_SIZE,
+        log_buf=ctypes.addressof(log))
+    fd = libc.syscall(number, BPF_PROG_LOAD, ctypes.byref(attr),
+        ctypes.sizeof(attr))
+    if fd < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, "%s: %s" % (os.strerror(err), log.value.strip()))
+    return fd
@@ -0,0 +1,66 @@
+import ctypes
+
+
+BUFFER_SIZE = 2048
+BUFFERS = 1024
+
+
+class BufferPool(object):
+    """
+    Fixed set of receive buffers carved out of one bytearray, so that
+    packets can be read into memory that is already there instead of into
+    a new string each. Buffers are known by their address, which is what
+    the vectored system calls take; memoryviews of them are for Python.
+
+    Whoever holds a buffer gives it back with release once the packet in
+    it has been written out or dropped. When none is free, acquire returns
+    None and the reader allocates as it did before.
+    """
+    def __init__(self, count=BUFFERS, size=BUFFER_SIZE):
+        self.count = count
+        self.size = size
+        self.slab = bytearray(count * size)
+        self.view = memoryview(self.slab)
+        self.address = ctypes.addressof((ctypes.c_char * len(self.slab)
+            ).from_buffer(self.slab))
+        self.free = range(count - 1, -1, -1)
+        self.exhausted = 0
+
+    @classmethod
+    def shared(cls, count=BUFFERS, size=BUFFER_SIZE):
+        attr_name = "_shared_instance"
+        if not hasattr(cls, attr_name):
+            setattr(cls, attr_name, BufferPool(count, size))
+        return getattr(cls, attr_name)
+
+    def stats(self):
+        return {
+            "buffers": self.count,
+            "free": len(self.free),
+            "exhausted": self.exhausted,
+        }
+
+    def acquire(self):
+        """
+        Returns the address of a free buffer, None if there is none.
+        """
+        if self.free:
+            return self.address + self.free.pop() * self.size
+        self.exhausted += 1
+        return None
+
+    def release(self, address):
+        """
+        Gives back the buffer that address points into.
+        """
+        self.free.append((address - self.address) // self.size)
+
+    def buffer(self, address, length=None):
+        """
+        Returns a memoryview of length bytes at address, up to the end of
+        the buffer if length is None.
+        """
+        offset = address - self.address
+        if length is None:
+            length = self.size - offset % self.size
+        return self.view[offset: offset + length]
@@ -0,0 +1,62 @@
+import select
+import sys
+import tornado.ioloop
+from . import Error
+
+
+class EdgeTriggeredEPoll(object):
+    """
+    epoll(7) implementation for tornado's IOLoop that registers every
+    descriptor edge-triggered: readiness is reported once per state change
+    rather than on every poll, so handlers must read until EAGAIN.
+    """
+    def __init__(self):
+        self._epoll = select.epoll()
+
+    def fileno(self):
+        return self._epoll.fileno()
+
+    def close(self):
+        self._epoll.close()
+
+    def register(self, fd, events):
+        self._epoll.register(fd, events | select.EPOLLET)
+
+    def modify(self, fd, events):
+        self._epoll.modify(fd, events | select.EPOLLET)
+
+    def unregister(self, fd):
+        self._epoll.unregister(fd)
+
+    def poll(self, timeout):
+        return self._epoll.poll(timeout)
+
+
+ENGINES = {
+    "select": tornado.ioloop._Select,
+}
+
+if hasattr(select, "epoll"):
+    ENGINES["epoll"] = select.epoll
+    ENGINES["epoll-et"] = EdgeTriggeredEPoll
+
+if hasattr(select, "kqueue"):
+    ENGINES["kqueue"] = tornado.ioloop._KQueue
+
+
+def default_engine():
+    """
+    Edge-triggered epoll on Linux. Everywhere else stay with select(), as
+    kqueue does not report readiness on the tun devices of Mac OS X.
+    """
+    if "linux" in sys.platform and "epoll-et" in ENGINES:
+        return "epoll-et"
+    return "select"
+
+
+def create_io_loop(engine=None):
+    engine = engine or default_engine()
+    if engine not in ENGINES:
+        raise Error("unknown event engine: %s (available: %s)" % (engine,
+            ", ".join(sorted(ENGINES))))
+    return tornado.ioloop.IOLoop(impl=ENGINES[engine]())
@@ -0,0 +1,86 @@
+import array
+import math
+
+
+# slots of a metrics array, one array per link, device and session
+PACKETS_IN = 0
+BYTES_IN = 1
+PACKETS_OUT = 2
+BYTES_OUT = 3
+DROPS = 4
+REWRITES = 5
+QUEUE_DEPTH = 6
+KEEPALIVE_RTT = 7
+SLOTS = 8
+
+# links and devices count what they read as in and what they write as out
+TRAFFIC = (
+    (PACKETS_IN, "packets_in_total", "counter", "Packets received."),
+    (BYTES_IN, "bytes_in_total", "counter", "Bytes of packets received."),
+    (PACKETS_OUT, "packets_out_total", "counter", "Packets sent."),
+    (BYTES_OUT, "bytes_out_total", "counter", "Bytes of packets sent."),
+    (DROPS, "drops_total", "counter", "Packets dropped."),
+)
+LINK_METRICS = TRAFFIC + (
+    (QUEUE_DEPTH, "queue_bytes", "gauge",
+        "Bytes queued for writing to the peer."),
+    (KEEPALIVE_RTT, "keepalive_rtt_seconds", "gauge",
+        "Round-trip time of the last answered keep-alive."),
+)
+DEVICE_METRICS = TRAFFIC
+SESSION_METRICS = (
+    (REWRITES, "rewrites_total", "counter",
+        "Packets passed to rewriters."),
+)
+PREFIX = "vpn_"
+
+_ZEROS = array.array("d", [0] * SLOTS)
+
+
+def new_metrics():
+    """
+    Returns a zeroed metrics array, indexed by the slots above. Hot paths
+    add to it in place, nothing is allocated per packet.
+    """
+    return array.array("d", _ZEROS)
+
+
+def escape_label(value):
+    return unicode(value).replace("\\", "\\\\").replace("\"", "\\\"").replace(
+        "\n", "\\n")
+
+
+def format_sample(name, labels, value, kind):
+    if labels:
+        name += "{%s}" % ",".join("%s=\"%s\"" % (key, escape_label(label))
+            for key, label in labels)
+    if kind == "counter":
+        return "%s %d" % (name, value)
+    return "%s %r" % (name, float(value))
+
+
+def format_families(families):
+    """
+    Renders families in the Prometheus text exposition format. A family is
+    (name, kind, help, samples), samples being (labels, value) pairs and
+    labels a sequence of (key, value) pairs.
+    """
+    lines = []
+    for name, kind, help, samples in families:
+        lines.append("# HELP %s %s" % (name, help))
+        lines.append("# TYPE %s %s" % (name, kind))
+        for labels, value in samples:
+            lines.append(format_sample(name, labels, value, kind))
+    return "\n".join(lines) + "\n"
+
+
+def array_families(part, layout, rows):
+    """
+    Returns a family per metric of layout for rows of (labels, metrics
+    array), named after part ("link", "device" or "session"). NaN stands
+    for not measured, such samples are left out.
+    """
+    return [(PREFIX + part + "_" + name, kind, help,
+        [(labels, metrics[slot]) for labels, metrics in rows
+            if not math.isnan(metrics[slot])])
+        for slot, name, kind, help in layout]
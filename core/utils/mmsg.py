@@ -0,0 +1,329 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import socket
+import struct
+
+
+logger = logging.getLogger("mmsg")
+
+MSG_DONTWAIT = 0x40
+IOV_MAX = 1024
+SOCKADDR_IN_SIZE = 16
+MAX_CACHED_ADDRESSES = 4096
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [
+        ("iov_base", ctypes.c_void_p),
+        ("iov_len", ctypes.c_size_t),
+    ]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(iovec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_hdr", msghdr),
+        ("msg_len", ctypes.c_uint),
+    ]
+
+
+def _load_libc():
+    try:
+        return ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    except OSError:
+        return None
+
+_libc = _load_libc()
+
+
+def _load_mmsg():
+    try:
+        recvmmsg, sendmmsg = _libc.recvmmsg, _libc.sendmmsg
+    except AttributeError:
+        return None, None
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint,
+        ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint,
+        ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    return recvmmsg, sendmmsg
+
+_recvmmsg, _sendmmsg = _load_mmsg()
+
+
+def _load_writev():
+    try:
+        func = _libc.writev
+    except AttributeError:
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.POINTER(iovec), ctypes.c_int]
+    func.restype = ctypes.c_ssize_t
+    return func
+
+_writev = _load_writev()
+
+
+def _fill_iovecs(iovecs, start, parts, referenced):
+    for i, part in enumerate(parts):
+        if part.__class__ is tuple:
+            # (address, memoryview) of a pooled buffer
+            address, part = part
+            iovecs[start + i].iov_base = address
+        else:
+            pointer = ctypes.c_char_p(part)
+            referenced.append(pointer)
+            iovecs[start + i].iov_base = ctypes.cast(pointer, ctypes.c_void_p)
+        iovecs[start + i].iov_len = len(part)
+
+
+def join_parts(parts):
+    return "".join(part[1].tobytes() if part.__class__ is tuple else part
+        for part in parts)
+
+
+def writev(sock, parts):
+    """
+    Writes a sequence of strings to a non-blocking socket with a single
+    writev(2), without joining them. Returns the number of bytes written,
+    0 if the socket would block.
+    """
+    if _writev is None:
+        try:
+            return sock.send(join_parts(parts))
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return 0
+            raise
+
+    referenced = []
+    iovecs = (iovec * len(parts))()
+    _fill_iovecs(iovecs, 0, parts, referenced)
+    written = _writev(sock.fileno(), iovecs, len(parts))
+    if written < 0:
+        err = ctypes.get_errno()
+        if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+            return 0
+        raise socket.error(err, "writev: " + errno.errorcode.get(err, ""))
+    return written
+
+
+def pack_sockaddr_in(addr):
+    return struct.pack("=H", socket.AF_INET) + struct.pack("!H", addr[1]) + \
+        socket.inet_aton(addr[0]) + "\x00" * 8
+
+
+def unpack_sockaddr_in(data):
+    port, = struct.unpack("!H", data[2:4])
+    return (socket.inet_ntoa(data[4:8]), port)
+
+
+class BatchedDatagramSocket(object):
+    """
+    Receives and sends up to batch_size IPv4 datagrams per system call with
+    recvmmsg(2)/sendmmsg(2). Where libc lacks them (Mac OS X) it falls back
+    to one recvfrom/sendto per datagram behind the same interface.
+
+    With a BufferPool, datagrams are received into its buffers and handed
+    out as memoryviews, which the receiver releases. Without one, or while
+    it has none free, they are copied out as strings.
+
+    The socket must be non-blocking.
+    """
+    def __init__(self, sock, batch_size=32, buf_size=2048, pool=None):
+        self.socket = sock
+        self.batch_size = batch_size
+        self.buf_size = buf_size
+        self.pool = pool if pool is None or pool.size >= buf_size else None
+        self.native = _recvmmsg is not None and sock.family == socket.AF_INET
+        self.addresses = {}
+        if self.native:
+            self.setup_receive_vector()
+
+    def setup_receive_vector(self):
+        size = self.batch_size
+        self.recv_buffers = [ctypes.create_string_buffer(self.buf_size)
+            for i in xrange(size)]
+        self.recv_names = [ctypes.create_string_buffer(SOCKADDR_IN_SIZE)
+            for i in xrange(size)]
+        self.recv_iovecs = (iovec * size)()
+        self.recv_msgs = (mmsghdr * size)()
+        for i in xrange(size):
+            self.recv_iovecs[i].iov_base = ctypes.addressof(self.recv_buffers[i])
+            self.recv_iovecs[i].iov_len = self.buf_size
+            hdr = self.recv_msgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(self.recv_names[i])
+            hdr.msg_iov = ctypes.pointer(self.recv_iovecs[i])
+            hdr.msg_iovlen = 1
+        # pool buffer under each iovec, None where it is a private buffer
+        self.recv_slots = [None] * size
+        self.unarmed = range(size)
+
+    def arm(self):
+        """
+        Points the iovecs whose buffers were handed out at free pool buffers.
+        """
+        pool = self.pool
+        unarmed = []
+        for i in self.unarmed:
+            address = pool.acquire()
+            if address is None:
+                self.recv_iovecs[i].iov_base = ctypes.addressof(self.recv_buffers[i])
+                unarmed.append(i)
+            else:
+                self.recv_iovecs[i].iov_base = address
+                self.recv_slots[i] = address
+        self.unarmed = unarmed
+
+    def close(self):
+        """
+        Gives back the pool buffers the iovecs point at.
+        """
+        if self.native and self.pool is not None:
+            for i, address in enumerate(self.recv_slots):
+                if address is not None:
+                    self.pool.release(address)
+                    self.recv_slots[i] = None
+                    self.recv_iovecs[i].iov_base = ctypes.addressof(
+                        self.recv_buffers[i])
+            self.pool = None
+
+    def recv(self):
+        """
+        Returns a list of (data, addr, address) tuples, empty once the socket
+        would block. address is that of the pool buffer holding data, None
+        if data is a string.
+        """
+        if not self.native:
+            return self.recv_fallback()
+
+        if self.pool is not None and self.unarmed:
+            self.arm()
+        for i in xrange(self.batch_size):
+            self.recv_msgs[i].msg_hdr.msg_namelen = SOCKADDR_IN_SIZE
+        count = _recvmmsg(self.socket.fileno(), self.recv_msgs, self.batch_size,
+            MSG_DONTWAIT, None)
+        if count < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return []
+            raise socket.error(err, "recvmmsg: " + errno.errorcode.get(err, ""))
+
+        received = []
+        for i in xrange(count):
+            length = self.recv_msgs[i].msg_len
+            addr = unpack_sockaddr_in(self.recv_names[i].raw)
+            address = self.recv_slots[i]
+            if address is None:
+                data = ctypes.string_at(self.recv_buffers[i], length)
+            else:
+                data = self.pool.buffer(address, length)
+                self.recv_slots[i] = None
+                self.unarmed.append(i)
+            received.append((data, addr, address))
+        return received
+
+    def recv_fallback(self):
+        received = []
+        while len(received) < self.batch_size:
+            address = self.pool.acquire() if self.pool is not None else None
+            try:
+                if address is None:
+                    data, addr = self.socket.recvfrom(self.buf_size)
+                else:
+                    length, addr = self.socket.recvfrom_into(
+                        self.pool.buffer(address), self.buf_size)
+                    data = self.pool.buffer(address, length)
+            except socket.error as e:
+                if address is not None:
+                    self.pool.release(address)
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            received.append((data, addr, address))
+        return received
+
+    def sockaddr(self, addr):
+        name = self.addresses.get(addr, None)
+        if name is None:
+            if len(self.addresses) >= MAX_CACHED_ADDRESSES:
+                self.addresses.clear()
+            name = self.addresses[addr] = ctypes.create_string_buffer(
+                pack_sockaddr_in(addr), SOCKADDR_IN_SIZE)
+        return name
+
+    def send(self, datagrams):
+        """
+        Sends a list of (data, addr) pairs, data being a string or a tuple
+        of parts gathered into one datagram: strings, or the (address,
+        memoryview) of pooled buffers. Datagrams the kernel has no room for
+        are dropped, as they would be anywhere else on the path. Returns the
+        number of datagrams dropped.
+        """
+        if not self.native:
+            return self.send_fallback(datagrams)
+
+        dropped = 0
+        for offset in xrange(0, len(datagrams), self.batch_size):
+            chunk = datagrams[offset: offset + self.batch_size]
+            size = len(chunk)
+            parts = [(data,) if isinstance(data, str) else data
+                for data, addr in chunk]
+            iovecs = (iovec * sum(len(p) for p in parts))()
+            msgs = (mmsghdr * size)()
+            # keep payloads and names referenced for the duration of the call
+            referenced = []
+            start = 0
+            for i, (data, addr) in enumerate(chunk):
+                _fill_iovecs(iovecs, start, parts[i], referenced)
+                name = self.sockaddr(addr)
+                referenced.append(name)
+                hdr = msgs[i].msg_hdr
+                hdr.msg_name = ctypes.addressof(name)
+                hdr.msg_namelen = SOCKADDR_IN_SIZE
+                hdr.msg_iov = ctypes.pointer(iovecs[start])
+                hdr.msg_iovlen = len(parts[i])
+                start += len(parts[i])
+
+            sent = 0
+            while sent < size:
+                pending = ctypes.cast(ctypes.addressof(msgs) + sent *
+                    ctypes.sizeof(mmsghdr), ctypes.POINTER(mmsghdr))
+                count = _sendmmsg(self.socket.fileno(), pending, size - sent,
+                    MSG_DONTWAIT)
+                if count < 0:
+                    err = ctypes.get_errno()
+                    if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                        logger.debug("dropped %d datagrams" % (size - sent))
+                        dropped += size - sent
+                        break
+                    raise socket.error(err, "sendmmsg: " +
+                        errno.errorcode.get(err, ""))
+                sent += count
+        return dropped
+
+    def send_fallback(self, datagrams):
+        dropped = 0
+        for data, addr in datagrams:
+            if not isinstance(data, str):
+                data = join_parts(data)
+            try:
+                self.socket.sendto(data, addr)
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                    raise
+                dropped += 1
+        return dropped
@@ -0,0 +1,69 @@
+import logging
+import tornado.ioloop
+from . import ExceptionIgnoredExecution
+
+
+TICK_SECONDS = 1
+SLOTS = 128
+
+
+class TimerWheel(object):
+    """
+    Hashed timing wheel: one IOLoop timer for any number of timeouts. A
+    timeout goes into the slot of the tick it is due at, modulo the number
+    of slots, and each tick only looks at the slot of that tick. Timeouts
+    further away than one turn stay in their slot for more turns.
+
+    now is the number of seconds the wheel has ticked, an integer that
+    only moves forward and costs nothing to read, for code that needs to
+    stamp events more often than it needs precision.
+    """
+    def __init__(self, tick_seconds=TICK_SECONDS, slots=SLOTS, io_loop=None):
+        self.tick_seconds = tick_seconds
+        self.slots = [[] for i in xrange(slots)]
+        self.now = 0
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self.periodic = None
+        self.logger = logging.getLogger("timer-wheel")
+
+    def start(self):
+        if self.periodic is None:
+            self.periodic = tornado.ioloop.PeriodicCallback(self.tick,
+                self.tick_seconds * 1000, self.io_loop)
+            self.periodic.start()
+
+    def stop(self):
+        if self.periodic is not None:
+            self.periodic.stop()
+            self.periodic = None
+
+    def schedule(self, seconds, callback):
+        """
+        Calls callback once, after at least seconds, rounded up to ticks.
+        Returns a handle for cancel.
+        """
+        ticks = max(1, -(-int(seconds) // self.tick_seconds))
+        deadline = self.now + ticks * self.tick_seconds
+        # timer: [deadline, callback]
+        timer = [deadline, callback]
+        self.slots[(deadline // self.tick_seconds) % len(self.slots)].append(timer)
+        return timer
+
+    def cancel(self, timer):
+        # dropped from its slot when the slot comes up
+        timer[1] = None
+
+    def tick(self):
+        self.now += self.tick_seconds
+        index = (self.now // self.tick_seconds) % len(self.slots)
+        slot = self.slots[index]
+        if not slot:
+            return
+        self.slots[index] = [timer for timer in slot
+            if timer[0] > self.now and timer[1] is not None]
+        for timer in slot:
+            callback = timer[1]
+            if timer[0] <= self.now and callback is not None:
+                timer[1] = None
+                with ExceptionIgnoredExecution(self.logger):
+                    callback()
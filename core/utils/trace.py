@@ -0,0 +1,48 @@
+import logging
+
+
+class Tracer(object):
+    """
+    Per-packet logging for hot paths. Call sites test enabled before doing
+    anything else, so a tracer that is off costs one attribute lookup:
+
+        if self.tracer.enabled:
+            self.tracer.trace("sent: %s", packet)
+
+    A tracer is on when its logger logs debug messages, or when it has
+    been turned on at runtime with enable, which logs at the level of the
+    logger. Either way only every sample-th call is logged, and arguments
+    are formatted only for those.
+    """
+    def __init__(self, logger, sample=1):
+        self.logger = logger
+        self.sample = sample
+        self.forced = False
+        self.count = 0
+        self.refresh()
+
+    def refresh(self):
+        """
+        Picks up a changed log level.
+        """
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        self.enabled = debug or self.forced
+        self.level = logging.DEBUG if debug else max(logging.INFO,
+            self.logger.getEffectiveLevel())
+
+    def enable(self, sample=1):
+        self.forced = True
+        self.sample = max(1, sample)
+        self.count = 0
+        self.refresh()
+
+    def disable(self):
+        self.forced = False
+        self.sample = 1
+        self.refresh()
+
+    def trace(self, msg, *args):
+        self.count += 1
+        if self.count % self.sample:
+            return
+        self.logger.log(self.level, msg, *args)
@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from core.networking.ip import IPAddressSpaceManager, IPLeaseManager
+
+
+class AddressSpaceTest(unittest.TestCase):
+    def test_released_reserved_slot_is_allocated_once(self):
+        pool = IPAddressSpaceManager("10.0.0.0/29")
+        pool.reserve(2)
+        pool.reserve(3)
+        # the restored lease expires before the cursor got to its slots
+        pool.release(pool.address_of(2))
+        pool.release(pool.address_of(3))
+        addresses = []
+        while True:
+            address = pool.allocate()
+            if address is None:
+                break
+            addresses.append(address)
+        self.assertEqual(len(addresses), pool.slots)
+        self.assertEqual(len(set(addresses)), pool.slots)
+
+
+class LeaseTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "leases")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_restore_expire_allocate(self):
+        leases = IPLeaseManager("10.0.0.0/29", lease_file=self.path)
+        for client_id in ("a", "b", "c"):
+            leases.release(leases.acquire(client_id))
+        leases.close()
+
+        leases = IPLeaseManager("10.0.0.0/29", lease_file=self.path)
+        restored = dict((lease.client_id, (lease.server_ip, lease.client_ip))
+            for lease in leases.leases.values())
+        # b is back within its lease time, a and c have expired
+        leases.idle["a"].expires = leases.idle["c"].expires = time.time() - 1
+        held = [leases.acquire("b"), leases.acquire("d")]
+        # the pool is full now, an anonymous lease frees its addresses at once
+        leases.release(leases.acquire())
+        held.append(leases.acquire("f"))
+        self.assertEqual((held[0].server_ip, held[0].client_ip), restored["b"])
+
+        addresses = [address for lease in held if lease is not None
+            for address in (lease.server_ip, lease.client_ip)]
+        self.assertEqual(len(addresses), len(set(addresses)))
+        leases.close()
+
+    def test_reconnect_takes_over_active_lease(self):
+        leases = IPLeaseManager("10.0.0.0/29")
+        old = leases.acquire("a", "192.0.2.1")
+        closed = []
+        old.is_alive = lambda: True
+        old.on_taken_over = lambda: closed.append(old)
+        # the client is back before its old session timed out
+        new = leases.acquire("a", "192.0.2.1")
+        self.assertEqual(closed, [old])
+        self.assertEqual((new.server_ip, new.client_ip),
+            (old.server_ip, old.client_ip))
+        # the old session closing does not take the addresses away
+        leases.release(old)
+        self.assertTrue(new.active)
+        self.assertEqual(leases.pool.allocated, 2)
+        leases.release(new)
+        self.assertEqual(leases.acquire("a").client_ip, new.client_ip)
+
+    def test_dead_session_is_taken_over_from_anywhere(self):
+        leases = IPLeaseManager("10.0.0.0/29")
+        old = leases.acquire("a", "192.0.2.1")
+        old.is_alive = lambda: False
+        new = leases.acquire("a", "198.51.100.7")
+        self.assertEqual(new.client_ip, old.client_ip)
+        self.assertTrue(leases.leases["a"] is new)
+
+    def test_live_sessions_sharing_an_id_keep_their_addresses(self):
+        leases = IPLeaseManager("10.0.0.0/29")
+        first = leases.acquire("a", "192.0.2.1")
+        closed = []
+        first.is_alive = lambda: True
+        first.on_taken_over = lambda: closed.append(first)
+        # a second client with a copy of the configuration
+        second = leases.acquire("a", "198.51.100.7")
+        self.assertEqual(closed, [])
+        self.assertTrue(second.client_id is None)
+        self.assertNotEqual(second.client_ip, first.client_ip)
+        self.assertNotEqual(second.server_ip, first.server_ip)
+        self.assertTrue(leases.leases["a"] is first)
+        # the second one leaving does not touch the first one's lease
+        leases.release(second)
+        self.assertTrue(first.active)
+        self.assertEqual(leases.pool.allocated, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()